@@ -0,0 +1,228 @@
+from collections import namedtuple
+import threading
+
+import numpy as np
+
+from models import db, track_artists, AUDIO_FEATURES, Play, Track
+
+
+# Same columns as the rows of api.rollup_select
+BucketRow = namedtuple('BucketRow', ['unit', 'bucket', 'play_count'] + ['avg_' + f for f in AUDIO_FEATURES])
+
+
+# Play column per time bucket unit
+BUCKET_COLUMNS = {
+    'hour': 'hour',
+    'day': 'day_of_week',
+    'week': 'week_of_year',
+    'month': 'month',
+    'year': 'year',
+}
+
+
+IN_CHUNK_SIZE = 5000
+
+
+def to_datetime64(datetimes):
+    return np.array(datetimes, dtype='datetime64[s]').astype(np.int64)
+
+
+class Catalog(object):
+
+    # Track attributes as arrays indexed by track index, shared by all users
+
+    def __init__(self):
+        self.track_index = dict()
+        self.track_ids = []
+        self.album_index = dict()
+        self.album_ids = []
+        self.artist_index = dict()
+        self.artist_ids = []
+        self.track_album = np.zeros(0, dtype=np.int32)  # -1: track without album
+        self.features = {f: np.zeros(0, dtype=np.float64) for f in AUDIO_FEATURES}  # NaN: no audio features
+        # (track index, artist index) pairs of t_track_artists
+        self.track_artist_track = np.zeros(0, dtype=np.int32)
+        self.track_artist_artist = np.zeros(0, dtype=np.int32)
+
+    def _index(self, index, ids, id_):
+        if id_ not in index:
+            index[id_] = len(ids)
+            ids.append(id_)
+        return index[id_]
+
+    def add_tracks(self, track_ids):
+        new_track_ids = [i for i in set(track_ids) if i not in self.track_index]
+        for i in range(0, len(new_track_ids), IN_CHUNK_SIZE):
+            self._load_tracks(new_track_ids[i:i + IN_CHUNK_SIZE])
+
+    def _load_tracks(self, track_ids):
+        tracks = db.session.\
+            query(Track.track_id, Track.album_id, *[getattr(Track, f) for f in AUDIO_FEATURES]).\
+            filter(Track.track_id.in_(track_ids)).\
+            all()
+        artists = db.session.\
+            query(track_artists.c.track_id, track_artists.c.artist_id).\
+            filter(track_artists.c.track_id.in_(track_ids)).\
+            all()
+
+        for track in tracks:
+            self._index(self.track_index, self.track_ids, track[0])
+        track_album = [self._index(self.album_index, self.album_ids, t[1]) if t[1] else -1 for t in tracks]
+        self.track_album = np.concatenate([self.track_album, np.array(track_album, dtype=np.int32)])
+        for n, feature in enumerate(AUDIO_FEATURES):
+            values = np.array([t[2 + n] for t in tracks], dtype=np.float64)  # None becomes NaN
+            self.features[feature] = np.concatenate([self.features[feature], values])
+
+        track_artist_track = [self.track_index[a[0]] for a in artists]
+        track_artist_artist = [self._index(self.artist_index, self.artist_ids, a[1]) for a in artists]
+        self.track_artist_track = np.concatenate([self.track_artist_track,
+                                                  np.array(track_artist_track, dtype=np.int32)])
+        self.track_artist_artist = np.concatenate([self.track_artist_artist,
+                                                   np.array(track_artist_artist, dtype=np.int32)])
+
+    def refresh_features(self):
+        # Tracks can get their audio features after they were loaded (--backfill-audio-features)
+        missing_ids = [self.track_ids[i] for i in np.flatnonzero(np.isnan(self.features['tempo'])).tolist()]
+        for i in range(0, len(missing_ids), IN_CHUNK_SIZE):
+            tracks = db.session.\
+                query(Track.track_id, *[getattr(Track, f) for f in AUDIO_FEATURES]).\
+                filter(Track.track_id.in_(missing_ids[i:i + IN_CHUNK_SIZE])).\
+                filter(Track.tempo.isnot(None)).\
+                all()
+            for track in tracks:
+                for n, feature in enumerate(AUDIO_FEATURES):
+                    self.features[feature][self.track_index[track[0]]] = track[1 + n]
+
+
+class UserPlays(object):
+
+    # Columnar copy of the plays of one user, ordered by played_at_utc_timestamp
+
+    def __init__(self):
+        self.version = None
+        self.last_timestamp = -1
+        self.row_count = 0  # Loaded plays, including the skipped ones
+        self.played_at_cet = np.zeros(0, dtype=np.int64)  # Seconds since epoch of the CET wall time
+        self.track = np.zeros(0, dtype=np.int32)
+        self.hour = np.zeros(0, dtype=np.uint8)
+        self.day_of_week = np.zeros(0, dtype=np.uint8)
+        self.week_of_year = np.zeros(0, dtype=np.uint8)
+        self.month = np.zeros(0, dtype=np.uint8)
+        self.year = np.zeros(0, dtype=np.uint16)
+
+    def append(self, rows, catalog):
+        if not rows:
+            return
+        self.row_count += len(rows)
+        self.last_timestamp = rows[-1].played_at_utc_timestamp
+        catalog.add_tracks([row.track_id for row in rows if row.track_id is not None])
+        # Plays without a (known) track are left out, like the joins of the SQL backend do
+        rows = [row for row in rows if row.track_id in catalog.track_index]
+        self.played_at_cet = np.concatenate([self.played_at_cet, to_datetime64([r.played_at_cet for r in rows])])
+        self.track = np.concatenate([self.track,
+                                     np.array([catalog.track_index[r.track_id] for r in rows], dtype=np.int32)])
+        for column in BUCKET_COLUMNS.values():
+            values = np.array([getattr(r, column) for r in rows], dtype=getattr(self, column).dtype)
+            setattr(self, column, np.concatenate([getattr(self, column), values]))
+
+    def mask(self, from_date, to_date, include_to_date):
+        from_date, to_date = to_datetime64([from_date, to_date])
+        if include_to_date:
+            return (self.played_at_cet >= from_date) & (self.played_at_cet <= to_date)
+        return (self.played_at_cet >= from_date) & (self.played_at_cet < to_date)
+
+
+class AnalyticsEngine(object):
+
+    # Answers the Counts and AudioFeature units from NumPy arrays instead of PostgreSQL. Plays of a user are
+    # loaded on first use. When the data version changes, only plays newer than the loaded ones are appended,
+    # unless older plays were added too (history import), then all plays of the user are loaded again.
+
+    def __init__(self):
+        self.catalog = Catalog()
+        self.users = dict()
+        self.lock = threading.Lock()
+
+    def _query_plays(self, user_name, after_timestamp):
+        return db.session.\
+            query(Play.played_at_utc_timestamp, Play.played_at_cet, Play.track_id,
+                  *[getattr(Play, c) for c in BUCKET_COLUMNS.values()]).\
+            filter(Play.user_name == user_name).\
+            filter(Play.played_at_utc_timestamp > after_timestamp).\
+            order_by(Play.played_at_utc_timestamp).\
+            all()
+
+    def _count_plays(self, user_name, until_timestamp):
+        return db.session.\
+            query(db.func.count(Play.played_at_utc_timestamp)).\
+            filter(Play.user_name == user_name).\
+            filter(Play.played_at_utc_timestamp <= until_timestamp).\
+            scalar()
+
+    def _get_user_plays(self, user_name, version):
+        with self.lock:
+            plays = self.users.get(user_name)
+            if plays is not None and plays.version == version:
+                return plays
+            if plays is not None:
+                self.catalog.refresh_features()
+                if self._count_plays(user_name, plays.last_timestamp) != plays.row_count:
+                    plays = None
+            if plays is None:
+                plays = self.users[user_name] = UserPlays()
+            plays.append(self._query_plays(user_name, plays.last_timestamp), self.catalog)
+            plays.version = version
+            return plays
+
+    def count_entities(self, unit, user_name, version, from_date, to_date, n):
+        # [(count, id)] of the n most played tracks, albums or artists
+        plays = self._get_user_plays(user_name, version)
+        catalog = self.catalog
+        track_counts = np.bincount(plays.track[plays.mask(from_date, to_date, include_to_date=True)],
+                                   minlength=len(catalog.track_ids))
+        if unit == 'track':
+            counts, ids = track_counts, catalog.track_ids
+        elif unit == 'album':
+            with_album = catalog.track_album >= 0
+            counts = np.bincount(catalog.track_album[with_album],
+                                 weights=track_counts[with_album],
+                                 minlength=len(catalog.album_ids))
+            ids = catalog.album_ids
+        else:
+            counts = np.bincount(catalog.track_artist_artist,
+                                 weights=track_counts[catalog.track_artist_track],
+                                 minlength=len(catalog.artist_ids))
+            ids = catalog.artist_ids
+        # Most played first, equal counts by ID like the ORDER BY of the SQL backend
+        played = np.flatnonzero(counts > 0)
+        top = played[np.lexsort((np.array(ids)[played], -counts[played]))][:n]
+        return [(int(counts[i]), ids[i]) for i in top]
+
+    def aggregate_buckets(self, bucket, user_name, version, from_date, to_date):
+        # Rows like api.rollup_select, ordered by bucket
+        plays = self._get_user_plays(user_name, version)
+        mask = plays.mask(from_date, to_date, include_to_date=False)
+        buckets = getattr(plays, BUCKET_COLUMNS[bucket])[mask].astype(np.int64)
+        tracks = plays.track[mask]
+        if not len(buckets):
+            return []
+        play_counts = np.bincount(buckets)
+
+        with_features = ~np.isnan(self.catalog.features['tempo'][tracks])
+        feature_counts = np.bincount(buckets[with_features], minlength=len(play_counts))
+        averages = dict()
+        for feature in AUDIO_FEATURES:
+            sums = np.bincount(buckets[with_features],
+                               weights=self.catalog.features[feature][tracks[with_features]],
+                               minlength=len(play_counts))
+            averages[feature] = sums / np.maximum(feature_counts, 1)
+
+        rows = []
+        for b in np.nonzero(play_counts)[0]:
+            rows.append(BucketRow(bucket, int(b), int(play_counts[b]),
+                                  *[float(averages[f][b]) if feature_counts[b] else None for f in AUDIO_FEATURES]))
+        return rows
+
+
+def init_app(app):
+    app.extensions['analytics'] = AnalyticsEngine()
@@ -1,8 +1,21 @@
 from datetime import datetime, timedelta
+import functools
 
-from flask import jsonify
-from flask_restful import Resource
-from models import db, Play, Track, Album, Artist
+from flask import Response, current_app, json, jsonify, request, stream_with_context
+from dateutil import tz
+from flask_restful import Resource, abort
+from sqlalchemy import literal, select, union_all
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.expression import FunctionElement
+from cache import ResponseCache
+from models import db, cache_key, play_to_dict, serialization_cache, track_artists, ExtractionCursor, Play, \
+    PlayRollup, Track, Album, Artist
+
+
+response_cache = ResponseCache()
+
+CET = tz.gettz('CET')
 
 
 def arg_date_to_datetime(from_date, to_date):
@@ -12,18 +25,151 @@ def arg_date_to_datetime(from_date, to_date):
     return f, t
 
 
+def load_by_ids(model, ids, *options):
+    # Fetches all instances with one IN (...) query and keeps the order of ids
+    if not ids:
+        return []
+    primary_key = model.__mapper__.primary_key[0]
+    instances = model.query.\
+        options(*options).\
+        filter(primary_key.in_(ids)).\
+        all()
+    instances_by_id = {getattr(i, primary_key.key): i for i in instances}
+    return [instances_by_id[i] for i in ids]
+
+
+def load_dicts_by_ids(model, ids, *options):
+    # Serialized entities in the order of ids, only those missing in the serialization cache are loaded
+    dicts = {i: serialization_cache.get((model.__tablename__, i)) for i in ids}
+    missing_ids = [i for i, d in dicts.items() if d is None]
+    for instance in load_by_ids(model, missing_ids, *options):
+        dicts[cache_key(instance)[1]] = instance.to_dict()
+    return [dicts[i] for i in ids]
+
+
+TRACK_DICT_OPTIONS = (joinedload(Track.artists), joinedload(Track.album).joinedload(Album.artists))
+
+
+# Columns of Play.to_dict, plays are read as plain rows instead of ORM instances
+PLAY_DICT_COLUMNS = (Play.played_at_utc_timestamp, Play.played_at_cet, Play.track_id)
+
+
+class iso_week(FunctionElement):
+    # ISO week of year of a date, like Play.week_of_year
+    type = db.Integer()
+    name = 'iso_week'
+
+
+@compiles(iso_week)
+def compile_iso_week(element, compiler, **kw):
+    date, = element.clauses
+    return compiler.process(db.cast(db.extract('week', date), db.Integer), **kw)
+
+
+@compiles(iso_week, 'sqlite')
+def compile_iso_week_sqlite(element, compiler, **kw):
+    # SQLite's %W counts weeks from the first Monday, the ISO week is the one of the Thursday in the same week
+    date, = element.clauses
+    return "((CAST(strftime('%j', date({}, '-3 days', 'weekday 4')) AS INTEGER) - 1) / 7 + 1)".format(
+        compiler.process(date, **kw))
+
+
+ROLLUP_BUCKETS = {
+    'hour': PlayRollup.hour,
+    'day': PlayRollup.day_of_week,
+    'week': iso_week(PlayRollup.date_cet),
+    'month': PlayRollup.month,
+    'year': PlayRollup.year,
+}
+
+
+def get_analytics_engine():
+    # The in-memory analytics engine if the deployment enabled it (ANALYTICS_BACKEND=numpy), else None
+    return current_app.extensions.get('analytics')
+
+
+def select_entity_counts(unit, count_query, user_name, from_date, to_date, n):
+    # [(count, id)] of the n most played entities, equal counts ordered by ID
+    engine = get_analytics_engine()
+    if engine is not None:
+        return engine.count_entities(unit, user_name, get_data_version(user_name), from_date, to_date, n)
+    return count_query.limit(n).all()
+
+
+def select_buckets(bucket, user_name, from_date, to_date):
+    # Rows of rollup_select ordered by bucket
+    engine = get_analytics_engine()
+    if engine is not None:
+        return engine.aggregate_buckets(bucket, user_name, get_data_version(user_name), from_date, to_date)
+    return db.session.execute(rollup_select(bucket, user_name, from_date, to_date).order_by('bucket')).fetchall()
+
+
+def rollup_select(bucket, user_name, from_date, to_date):
+    # Plays and average audio features of a user per time bucket. User and dates are bound parameters,
+    # so the statement text only depends on the bucket and can be prepared once per bucket.
+    column = ROLLUP_BUCKETS[bucket]
+    audio_feature_count = db.func.nullif(db.func.sum(PlayRollup.audio_feature_count), 0)
+    return select([literal(bucket).label('unit'),
+                   column.label('bucket'),
+                   db.func.sum(PlayRollup.play_count).label('play_count'),
+                   (db.func.sum(PlayRollup.sum_tempo) / audio_feature_count).label('avg_tempo'),
+                   (db.func.sum(PlayRollup.sum_energy) / audio_feature_count).label('avg_energy'),
+                   (db.func.sum(PlayRollup.sum_valence) / audio_feature_count).label('avg_valence'),
+                   (db.func.sum(PlayRollup.sum_key) / audio_feature_count).label('avg_key'),
+                   (db.func.sum(PlayRollup.sum_loudness) / audio_feature_count).label('avg_loudness')]).\
+        where(PlayRollup.user_name == db.bindparam('user_name', user_name)).\
+        where(PlayRollup.date_cet >= db.bindparam('from_date', from_date.date())).\
+        where(PlayRollup.date_cet < db.bindparam('to_date', to_date.date())).\
+        group_by(column)
+
+
+def get_data_version(user_name):
+    # Changes whenever the extractor writes new plays of the user
+    return db.session.\
+        query(ExtractionCursor.updated_at_utc).\
+        filter(ExtractionCursor.user_name == user_name).\
+        scalar()
+
+
+def ends_in_past(to_date):
+    # Dates of the API are CET dates, like played_at_cet
+    return to_date is not None and datetime.strptime(to_date, '%Y-%m-%d').date() < datetime.now(CET).date()
+
+
+def cached_response(key, user_name, to_date, build_response):
+    # Entries are bound to the data version, which also changes for imported plays and backfilled audio
+    # features. Ranges that ended before today change with it only, so they do not expire.
+    version = get_data_version(user_name)
+    expires = not ends_in_past(to_date)
+    entry = response_cache.get(key, version)
+    if entry is None:
+        entry = response_cache.set(key, build_response().get_data(), version, expires=expires)
+    response = current_app.response_class(entry.body, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.headers['Cache-Control'] = 'no-cache'  # Revalidate, so clients get 304s instead of stale data
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response.make_conditional(request)
+
+
 class Plays(Resource):
 
     def get(self, user_name):
-        latest_plays = Play.query.\
-                            filter_by(user_name=user_name).\
+        return cached_response(('plays', None, user_name, None, None), user_name, None,
+                               lambda: self._get_response(user_name))
+
+    def _get_response(self, user_name):
+        latest_plays = db.session.\
+                            query(*PLAY_DICT_COLUMNS).\
+                            filter(Play.user_name == user_name).\
                             order_by(Play.played_at_cet.desc()).\
                             limit(20).\
                             all()
+        track_dicts = load_dicts_by_ids(Track, [play.track_id for play in latest_plays], *TRACK_DICT_OPTIONS)
         result = []
 
-        for play in latest_plays:
-            result.append(play.to_dict())
+        for play, track_dict in zip(latest_plays, track_dicts):
+            result.append(play_to_dict(play, track_dict))
 
         response = jsonify({
             'meta': {
@@ -31,6 +177,48 @@ class Plays(Resource):
             },
             'latest_plays': result,
         })
+        return response
+
+
+class PlayHistory(Resource):
+
+    # Streams all plays of a user as NDJSON, newest first. Plays are read in pages with keyset pagination
+    # on played_at_utc_timestamp, so memory stays flat for any history length. Clients can resume an export
+    # with ?before=<played_at_utc_timestamp of the last received play>.
+
+    DEFAULT_PAGE_SIZE = 500
+    MAX_PAGE_SIZE = 5000
+
+    def _get_page(self, user_name, before, page_size):
+        query = db.session.\
+            query(*PLAY_DICT_COLUMNS).\
+            filter(Play.user_name == user_name)
+        if before is not None:
+            query = query.filter(Play.played_at_utc_timestamp < before)
+        plays = query.\
+            order_by(Play.played_at_utc_timestamp.desc()).\
+            limit(page_size).\
+            all()
+        track_dicts = load_dicts_by_ids(Track, [play.track_id for play in plays], *TRACK_DICT_OPTIONS)
+        return plays, track_dicts
+
+    def _generate_lines(self, user_name, before, page_size):
+        while True:
+            plays, track_dicts = self._get_page(user_name, before, page_size)
+            for play, track_dict in zip(plays, track_dicts):
+                play_dict = play_to_dict(play, track_dict)
+                play_dict['played_at_utc_timestamp'] = play.played_at_utc_timestamp
+                yield json.dumps(play_dict) + '\n'
+            if len(plays) < page_size:
+                return
+            before = plays[-1].played_at_utc_timestamp
+
+    def get(self, user_name):
+        before = request.args.get('before', type=int)
+        page_size = request.args.get('page_size', default=self.DEFAULT_PAGE_SIZE, type=int)
+        page_size = max(1, min(page_size, self.MAX_PAGE_SIZE))
+        response = Response(stream_with_context(self._generate_lines(user_name, before, page_size)),
+                            mimetype='application/x-ndjson')
         response.headers.add('Access-Control-Allow-Origin', '*')
         return response
 
@@ -61,23 +249,22 @@ class Counts(Resource, ResourceMixin):
 
     def _get_count_per_track(self, user_name, from_date, to_date):
         plays_per_track = []
-        counts = db.session.\
+        count_query = db.session.\
             query(db.func.count(Play.track_id).label('cnt'), Play.track_id).\
             filter_by(user_name=user_name).\
             filter(Play.played_at_cet >= from_date).\
             filter(Play.played_at_cet <= to_date).\
             group_by(Play.track_id).\
-            order_by(db.desc('cnt')).\
-            limit(self.N).\
-            all()
-        for count, track_id in counts:
-            track = Track.query.get(track_id)
-            plays_per_track.append({'count': count, 'track': track.to_dict()})
+            order_by(db.desc('cnt'), Play.track_id)
+        counts = select_entity_counts('track', count_query, user_name, from_date, to_date, self.N)
+        tracks = load_dicts_by_ids(Track, [track_id for _, track_id in counts], *TRACK_DICT_OPTIONS)
+        for (count, _), track in zip(counts, tracks):
+            plays_per_track.append({'count': count, 'track': track})
         return {'data': plays_per_track}
 
     def _get_count_per_artist(self, user_name, from_date, to_date):
         plays_per_artist = []
-        counts = db.session.\
+        count_query = db.session.\
             query(db.func.count(Artist.artist_id).label('cnt'), Artist.artist_id).\
             select_from(Play).\
             filter_by(user_name=user_name).\
@@ -86,17 +273,16 @@ class Counts(Resource, ResourceMixin):
             join(Play.track).\
             join(Track.artists).\
             group_by(Artist.artist_id).\
-            order_by(db.desc('cnt')).\
-            limit(self.N).\
-            all()
-        for count, artist_id in counts:
-            artist = Artist.query.get(artist_id)
-            plays_per_artist.append({'count': count, 'artist': artist.to_dict()})
+            order_by(db.desc('cnt'), Artist.artist_id)
+        counts = select_entity_counts('artist', count_query, user_name, from_date, to_date, self.N)
+        artists = load_dicts_by_ids(Artist, [artist_id for _, artist_id in counts])
+        for (count, _), artist in zip(counts, artists):
+            plays_per_artist.append({'count': count, 'artist': artist})
         return {'data': plays_per_artist}
 
     def _get_count_per_album(self, user_name, from_date, to_date):
         plays_per_album = []
-        counts = db.session.\
+        count_query = db.session.\
             query(db.func.count(Album.album_id).label('cnt'), Album.album_id).\
             select_from(Play).\
             filter_by(user_name=user_name).\
@@ -105,189 +291,235 @@ class Counts(Resource, ResourceMixin):
             join(Play.track).\
             join(Track.album).\
             group_by(Album.album_id).\
-            order_by(db.desc('cnt')).\
-            limit(self.N).\
-            all()
-        for count, album_id in counts:
-            album = Album.query.get(album_id)
-            plays_per_album.append({'count': count, 'album': album.to_dict()})
+            order_by(db.desc('cnt'), Album.album_id)
+        counts = select_entity_counts('album', count_query, user_name, from_date, to_date, self.N)
+        albums = load_dicts_by_ids(Album, [album_id for _, album_id in counts], joinedload(Album.artists))
+        for (count, _), album in zip(counts, albums):
+            plays_per_album.append({'count': count, 'album': album})
         return {'data': plays_per_album}
 
-    def _get_count_per_day(self, user_name, from_date, to_date):
-        plays_per_day = dict()
-        counts = db.session.\
-            query(db.func.count(Play.day_of_week).label('cnt'), Play.day_of_week).\
-            filter_by(user_name=user_name).\
-            filter(Play.played_at_cet >= from_date).\
-            filter(Play.played_at_cet <= to_date).\
-            group_by(Play.day_of_week).\
-            order_by(db.asc(Play.day_of_week)).\
-            limit(self.N).\
-            all()
-        for count, day in counts:
-            plays_per_day[day] = count
-        return {'data': plays_per_day}
-
-    def _get_count_per_hour(self, user_name, from_date, to_date):
-        plays_per_hour = dict()
-        counts = db.session.\
-            query(db.func.count(Play.hour).label('cnt'), Play.hour).\
-            filter_by(user_name=user_name).\
-            filter(Play.played_at_cet >= from_date).\
-            filter(Play.played_at_cet <= to_date).\
-            group_by(Play.hour).\
-            order_by(db.asc(Play.hour)).\
-            limit(self.N).\
-            all()
-        for count, hour in counts:
-            plays_per_hour[hour] = count
-        return {'data': plays_per_hour}
-
-    def _get_count_per_month(self, user_name, from_date, to_date):
-        plays_per_month = dict()
-        counts = db.session.\
-            query(db.func.count(Play.month).label('cnt'), Play.month).\
-            filter_by(user_name=user_name).\
-            filter(Play.played_at_cet >= from_date).\
-            filter(Play.played_at_cet <= to_date).\
-            group_by(Play.month).\
-            order_by(db.asc(Play.month)).\
-            limit(self.N).\
-            all()
-        for count, month in counts:
-            plays_per_month[month] = count
-        return {'data': plays_per_month}
-
-    def _get_data_by_unit(self, unit, user_name, from_date, to_date):
+    def _get_count_per_bucket(self, bucket, user_name, from_date, to_date):
+        rows = select_buckets(bucket, user_name, from_date, to_date)
+        return {'data': {row.bucket: row.play_count for row in rows}}
 
-        UNIT_MAPPING = {
+    def _get_unit_mapping(self):
+        return {
             'artist': self._get_count_per_artist,
             'track': self._get_count_per_track,
             'album': self._get_count_per_album,
-            'hour': self._get_count_per_hour,
-            'day': self._get_count_per_day,
-            'month': self._get_count_per_month,
+            'hour': functools.partial(self._get_count_per_bucket, 'hour'),
+            'day': functools.partial(self._get_count_per_bucket, 'day'),
+            'week': functools.partial(self._get_count_per_bucket, 'week'),
+            'month': functools.partial(self._get_count_per_bucket, 'month'),
+            'year': functools.partial(self._get_count_per_bucket, 'year'),
         }
-        if unit in UNIT_MAPPING:
-            return UNIT_MAPPING[unit](user_name, from_date, to_date)
+
+    def _get_data_by_unit(self, unit, user_name, from_date, to_date):
+        unit_mapping = self._get_unit_mapping()
+        if unit in unit_mapping:
+            return unit_mapping[unit](user_name, from_date, to_date)
         return {}
 
     def get(self, unit, user_name, from_date=None, to_date=None):
+        return cached_response(('count', unit, user_name, from_date, to_date), user_name, to_date,
+                               lambda: self._get_response(unit, user_name, from_date, to_date))
+
+    def _get_response(self, unit, user_name, from_date, to_date):
         from_date, to_date = arg_date_to_datetime(from_date, to_date)
         data = self._get_data_by_unit(unit, user_name, from_date, to_date)
         data.update(self._apply_meta_data(unit, user_name, from_date, to_date, resource='count'))
-        response = jsonify(data)
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        return jsonify(data)
 
 
 class AudioFeature(Resource, ResourceMixin):
 
-    def _get_audio_feature_per_month(self, user_name, from_date, to_date):
-        sql = """SELECT
-    avg((t_track.audio_feature_data->>'tempo') :: FLOAT) AS avg_tempo,
-    avg((t_track.audio_feature_data->>'energy') :: FLOAT) AS avg_energy,
-    avg((t_track.audio_feature_data->>'valence') :: FLOAT) AS avg_valence,
-    avg((t_track.audio_feature_data->>'key') :: FLOAT) AS avg_key,
-    avg((t_track.audio_feature_data->>'loudness') :: FLOAT) AS avg_loudness,
-    t_play.month
-FROM
-    t_play
-JOIN t_track ON t_play.track_id = t_track.track_id
-WHERE t_play.user_name = '{}'
-AND t_play.played_at_cet >= '{}-{}-{}'
-AND t_play.played_at_cet <= '{}-{}-{}'
-GROUP BY t_play.month
-ORDER BY t_play.month ASC"""
-
-        rows = db.session.execute(sql.format(user_name,
-                                  from_date.year,
-                                  from_date.month,
-                                  from_date.day,
-                                  to_date.year,
-                                  to_date.month,
-                                  to_date.day))
-        return self._rows_to_data(rows)
-
-    def _get_audio_feature_per_day(self, user_name, from_date, to_date):
-        sql = """SELECT
-    avg((t_track.audio_feature_data->>'tempo') :: FLOAT) AS avg_tempo,
-    avg((t_track.audio_feature_data->>'energy') :: FLOAT) AS avg_energy,
-    avg((t_track.audio_feature_data->>'valence') :: FLOAT) AS avg_valence,
-    avg((t_track.audio_feature_data->>'key') :: FLOAT) AS avg_key,
-    avg((t_track.audio_feature_data->>'loudness') :: FLOAT) AS avg_loudness,
-    t_play.day_of_week
-FROM
-    t_play
-JOIN t_track ON t_play.track_id = t_track.track_id
-WHERE t_play.user_name = '{}'
-AND t_play.played_at_cet >= '{}-{}-{}'
-AND t_play.played_at_cet <= '{}-{}-{}'
-GROUP BY t_play.day_of_week
-ORDER BY t_play.day_of_week ASC"""
-
-        rows = db.session.execute(sql.format(user_name,
-                                  from_date.year,
-                                  from_date.month,
-                                  from_date.day,
-                                  to_date.year,
-                                  to_date.month,
-                                  to_date.day))
-        return self._rows_to_data(rows)
-
-    def _get_audio_feature_per_hour(self, user_name, from_date, to_date):
-        sql = """SELECT
-    avg((t_track.audio_feature_data->>'tempo') :: FLOAT) AS avg_tempo,
-    avg((t_track.audio_feature_data->>'energy') :: FLOAT) AS avg_energy,
-    avg((t_track.audio_feature_data->>'valence') :: FLOAT) AS avg_valence,
-    avg((t_track.audio_feature_data->>'key') :: FLOAT) AS avg_key,
-    avg((t_track.audio_feature_data->>'loudness') :: FLOAT) AS avg_loudness,
-    t_play.hour
-FROM
-    t_play
-JOIN t_track ON t_play.track_id = t_track.track_id
-WHERE t_play.user_name = '{}'
-AND t_play.played_at_cet >= '{}-{}-{}'
-AND t_play.played_at_cet <= '{}-{}-{}'
-GROUP BY t_play.hour
-ORDER BY t_play.hour ASC"""
-
-        rows = db.session.execute(sql.format(user_name,
-                                  from_date.year,
-                                  from_date.month,
-                                  from_date.day,
-                                  to_date.year,
-                                  to_date.month,
-                                  to_date.day))
+    def _get_audio_feature_per_bucket(self, bucket, user_name, from_date, to_date):
+        rows = select_buckets(bucket, user_name, from_date, to_date)
         return self._rows_to_data(rows)
 
     def _rows_to_data(self, rows):
         result = dict()
         for row in rows:
-            result[str(row[5])] = {
-                'avg_tempo': row[0],
-                'avg_energy': row[1],
-                'avg_valence': row[2],
-                'avg_key': row[3],
-                'avg_loudness': row[4]
+            result[str(row.bucket)] = {
+                'avg_tempo': row.avg_tempo,
+                'avg_energy': row.avg_energy,
+                'avg_valence': row.avg_valence,
+                'avg_key': row.avg_key,
+                'avg_loudness': row.avg_loudness
             }
         return {'data': result}
 
-    def _get_data_by_unit(self, unit, user_name, from_date, to_date):
-
-        UNIT_MAPPING = {
-            'hour': self._get_audio_feature_per_hour,
-            'day': self._get_audio_feature_per_day,
-            'month': self._get_audio_feature_per_month,
+    def _get_unit_mapping(self):
+        return {
+            'hour': functools.partial(self._get_audio_feature_per_bucket, 'hour'),
+            'day': functools.partial(self._get_audio_feature_per_bucket, 'day'),
+            'week': functools.partial(self._get_audio_feature_per_bucket, 'week'),
+            'month': functools.partial(self._get_audio_feature_per_bucket, 'month'),
+            'year': functools.partial(self._get_audio_feature_per_bucket, 'year'),
         }
-        if unit in UNIT_MAPPING:
-            return UNIT_MAPPING[unit](user_name, from_date, to_date)
+
+    def _get_data_by_unit(self, unit, user_name, from_date, to_date):
+        unit_mapping = self._get_unit_mapping()
+        if unit in unit_mapping:
+            return unit_mapping[unit](user_name, from_date, to_date)
         return {}
 
     def get(self, unit, user_name, from_date=None, to_date=None):
+        return cached_response(('audio_feature', unit, user_name, from_date, to_date), user_name, to_date,
+                               lambda: self._get_response(unit, user_name, from_date, to_date))
+
+    def _get_response(self, unit, user_name, from_date, to_date):
         from_date, to_date = arg_date_to_datetime(from_date, to_date)
         data = self._get_data_by_unit(unit, user_name, from_date, to_date)
         data.update(self._apply_meta_data(unit, user_name, from_date, to_date, resource='audio_feature'))
-        response = jsonify(data)
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        return jsonify(data)
+
+
+class Stats(Resource, ResourceMixin):
+
+    # Several units of Counts and AudioFeature for one user and date range in one round trip, e.g.
+    # /stats/user/<user_name>?units=count:track,count:hour,audio_feature:day
+    # Track, album and artist counts come from a single statement over one filtered scan of t_play,
+    # all time bucket units from a single statement over t_play_rollup.
+
+    RESOURCES = {
+        'count': Counts,
+        'audio_feature': AudioFeature,
+    }
+    ENTITIES = {
+        'track': Track,
+        'album': Album,
+        'artist': Artist,
+    }
+
+    def _parse_units(self, units):
+        # Only units the single resources support, as (resource, unit) tuples
+        result = []
+        for resource_unit in units.split(','):
+            resource, _, unit = resource_unit.partition(':')
+            if resource in self.RESOURCES and unit in self.RESOURCES[resource]()._get_unit_mapping():
+                result.append((resource, unit))
+        return result
+
+    def _get_entity_counts(self, units, user_name, from_date, to_date):
+        plays = db.session.\
+            query(Play.track_id.label('track_id'), Track.album_id.label('album_id')).\
+            join(Play.track).\
+            filter(Play.user_name == user_name).\
+            filter(Play.played_at_cet >= from_date).\
+            filter(Play.played_at_cet <= to_date).\
+            cte('plays')
+        count = db.func.count().label('cnt')
+        groupings = {
+            'track': (plays.c.track_id, plays),
+            'album': (plays.c.album_id, plays),
+            'artist': (track_artists.c.artist_id,
+                       plays.join(track_artists, track_artists.c.track_id == plays.c.track_id)),
+        }
+        selects = []
+        for unit in units:
+            column, from_clause = groupings[unit]
+            top_n = select([literal(unit).label('unit'), column.label('id'), count]).\
+                select_from(from_clause).\
+                group_by(column).\
+                order_by(db.desc('cnt'), column).\
+                limit(Counts.N).\
+                alias()
+            selects.append(select([top_n]))
+        rows = db.session.execute(union_all(*selects)).fetchall()
+
+        data = dict()
+        for unit in units:
+            counts = sorted([(row.cnt, row.id) for row in rows if row.unit == unit], key=lambda c: (-c[0], c[1]))
+            dicts = load_dicts_by_ids(self.ENTITIES[unit],
+                                      [i for _, i in counts],
+                                      *(TRACK_DICT_OPTIONS if unit == 'track' else ()))
+            data[unit] = {'data': [{'count': c, unit: d} for (c, _), d in zip(counts, dicts)]}
+        return data
+
+    def _get_bucket_rows(self, units, user_name, from_date, to_date):
+        selects = [rollup_select(unit, user_name, from_date, to_date) for unit in units]
+        rows = db.session.execute(union_all(*selects)).fetchall()
+        return sorted(rows, key=lambda row: (row.unit, row.bucket))
+
+    def _get_data(self, units, user_name, from_date, to_date):
+        data = {resource: dict() for resource in self.RESOURCES}
+        if get_analytics_engine() is not None:
+            # All plays are in memory already, there are no round trips to save
+            for resource, unit in units:
+                data[resource][unit] = self.RESOURCES[resource]()._get_data_by_unit(unit, user_name, from_date, to_date)
+            return data
+        entity_units = [u for r, u in units if r == 'count' and u in self.ENTITIES]
+        if entity_units:
+            data['count'].update(self._get_entity_counts(entity_units, user_name, from_date, to_date))
+        bucket_units = sorted({u for _, u in units if u in ROLLUP_BUCKETS})
+        if bucket_units:
+            rows = self._get_bucket_rows(bucket_units, user_name, from_date, to_date)
+            for resource, unit in units:
+                unit_rows = [row for row in rows if row.unit == unit]
+                if resource == 'count' and unit in ROLLUP_BUCKETS:
+                    data['count'][unit] = {'data': {row.bucket: row.play_count for row in unit_rows}}
+                elif resource == 'audio_feature':
+                    data['audio_feature'][unit] = AudioFeature()._rows_to_data(unit_rows)
+        return data
+
+    def get(self, user_name, from_date=None, to_date=None):
+        units = request.args.get('units', '')
+        return cached_response(('stats', units, user_name, from_date, to_date), user_name, to_date,
+                               lambda: self._get_response(units, user_name, from_date, to_date))
+
+    def _get_response(self, units, user_name, from_date, to_date):
+        from_date, to_date = arg_date_to_datetime(from_date, to_date)
+        data = {'data': self._get_data(self._parse_units(units), user_name, from_date, to_date)}
+        data.update(self._apply_meta_data(units, user_name, from_date, to_date, resource='stats'))
+        return jsonify(data)
+
+
+class Histogram(Resource, ResourceMixin):
+
+    # Plays per time bucket along the timeline, bucketed in the time zone given by ?tz= (default UTC),
+    # e.g. /histogram/per/day/user/<user_name>?tz=America/New_York. Buckets are computed by PostgreSQL
+    # from played_at_utc, the date range is a range scan on played_at_utc_timestamp.
+
+    BUCKETS = ('15min', 'hour', 'day', 'week', 'month', 'year')
+
+    def _get_bucket_start(self, bucket, tz_name):
+        local_time = db.func.timezone(db.bindparam('tz', tz_name),
+                                      db.func.timezone('UTC', Play.played_at_utc))
+        if bucket == '15min':
+            return db.func.date_trunc('hour', local_time) + \
+                db.func.floor(db.func.date_part('minute', local_time) / 15) * db.literal_column("INTERVAL '15 minutes'")
+        return db.func.date_trunc(bucket, local_time)
+
+    def _to_timestamp(self, local_datetime, timezone):
+        # Milliseconds since epoch like played_at_utc_timestamp
+        return int(local_datetime.replace(tzinfo=timezone).timestamp() * 1000)
+
+    def _get_data(self, bucket, user_name, from_date, to_date, tz_name):
+        timezone = tz.gettz(tz_name)
+        bucket_start = self._get_bucket_start(bucket, tz_name).label('bucket')
+        counts = db.session.\
+            query(bucket_start, db.func.count().label('cnt')).\
+            filter(Play.user_name == user_name).\
+            filter(Play.played_at_utc_timestamp >= self._to_timestamp(from_date, timezone)).\
+            filter(Play.played_at_utc_timestamp < self._to_timestamp(to_date, timezone)).\
+            group_by('bucket').\
+            order_by('bucket').\
+            all()
+        return {'data': {start.isoformat(): count for start, count in counts}}
+
+    def get(self, bucket, user_name, from_date=None, to_date=None):
+        tz_name = request.args.get('tz', 'UTC')
+        if bucket not in self.BUCKETS:
+            abort(400, message='Unknown bucket {}, use one of {}.'.format(bucket, ', '.join(self.BUCKETS)))
+        if tz.gettz(tz_name) is None:
+            abort(400, message='Unknown time zone {}.'.format(tz_name))
+        return cached_response(('histogram', (bucket, tz_name), user_name, from_date, to_date), user_name, to_date,
+                               lambda: self._get_response(bucket, user_name, from_date, to_date, tz_name))
+
+    def _get_response(self, bucket, user_name, from_date, to_date, tz_name):
+        from_date, to_date = arg_date_to_datetime(from_date, to_date)
+        data = self._get_data(bucket, user_name, from_date, to_date, tz_name)
+        data.update(self._apply_meta_data(bucket, user_name, from_date, to_date, resource='histogram'))
+        data['meta']['tz'] = tz_name
+        return jsonify(data)
@@ -2,11 +2,15 @@ import os
 from flask import Flask, render_template
 from flask_restful import Api
 
+import db_pool
 from models import db
-from api import Plays, Counts, AudioFeature
+from api import Plays, PlayHistory, Counts, AudioFeature, Stats, Histogram
 
 
 POSTGRES_ENVIRON_KEY = 'DATABASE_URL'
+ANALYTICS_BACKEND_ENVIRON_KEY = 'ANALYTICS_BACKEND'
+INSTRUMENTATION_ENVIRON_KEY = 'INSTRUMENTATION'
+SLOW_REQUEST_SECONDS_ENVIRON_KEY = 'SLOW_REQUEST_SECONDS'
 
 
 app = Flask(__name__)
@@ -21,28 +25,59 @@ try:
 except KeyError:
     import settings
     app.config['SQLALCHEMY_DATABASE_URI'] = settings.POSTGRES_CONNECTION_STRING
+# 'sql' (default): every stats request is answered by PostgreSQL
+# 'numpy': stats are computed from in-memory NumPy arrays of the plays of a user
+app.config['ANALYTICS_BACKEND'] = os.environ.get(ANALYTICS_BACKEND_ENVIRON_KEY, 'sql')
+# Statements, DB time and latency per endpoint on /metrics, requests slower than SLOW_REQUEST_SECONDS are logged
+app.config['INSTRUMENTATION'] = os.environ.get(INSTRUMENTATION_ENVIRON_KEY, '') == '1'
+app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get(SLOW_REQUEST_SECONDS_ENVIRON_KEY, 1.0))
 
 
 # ############################## #
 # 2) Create db connection in app #
 # ############################## #
 db.init_app(app)
+with app.app_context():
+    # One engine and pool per worker process, see db_pool for the settings
+    app.extensions['pool_stats'] = db_pool.configure_engine(db.engine)
+if app.config['ANALYTICS_BACKEND'] == 'numpy':
+    import analytics
+    analytics.init_app(app)
+if app.config['INSTRUMENTATION']:
+    import instrumentation
+    instrumentation.init_app(app)
 
 
 # ################################## #
 # 3) Configure API endpoints for app #
 # ################################## #
 api = Api(app)
-api.add_resource(Plays,
+api.add_resource(
+    Plays,
     '/plays/user/<string:user_name>')
-api.add_resource(Counts,
+api.add_resource(
+    PlayHistory,
+    '/plays/history/user/<string:user_name>')
+api.add_resource(
+    Counts,
     '/counts/per/<string:unit>/user/<string:user_name>',
     '/counts/per/<string:unit>/user/<string:user_name>/from/<string:from_date>',
     '/counts/per/<string:unit>/user/<string:user_name>/from/<string:from_date>/to/<string:to_date>')
-api.add_resource(AudioFeature,
+api.add_resource(
+    AudioFeature,
     '/audiofeatures/per/<string:unit>/user/<string:user_name>',
     '/audiofeatures/per/<string:unit>/user/<string:user_name>/from/<string:from_date>',
     '/audiofeatures/per/<string:unit>/user/<string:user_name>/from/<string:from_date>/to/<string:to_date>')
+api.add_resource(
+    Histogram,
+    '/histogram/per/<string:bucket>/user/<string:user_name>',
+    '/histogram/per/<string:bucket>/user/<string:user_name>/from/<string:from_date>',
+    '/histogram/per/<string:bucket>/user/<string:user_name>/from/<string:from_date>/to/<string:to_date>')
+api.add_resource(
+    Stats,
+    '/stats/user/<string:user_name>',
+    '/stats/user/<string:user_name>/from/<string:from_date>',
+    '/stats/user/<string:user_name>/from/<string:from_date>/to/<string:to_date>')
 
 
 @app.route('/')
@@ -0,0 +1,243 @@
+import argparse
+from collections import OrderedDict
+import contextlib
+from datetime import date, datetime, timedelta
+import sys
+import time
+
+from sqlalchemy import event, literal, literal_column, select
+from sqlalchemy.sql.expression import BindParameter
+from sqlalchemy.sql.visitors import replacement_traverse
+
+from app import app
+import api
+from models import db, ExtractionCursor, Play, Track
+from results import summarize, write_results
+
+
+COUNT_UNITS = ('artist', 'track', 'album', 'hour', 'day', 'week', 'month', 'year')
+AUDIO_FEATURE_UNITS = ('hour', 'day', 'week', 'month', 'year')
+HISTOGRAM_BUCKETS = ('15min', 'day', 'month')
+STATS_UNITS = 'count:track,count:artist,count:album,count:hour,count:day,audio_feature:hour,audio_feature:day'
+
+
+def get_routes(user_name, from_date, to_date):
+    # (route name, URL) of every read endpoint for one user and date range
+    dates = 'from/{}/to/{}'.format(from_date, to_date)
+    routes = [
+        ('plays', '/plays/user/{}'.format(user_name)),
+        ('plays_history', '/plays/history/user/{}'.format(user_name)),
+    ]
+    for unit in COUNT_UNITS:
+        routes.append(('counts:{}'.format(unit), '/counts/per/{}/user/{}/{}'.format(unit, user_name, dates)))
+    for unit in AUDIO_FEATURE_UNITS:
+        routes.append(('audiofeatures:{}'.format(unit),
+                       '/audiofeatures/per/{}/user/{}/{}'.format(unit, user_name, dates)))
+    for bucket in HISTOGRAM_BUCKETS:
+        routes.append(('histogram:{}'.format(bucket),
+                       '/histogram/per/{}/user/{}/{}?tz=Europe/Berlin'.format(bucket, user_name, dates)))
+    routes.append(('stats', '/stats/user/{}/{}?units={}'.format(user_name, dates, STATS_UNITS)))
+    return routes
+
+
+# Play column per time bucket of api.ROLLUP_BUCKETS
+PLAY_BUCKETS = {
+    'hour': Play.hour,
+    'day': Play.day_of_week,
+    'week': Play.week_of_year,
+    'month': Play.month,
+    'year': Play.year,
+}
+
+
+def plays_select(bucket, user_name, from_date, to_date):
+    # The rows of api.rollup_select aggregated from t_play, as the endpoints did before t_play_rollup
+    column = PLAY_BUCKETS[bucket]
+    return select([literal(bucket).label('unit'),
+                   column.label('bucket'),
+                   db.func.count().label('play_count'),
+                   db.func.avg(Track.tempo).label('avg_tempo'),
+                   db.func.avg(Track.energy).label('avg_energy'),
+                   db.func.avg(Track.valence).label('avg_valence'),
+                   db.func.avg(Track.key).label('avg_key'),
+                   db.func.avg(Track.loudness).label('avg_loudness')]).\
+        select_from(Play.__table__.outerjoin(Track.__table__, Track.track_id == Play.track_id)).\
+        where(Play.user_name == db.bindparam('user_name', user_name)).\
+        where(Play.played_at_cet >= db.bindparam('from_date', from_date)).\
+        where(Play.played_at_cet < db.bindparam('to_date', to_date)).\
+        group_by(column)
+
+
+def inline_literal(value):
+    # The value as an SQL literal in the statement text, like the str.format-ed queries before rollup_select
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    if isinstance(value, str):
+        return literal_column("'{}'".format(value.replace("'", "''")))
+    return literal_column(str(value))
+
+
+def literal_rollup_select(bucket, user_name, from_date, to_date):
+    # api.rollup_select with user and dates in the statement text, so every user and date range is a new
+    # statement for the database to parse and plan
+    statement = ROLLUP_SELECT(bucket, user_name, from_date, to_date)
+    return replacement_traverse(statement, {}, lambda element: inline_literal(element.value)
+                                if isinstance(element, BindParameter) else None)
+
+
+ROLLUP_SELECT = api.rollup_select
+
+
+@contextlib.contextmanager
+def replacing_rollup_select(function):
+    # Time bucket units are answered with the statements of function instead of api.rollup_select
+    api.rollup_select = function
+    try:
+        yield
+    finally:
+        api.rollup_select = ROLLUP_SELECT
+
+
+def is_bucket_route(name):
+    return name == 'stats' or name.startswith('audiofeatures:') or \
+        (name.startswith('counts:') and name.split(':')[1] in api.ROLLUP_BUCKETS)
+
+
+class QueryCounter(object):
+
+    # Counts statements and their time on an engine between reset() calls, and collects their distinct texts
+
+    def __init__(self, engine):
+        self.statements = 0
+        self.seconds = 0.0
+        self.texts = set()
+        self._started = None
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        self._started = time.time()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        self.seconds += time.time() - self._started
+        self.texts.add(statement)
+
+    def reset(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+def clear_caches(warm):
+    # Cold runs measure the database path, warm runs the response cache
+    if not warm:
+        api.response_cache.clear()
+        api.serialization_cache.clear()
+
+
+def bench_route(client, counter, url, runs, warm):
+    seconds = []
+    statements = []
+    db_seconds = []
+    bytes_ = 0
+    for _ in range(runs):
+        clear_caches(warm)
+        counter.reset()
+        started = time.time()
+        response = client.get(url)
+        body = response.get_data()  # Also runs streamed responses to the end
+        seconds.append(time.time() - started)
+        statements.append(counter.statements)
+        db_seconds.append(counter.seconds)
+        if response.status_code != 200:
+            raise RuntimeError('{} returned {}'.format(url, response.status_code))
+        bytes_ = len(body)
+    result = summarize(seconds)
+    result['queries_per_request'] = sum(statements) / float(len(statements))
+    result['db_mean_ms'] = sum(db_seconds) / len(db_seconds) * 1000
+    result['response_bytes'] = bytes_
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and queries per request of all read endpoints')
+    parser.add_argument('--users', dest='users', type=int, default=3,
+                        help='Number of users with extracted plays to request')
+    parser.add_argument('--runs', dest='runs', type=int, default=20, help='Requests per route and user')
+    parser.add_argument('--days', dest='days', type=int, default=365, help='Date range of the requests')
+    parser.add_argument('--warm', dest='warm', action='store_true',
+                        help='Keep the response and serialization caches between requests')
+    parser.add_argument('--compare-rollups', dest='compare_rollups', action='store_true',
+                        help='Only the time bucket routes, answered from t_play and from t_play_rollup')
+    parser.add_argument('--compare-binds', dest='compare_binds', action='store_true',
+                        help='Only the time bucket routes, with user and dates rendered into the statements and as '
+                             'bound parameters')
+    parser.add_argument('--output', dest='output', help='Path of the JSON results')
+    args = parser.parse_args()
+
+    to_date = date.today()
+    from_date = to_date - timedelta(days=args.days)
+    compare = args.compare_rollups or args.compare_binds
+    if args.compare_rollups:
+        variant, baseline, suffix = plays_select, ' (plays)', ' (rollups)'
+    else:
+        variant, baseline, suffix = literal_rollup_select, ' (literals)', ' (bound)'
+    warm = args.warm and not compare
+    results = OrderedDict()
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+        cursors = ExtractionCursor.query.order_by(ExtractionCursor.user_name).limit(args.users)
+        user_names = [c.user_name for c in cursors]
+        if not user_names:
+            sys.exit("No users with extracted plays, run benchmark/generate_data.py first.")
+        client = app.test_client()
+
+        timings = OrderedDict()
+        texts = OrderedDict()  # Distinct statement texts per route over all users
+        for user_name in user_names:
+            for name, url in get_routes(user_name, from_date, to_date):
+                if compare:
+                    if not is_bucket_route(name):
+                        continue
+                    with replacing_rollup_select(variant):
+                        client.get(url)
+                        counter.texts = set()
+                        timings.setdefault(name + baseline, []).append(
+                            bench_route(client, counter, url, args.runs, warm))
+                        texts.setdefault(name + baseline, set()).update(counter.texts)
+                    name += suffix
+                client.get(url)  # Warm up connections and code paths
+                counter.texts = set()
+                timings.setdefault(name, []).append(bench_route(client, counter, url, args.runs, warm))
+                texts.setdefault(name, set()).update(counter.texts)
+
+    # Per route, the median over users of each measure
+    for name, user_results in timings.items():
+        results[name] = OrderedDict((key, sorted(r[key] for r in user_results)[len(user_results) // 2])
+                                    for key in user_results[0])
+        results[name]['distinct_statements'] = len(texts[name])
+        print("{:<32} p50 {:8.1f}ms  p95 {:8.1f}ms  {:5.1f} queries  {:3d} distinct".format(
+            name, results[name]['p50_ms'], results[name]['p95_ms'], results[name]['queries_per_request'],
+            results[name]['distinct_statements']))
+
+    if compare:
+        # With bound parameters, a driver that prepares statements (and pg_stat_statements) sees one statement
+        # per route, with literals one per user and date range
+        for name in results:
+            if name.endswith(suffix):
+                route = name[:-len(suffix)]
+                print("{:<32} {:.1f}x faster{}, {} instead of {} distinct statements".format(
+                    route, results[route + baseline]['p50_ms'] / results[name]['p50_ms'], suffix,
+                    results[name]['distinct_statements'], results[route + baseline]['distinct_statements']))
+
+    write_results('api', {
+        'users': user_names,
+        'runs': args.runs,
+        'from_date': from_date,
+        'to_date': to_date,
+        'warm': warm,
+        'compare_rollups': args.compare_rollups,
+        'compare_binds': args.compare_binds,
+        'analytics_backend': app.config['ANALYTICS_BACKEND'],
+        'routes': results,
+    }, output=args.output)
@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+from collections import Counter, OrderedDict
+import contextlib
+import os
+import time
+
+from sqlalchemy import event
+
+from main import SpotifyConnection
+from models import ExtractionCursor, Play, PlayRollup, PostgreSQLConnection, get_engine, known_ids
+from rate_limit import RequestScheduler, scheduler_options
+from results import write_results
+from synthetic import FakeSpotify, SyntheticCatalog
+
+
+USER_PREFIX = 'bench_extract_'
+
+
+class StatementCounter(object):
+
+    def __init__(self, engine):
+        self.statements = 0
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+
+def cleanup():
+    # Plays of the benchmark users must not show up in bench_api.py, the catalog is kept
+    db = PostgreSQLConnection()
+    try:
+        for model in (Play, PlayRollup, ExtractionCursor):
+            db.session.query(model).\
+                filter(model.user_name.like(USER_PREFIX + '%')).\
+                delete(synchronize_session=False)
+        db.session.commit()
+    finally:
+        db.close()
+
+
+def extract(user_name, client, scheduler, bulk):
+    spotify = SpotifyConnection({'user_name': user_name}, client=client, scheduler=scheduler)
+    try:
+        if bulk:
+            return spotify.extract_plays_bulk()
+        return spotify.extract_plays()
+    finally:
+        spotify.db.close()
+
+
+def user_name(mode, n):
+    return '{}{}_{:03d}'.format(USER_PREFIX, mode, n)
+
+
+@contextlib.contextmanager
+def quiet(args):
+    # Hides the output of the extraction script unless --verbose
+    if args.verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def bench_mode(mode, catalog, args, counter):
+    # Every user is extracted args.runs times. The first run of a user sees a mostly unknown catalog,
+    # later runs mostly known tracks.
+    client = FakeSpotify(catalog, plays_per_run=args.plays_per_run, latency=args.latency,
+                         throttle_rate=args.throttle_rate, error_rate=args.error_rate, retry_after=args.retry_after,
+                         seed=args.seed)
+    scheduler = RequestScheduler(mode, **scheduler_options())
+    runs = []
+    for run in range(args.runs):
+        for n in range(args.users):
+            calls_before = Counter(client.calls)
+            statements_before = counter.statements
+            started = time.time()
+            with quiet(args):
+                inserted, skipped, failed, not_attempted = extract(user_name(mode, n), client, scheduler,
+                                                                   mode == 'bulk')
+            seconds = time.time() - started
+            calls = client.calls - calls_before
+            runs.append({
+                'run': run,
+                'seconds': seconds,
+                'inserted': inserted,
+                'skipped': skipped,
+                'failed': failed,
+                'not_attempted': not_attempted,
+                'api_calls': sum(calls.values()),
+                'statements': counter.statements - statements_before,
+            })
+    return summarize_runs(runs, client, scheduler)
+
+
+def bench_async_mode(mode, catalog, args, counter):
+    # All users are extracted at once per run, through a fake HTTP server on the same event loop.
+    # The seconds of a run are the wall time for all users.
+    import async_extract
+    from fake_spotify_server import FakeSpotifyServer, start
+    client = FakeSpotify(catalog, plays_per_run=args.plays_per_run, seed=args.seed)
+    server = FakeSpotifyServer(client, latency=args.latency, throttle_rate=args.throttle_rate,
+                               retry_after=args.retry_after, seed=args.seed)
+    scheduler = RequestScheduler(mode, **scheduler_options())
+    loop = asyncio.get_event_loop()
+    runner = loop.run_until_complete(start(server, port=args.port))
+    api_url = 'http://127.0.0.1:{}/v1/'.format(args.port)
+    runs = []
+    try:
+        for run in range(args.runs):
+            connections = [SpotifyConnection({'user_name': user_name(mode, n)}, client=client, scheduler=scheduler)
+                           for n in range(args.users)]
+            calls_before = Counter(client.calls)
+            statements_before = counter.statements
+            started = time.time()
+            with quiet(args):
+                results = async_extract.run(connections, concurrency=args.concurrency, workers=args.users,
+                                            api_url=api_url, loop=loop)
+            seconds = time.time() - started
+            calls = client.calls - calls_before
+            runs.append({
+                'run': run,
+                'seconds': seconds,
+                'inserted': sum(r['inserted'] for r in results.values()),
+                'skipped': sum(r['skipped'] for r in results.values()),
+                'failed': sum(r['failed'] for r in results.values()),
+                'not_attempted': sum(r['not_attempted'] for r in results.values()),
+                'api_calls': sum(calls.values()),
+                'throttled': sum(r['throttled'] for r in results.values()),
+                'statements': counter.statements - statements_before,
+                'errors': [r['error'] for r in results.values() if r['error']],
+            })
+    finally:
+        loop.run_until_complete(runner.cleanup())
+    return summarize_runs(runs, client, scheduler)
+
+
+def summarize_runs(runs, client, scheduler):
+    total_seconds = sum(r['seconds'] for r in runs)
+    total_plays = sum(r['inserted'] + r['skipped'] for r in runs)
+    first_runs = [r for r in runs if r['run'] == 0]
+    later_runs = [r for r in runs if r['run'] > 0]
+    return OrderedDict([
+        ('plays', total_plays),
+        ('seconds', total_seconds),
+        ('plays_per_second', total_plays / total_seconds if total_seconds else None),
+        ('first_run_mean_seconds', sum(r['seconds'] for r in first_runs) / len(first_runs)),
+        ('later_run_mean_seconds', sum(r['seconds'] for r in later_runs) / len(later_runs) if later_runs else None),
+        ('statements_per_play', sum(r['statements'] for r in runs) / float(total_plays or 1)),
+        ('api_calls', dict(client.calls)),
+        ('api_calls_per_play', sum(client.calls.values()) / float(total_plays or 1)),
+        ('scheduler', scheduler.stats.to_dict()),
+        ('runs', runs),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extractor throughput against a fake Spotify API')
+    parser.add_argument('--users', dest='users', type=int, default=3)
+    parser.add_argument('--runs', dest='runs', type=int, default=3, help='Extractions per user')
+    parser.add_argument('--plays-per-run', dest='plays_per_run', type=int, default=50)
+    parser.add_argument('--artists', dest='artists', type=int, default=500)
+    parser.add_argument('--albums', dest='albums', type=int, default=1000)
+    parser.add_argument('--tracks', dest='tracks', type=int, default=5000)
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0,
+                        help='Simulated seconds per Spotify request')
+    parser.add_argument('--modes', dest='modes', default='per-row,bulk',
+                        help='Comma separated extraction modes: per-row, bulk and/or async')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=10,
+                        help='Concurrent requests of the async mode')
+    parser.add_argument('--throttle-rate', dest='throttle_rate', type=float, default=0.0,
+                        help='Share of requests the fake Spotify API answers with 429')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0,
+                        help='Share of requests the fake Spotify API answers with 503 (not in the async mode)')
+    parser.add_argument('--retry-after', dest='retry_after', type=int, default=1,
+                        help='Retry-After seconds of the 429 responses')
+    parser.add_argument('--port', dest='port', type=int, default=8765, help='Port of the fake server')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        help='Keep the plays of the benchmark users')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='Show the extractor output')
+    parser.add_argument('--output', dest='output', help='Path of the JSON results')
+    args = parser.parse_args()
+
+    get_engine(pool_size=args.users, max_overflow=2)
+    PostgreSQLConnection().migrate_db()
+    cleanup()
+    counter = StatementCounter(get_engine())
+    results = OrderedDict()
+    try:
+        for n, mode in enumerate(args.modes.split(',')):
+            # Each mode gets its own catalog, so that no mode profits from tracks another mode saved
+            catalog = SyntheticCatalog(args.artists, args.albums, args.tracks, seed=args.seed + n)
+            results[mode] = (bench_async_mode if mode == 'async' else bench_mode)(mode, catalog, args, counter)
+            print("{:<8} {:8.1f} plays/s  {:5.2f} statements/play  {:5.2f} API calls/play  {} throttled  {} retried"
+                  .format(mode, results[mode]['plays_per_second'] or 0, results[mode]['statements_per_play'],
+                          results[mode]['api_calls_per_play'], results[mode]['scheduler']['throttled'],
+                          results[mode]['scheduler']['retried']))
+    finally:
+        if not args.keep:
+            cleanup()
+
+    write_results('extract', {
+        'users': args.users,
+        'runs': args.runs,
+        'plays_per_run': args.plays_per_run,
+        'catalog': {'artists': args.artists, 'albums': args.albums, 'tracks': args.tracks},
+        'latency': args.latency,
+        'known_id_cache': {'hits': known_ids.hits, 'misses': known_ids.misses},
+        'modes': results,
+    }, output=args.output)
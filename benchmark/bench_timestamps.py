@@ -0,0 +1,118 @@
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import random
+import sys
+import time
+
+from main import SpotifyConnection
+from play_times import PLAY_TIME_COLUMNS, decompose_played_at, get_timezone
+from results import write_results
+from synthetic import format_played_at
+
+
+class TimestampConnection(SpotifyConnection):
+
+    # Only converts timestamps, no database needed
+    def init_db(self):
+        return None
+
+
+def transitions(timezone, start, end):
+    # UTC instants at which the offset of timezone changes between start and end, to the hour
+    utc = get_timezone('UTC')
+    found = []
+    hour = start
+    offset = hour.replace(tzinfo=utc).astimezone(timezone).utcoffset()
+    while hour < end:
+        hour += timedelta(hours=1)
+        next_offset = hour.replace(tzinfo=utc).astimezone(timezone).utcoffset()
+        if next_offset != offset:
+            found.append(hour)
+            offset = next_offset
+    return found
+
+
+def generate_played_ats(count, years, edge_share, edge_seconds, seed):
+    # played_at strings spread over years, edge_share of them within edge_seconds of a DST change, and some
+    # hitting a full second (no milliseconds in the string)
+    rng = random.Random(seed)
+    end = datetime(2018, 1, 1)
+    start = end - timedelta(days=365 * years)
+    edges = transitions(get_timezone('CET'), start, end)
+    played_ats = []
+    for n in range(count):
+        if edges and rng.random() < edge_share:
+            played_at = rng.choice(edges) + timedelta(seconds=rng.uniform(-edge_seconds, edge_seconds))
+        else:
+            played_at = start + timedelta(seconds=rng.uniform(0, (end - start).total_seconds()))
+        if n % 10 == 0:
+            played_ats.append(played_at.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        else:
+            played_ats.append(format_played_at(played_at))
+    return played_ats
+
+
+def comparable(value):
+    # Datetimes are also compared by offset, fold and tzinfo, which == ignores for the same tzinfo
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None), value.utcoffset(), getattr(value, 'fold', 0), id(value.tzinfo)
+    return type(value), value
+
+
+def mismatches(per_row, batch):
+    found = []
+    for row, (a, b) in enumerate(zip(per_row, batch)):
+        for column in PLAY_TIME_COLUMNS:
+            if comparable(getattr(a, column)) != comparable(getattr(b, column)):
+                found.append((row, column, getattr(a, column), getattr(b, column)))
+    return found
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        result = function()
+        seconds = time.time() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per play and batch conversion of played_at to Play columns')
+    parser.add_argument('--plays', dest='plays', type=int, default=100000)
+    parser.add_argument('--years', dest='years', type=int, default=5)
+    parser.add_argument('--edge-share', dest='edge_share', type=float, default=0.25,
+                        help='Share of played_at near a DST change, around 0.01 in real histories')
+    parser.add_argument('--edge-seconds', dest='edge_seconds', type=int, default=4 * 3600,
+                        help='Maximum distance of these played_at to the DST change')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='Timed runs, the fastest counts')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--output', dest='output', help='Path of the JSON results')
+    args = parser.parse_args()
+
+    played_ats = generate_played_ats(args.plays, args.years, args.edge_share, args.edge_seconds, args.seed)
+    spotify = TimestampConnection({'user_name': 'bench_timestamps'}, client=object())
+    per_row_seconds, per_row = timed(lambda: [spotify.get_play_from_played_at_utc(p) for p in played_ats],
+                                     args.repeat)
+    batch_seconds, batch = timed(lambda: spotify.get_plays_from_played_at_utc(played_ats), args.repeat)
+    columns_seconds, _ = timed(lambda: decompose_played_at(played_ats), args.repeat)
+
+    found = mismatches(per_row, batch)
+    results = OrderedDict([
+        ('plays', args.plays),
+        ('edge_share', args.edge_share),
+        ('per_row_plays_per_second', args.plays / per_row_seconds),
+        ('batch_plays_per_second', args.plays / batch_seconds),
+        ('columns_plays_per_second', args.plays / columns_seconds),
+        ('speedup', per_row_seconds / batch_seconds),
+        ('mismatches', len(found)),
+    ])
+    print("per row  {:10.0f} plays/s".format(results['per_row_plays_per_second']))
+    print("batch    {:10.0f} plays/s  ({:.1f}x, {:.0f} plays/s without building Play objects)".format(
+        results['batch_plays_per_second'], results['speedup'], results['columns_plays_per_second']))
+    for row, column, expected, actual in found[:10]:
+        print("Mismatch of {} for {}: {!r} per row, {!r} in batch".format(column, played_ats[row], expected, actual))
+    write_results('timestamps', results, output=args.output)
+    sys.exit(1 if found else 0)
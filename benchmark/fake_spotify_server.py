@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import itertools
+import random
+
+from aiohttp import web
+
+from synthetic import FakeSpotify, SyntheticCatalog
+
+
+class FakeSpotifyServer(object):
+
+    # Serves a FakeSpotify over HTTP with the paths and JSON of the Spotify Web API, for the asyncio
+    # extraction (SPOTIFY_API_URL=http://<host>:<port>/v1/). latency (seconds) is added to every response,
+    # throttle_rate is the share of requests answered with 429 and a Retry-After of retry_after seconds.
+
+    def __init__(self, fake, latency=0.0, throttle_rate=0.0, retry_after=1, seed=0):
+        self.fake = fake
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.throttled = 0
+        self.pages = dict()  # Recently played items by page ID, for the next URLs
+        self.page_ids = itertools.count()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v1/me/player/recently-played', self.recently_played)
+        app.router.add_get('/v1/tracks', self.catalog(self.fake.tracks))
+        app.router.add_get('/v1/albums', self.catalog(self.fake.albums))
+        app.router.add_get('/v1/artists', self.catalog(self.fake.artists))
+        app.router.add_get('/v1/audio-features',
+                           self.catalog(lambda ids: {'audio_features': self.fake.audio_features(ids)}))
+        return app
+
+    async def _throttle(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.throttle_rate and self.rng.random() < self.throttle_rate:
+            self.throttled += 1
+            return web.Response(status=429, headers={'Retry-After': str(self.retry_after)})
+        return None
+
+    async def recently_played(self, request):
+        throttled = await self._throttle()
+        if throttled:
+            return throttled
+        self.fake._request('recently_played')
+        if 'page' in request.query:
+            page_id = request.query['page']
+            offset = int(request.query['offset'])
+        else:
+            page_id = str(next(self.page_ids))
+            after = request.query.get('after')
+            self.pages[page_id] = self.fake._recently_played(int(after) if after else None)
+            offset = 0
+        items = self.pages[page_id]
+        next_offset = offset + self.fake.PAGE_SIZE
+        next_url = str(request.url.with_query({'page': page_id, 'offset': next_offset})) \
+            if next_offset < len(items) else None
+        return web.json_response({'items': items[offset:next_offset], 'limit': self.fake.PAGE_SIZE, 'next': next_url})
+
+    def catalog(self, fetch):
+        async def handler(request):
+            throttled = await self._throttle()
+            if throttled:
+                return throttled
+            return web.json_response(fetch(request.query['ids'].split(',')))
+        return handler
+
+
+async def start(server, host='127.0.0.1', port=8765):
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Spotify Web API with synthetic data')
+    parser.add_argument('--port', dest='port', type=int, default=8765)
+    parser.add_argument('--artists', dest='artists', type=int, default=500)
+    parser.add_argument('--albums', dest='albums', type=int, default=1000)
+    parser.add_argument('--tracks', dest='tracks', type=int, default=5000)
+    parser.add_argument('--plays-per-run', dest='plays_per_run', type=int, default=50)
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', dest='throttle_rate', type=float, default=0.0)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+
+    catalog = SyntheticCatalog(args.artists, args.albums, args.tracks, seed=args.seed)
+    fake = FakeSpotify(catalog, plays_per_run=args.plays_per_run, seed=args.seed)
+    server = FakeSpotifyServer(fake, latency=args.latency, throttle_rate=args.throttle_rate, seed=args.seed)
+    web.run_app(server.app(), port=args.port)
@@ -0,0 +1,117 @@
+import argparse
+from datetime import datetime, timedelta
+import random
+import time
+
+from app import app
+from models import db, album_artists, track_artists, Album, Artist, ExtractionCursor, Play, PlayRollup, Track
+from synthetic import AUDIO_FEATURES, SyntheticCatalog, play_row, play_times
+
+
+CHUNK_SIZE = 5000
+
+
+def insert(table, rows):
+    for i in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[i:i + CHUNK_SIZE])
+
+
+def insert_catalog(catalog):
+    insert(Artist.__table__, [{'artist_id': a['id'], 'artist_data': a} for a in catalog.artists])
+    insert(Album.__table__, [{'album_id': a['id'], 'album_data': a} for a in catalog.albums])
+    insert(album_artists, [{'album_id': a['id'], 'artist_id': artist['id']}
+                           for a in catalog.albums for artist in a['artists']])
+    track_rows = []
+    for track in catalog.tracks:
+        audio_feature = catalog.audio_features.get(track['id'])
+        row = {'track_id': track['id'], 'track_data': track, 'album_id': track['album']['id'],
+               'audio_feature_data': audio_feature}
+        for feature in AUDIO_FEATURES:
+            row[feature] = audio_feature[feature] if audio_feature else None
+        track_rows.append(row)
+    insert(Track.__table__, track_rows)
+    insert(track_artists, [{'track_id': t['id'], 'artist_id': a['id']} for t in catalog.tracks for a in t['artists']])
+    db.session.commit()
+
+
+def add_to_rollups(rollups, play, audio_feature):
+    key = (play['user_name'], play['year'], play['month'], play['day'], play['hour'])
+    rollup = rollups.get(key)
+    if rollup is None:
+        rollup = rollups[key] = {
+            'user_name': play['user_name'], 'year': play['year'], 'month': play['month'], 'day': play['day'],
+            'hour': play['hour'], 'date_cet': play['played_at_cet'].date(), 'day_of_week': play['day_of_week'],
+            'play_count': 0, 'audio_feature_count': 0,
+        }
+        for feature in AUDIO_FEATURES:
+            rollup['sum_' + feature] = 0.0
+    rollup['play_count'] += 1
+    if audio_feature:
+        rollup['audio_feature_count'] += 1
+        for feature in AUDIO_FEATURES:
+            rollup['sum_' + feature] += audio_feature[feature]
+
+
+def insert_plays(catalog, user_name, from_date, to_date, plays_per_day, rng, timestamps):
+    # Plays, rollups and the extraction cursor of one user, like the extractor would have written them
+    rollups = dict()
+    plays = []
+    count = 0
+    latest_timestamp = None
+    for played_at_utc in play_times(rng, from_date, to_date, plays_per_day):
+        play = play_row(user_name, played_at_utc, catalog.random_track_id(rng))
+        if play['played_at_utc_timestamp'] in timestamps:  # t_play is keyed by the timestamp only
+            continue
+        timestamps.add(play['played_at_utc_timestamp'])
+        latest_timestamp = play['played_at_utc_timestamp']
+        add_to_rollups(rollups, play, catalog.audio_features.get(play['track_id']))
+        plays.append(play)
+        if len(plays) == CHUNK_SIZE:
+            insert(Play.__table__, plays)
+            count += len(plays)
+            plays = []
+    insert(Play.__table__, plays)
+    count += len(plays)
+    insert(PlayRollup.__table__, list(rollups.values()))
+    if latest_timestamp is not None:
+        insert(ExtractionCursor.__table__, [{'user_name': user_name, 'played_at_utc_timestamp': latest_timestamp}])
+    db.session.commit()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill the database with synthetic users, catalog and plays')
+    parser.add_argument('--users', dest='users', type=int, default=5)
+    parser.add_argument('--artists', dest='artists', type=int, default=2000)
+    parser.add_argument('--albums', dest='albums', type=int, default=4000)
+    parser.add_argument('--tracks', dest='tracks', type=int, default=20000)
+    parser.add_argument('--years', dest='years', type=float, default=3)
+    parser.add_argument('--plays-per-day', dest='plays_per_day', type=float, default=40)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--drop', dest='drop', action='store_true',
+                        help='Drop and recreate all tables first')
+    args = parser.parse_args()
+
+    started = time.time()
+    rng = random.Random(args.seed)
+    to_date = datetime.utcnow().date()
+    from_date = to_date - timedelta(days=int(args.years * 365))
+
+    with app.app_context():
+        if args.drop:
+            print("* Recreating tables.")
+            db.drop_all()
+        db.create_all()
+
+        print("* Generating {} artists, {} albums and {} tracks.".format(args.artists, args.albums, args.tracks))
+        catalog = SyntheticCatalog(args.artists, args.albums, args.tracks, seed=args.seed)
+        insert_catalog(catalog)
+
+        # Timestamps are the primary key of t_play and have to be unique across users
+        timestamps = set()
+        for n in range(args.users):
+            user_name = 'user_{:03d}'.format(n)
+            count = insert_plays(catalog, user_name, from_date, to_date, args.plays_per_day, rng, timestamps)
+            print("* {}: {} plays from {} to {}.".format(user_name, count, from_date, to_date))
+
+    print("Finished in {:.1f}s.".format(time.time() - started))
@@ -0,0 +1,45 @@
+from datetime import datetime
+import json
+import os
+import platform
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def percentile(values, p):
+    # Nearest rank percentile, p in [0, 100]
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(seconds):
+    return {
+        'runs': len(seconds),
+        'p50_ms': percentile(seconds, 50) * 1000,
+        'p95_ms': percentile(seconds, 95) * 1000,
+        'mean_ms': sum(seconds) / len(seconds) * 1000,
+        'max_ms': max(seconds) * 1000,
+    }
+
+
+def write_results(name, results, output=None):
+    # Writes results with some context about the run to output, default benchmark/results/<name>-<time>.json
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '{}-{}.json'.format(name, datetime.now().strftime('%Y%m%d-%H%M%S')))
+    document = {
+        'benchmark': name,
+        'finished_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True, default=str)
+    print("Results written to {}.".format(output))
+    return output
@@ -0,0 +1,328 @@
+from bisect import bisect
+from collections import Counter
+from datetime import datetime, timedelta
+from dateutil import tz
+import itertools
+import random
+import string
+import time
+
+
+UTC = tz.gettz('UTC')
+CET = tz.gettz('CET')
+
+
+AUDIO_FEATURES = ('tempo', 'energy', 'valence', 'key', 'loudness')
+
+
+# Relative number of plays per CET hour (0-23) and weekday (Monday: 0), shaped like a listener
+# with a commute, an evening peak and quiet nights
+HOUR_WEIGHTS = (3, 2, 1, 1, 1, 1, 2, 6, 10, 9, 7, 7, 8, 7, 7, 7, 8, 10, 12, 13, 13, 12, 9, 5)
+DAY_OF_WEEK_WEIGHTS = (10, 10, 10, 11, 13, 14, 12)
+
+
+ID_ALPHABET = string.ascii_letters + string.digits
+
+
+class WeightedChoice(object):
+
+    # random.choices with cumulative weights, which is not available before Python 3.6
+
+    def __init__(self, values, weights):
+        self.values = list(values)
+        self.cumulative_weights = list(itertools.accumulate(weights))
+
+    def choice(self, rng):
+        return self.values[bisect(self.cumulative_weights, rng.random() * self.cumulative_weights[-1])]
+
+
+def zipf_weights(n, exponent=1.1):
+    # A few entities get most of the plays, like real listening habits
+    return [1.0 / (rank ** exponent) for rank in range(1, n + 1)]
+
+
+def spotify_id(rng):
+    return ''.join(rng.choice(ID_ALPHABET) for _ in range(22))
+
+
+def _images(rng, kind, entity_id):
+    return [{'width': size, 'height': size, 'url': 'https://i.scdn.co/image/{}-{}-{}'.format(kind, entity_id, size)}
+            for size in (640, 300, 64)]
+
+
+def _name(rng, words=2):
+    return ' '.join(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))).title()
+                    for _ in range(rng.randint(1, words)))
+
+
+def _simple(entity, kind):
+    return {
+        'external_urls': entity['external_urls'],
+        'href': entity['href'],
+        'id': entity['id'],
+        'name': entity['name'],
+        'type': kind,
+        'uri': entity['uri'],
+    }
+
+
+def artist_payload(rng, artist_id):
+    return {
+        'external_urls': {'spotify': 'https://open.spotify.com/artist/{}'.format(artist_id)},
+        'followers': {'href': None, 'total': rng.randint(10, 5000000)},
+        'genres': [_name(rng, 1).lower() for _ in range(rng.randint(0, 3))],
+        'href': 'https://api.spotify.com/v1/artists/{}'.format(artist_id),
+        'id': artist_id,
+        'images': _images(rng, 'artist', artist_id),
+        'name': _name(rng),
+        'popularity': rng.randint(0, 100),
+        'type': 'artist',
+        'uri': 'spotify:artist:{}'.format(artist_id),
+    }
+
+
+def album_payload(rng, album_id, artists):
+    return {
+        'album_type': rng.choice(['album', 'album', 'single', 'compilation']),
+        'artists': [_simple(a, 'artist') for a in artists],
+        'available_markets': ['DE', 'AT', 'CH'],
+        'copyrights': [{'text': '(C) {} {}'.format(rng.randint(1960, 2018), artists[0]['name']), 'type': 'C'}],
+        'external_ids': {'upc': ''.join(rng.choice(string.digits) for _ in range(12))},
+        'external_urls': {'spotify': 'https://open.spotify.com/album/{}'.format(album_id)},
+        'genres': [],
+        'href': 'https://api.spotify.com/v1/albums/{}'.format(album_id),
+        'id': album_id,
+        'images': _images(rng, 'album', album_id),
+        'label': _name(rng),
+        'name': _name(rng, 4),
+        'popularity': rng.randint(0, 100),
+        'release_date': '{}-{:02d}-{:02d}'.format(rng.randint(1960, 2018), rng.randint(1, 12), rng.randint(1, 28)),
+        'release_date_precision': 'day',
+        'tracks': {'href': 'https://api.spotify.com/v1/albums/{}/tracks'.format(album_id), 'items': [],
+                   'limit': 50, 'next': None, 'offset': 0, 'previous': None, 'total': 0},
+        'type': 'album',
+        'uri': 'spotify:album:{}'.format(album_id),
+    }
+
+
+def track_payload(rng, track_id, album, artists, track_number):
+    return {
+        'album': dict(_simple(album, 'album'), artists=album['artists'], images=album['images'],
+                      album_type=album['album_type'], available_markets=album['available_markets']),
+        'artists': [_simple(a, 'artist') for a in artists],
+        'available_markets': album['available_markets'],
+        'disc_number': 1,
+        'duration_ms': rng.randint(90000, 420000),
+        'explicit': rng.random() < 0.1,
+        'external_ids': {'isrc': 'DE{}'.format(''.join(rng.choice(string.digits) for _ in range(10)))},
+        'external_urls': {'spotify': 'https://open.spotify.com/track/{}'.format(track_id)},
+        'href': 'https://api.spotify.com/v1/tracks/{}'.format(track_id),
+        'id': track_id,
+        'name': _name(rng, 4),
+        'popularity': rng.randint(0, 100),
+        'preview_url': 'https://p.scdn.co/mp3-preview/{}'.format(track_id),
+        'track_number': track_number,
+        'type': 'track',
+        'uri': 'spotify:track:{}'.format(track_id),
+    }
+
+
+def audio_feature_payload(rng, track_id, duration_ms):
+    return {
+        'acousticness': rng.random(),
+        'analysis_url': 'https://api.spotify.com/v1/audio-analysis/{}'.format(track_id),
+        'danceability': rng.random(),
+        'duration_ms': duration_ms,
+        'energy': rng.betavariate(2, 2),
+        'id': track_id,
+        'instrumentalness': rng.random() ** 4,
+        'key': rng.randint(0, 11),
+        'liveness': rng.random() ** 2,
+        'loudness': -rng.gammavariate(3, 2.5),
+        'mode': rng.randint(0, 1),
+        'speechiness': rng.random() ** 3,
+        'tempo': rng.gauss(120, 25),
+        'time_signature': 4,
+        'track_href': 'https://api.spotify.com/v1/tracks/{}'.format(track_id),
+        'type': 'audio_features',
+        'uri': 'spotify:track:{}'.format(track_id),
+        'valence': rng.betavariate(2, 2),
+    }
+
+
+class SyntheticCatalog(object):
+
+    # Spotify shaped payloads of artists, albums and tracks. Tracks belong to albums of their first artist,
+    # some tracks feature a second artist and some tracks have no audio features.
+
+    def __init__(self, artist_count, album_count, track_count, seed=0, audio_feature_ratio=0.95):
+        rng = random.Random(seed)
+        self.artists = [artist_payload(rng, spotify_id(rng)) for _ in range(artist_count)]
+        self.artists_by_id = {a['id']: a for a in self.artists}
+        self.albums = [album_payload(rng, spotify_id(rng), [rng.choice(self.artists)]) for _ in range(album_count)]
+        self.albums_by_id = {a['id']: a for a in self.albums}
+        self.tracks = []
+        self.audio_features = dict()
+        for n in range(track_count):
+            album = self.albums[n % album_count]
+            artists = [self.artists_by_id[album['artists'][0]['id']]]
+            featured = rng.choice(self.artists)
+            if rng.random() < 0.15 and featured is not artists[0]:
+                artists.append(featured)
+            track = track_payload(rng, spotify_id(rng), album, artists, n // album_count + 1)
+            self.tracks.append(track)
+            if rng.random() < audio_feature_ratio:
+                self.audio_features[track['id']] = audio_feature_payload(rng, track['id'], track['duration_ms'])
+        self.tracks_by_id = {t['id']: t for t in self.tracks}
+
+        # Track popularity, shuffled so that popular tracks are spread over albums
+        track_ids = [t['id'] for t in self.tracks]
+        rng.shuffle(track_ids)
+        self.popularity = WeightedChoice(track_ids, zipf_weights(len(track_ids)))
+
+    def random_track_id(self, rng):
+        return self.popularity.choice(rng)
+
+
+def play_times(rng, from_date, to_date, plays_per_day):
+    # UTC datetimes of plays between two dates, with CET hours and weekdays following the weights above
+    hours = WeightedChoice(range(24), HOUR_WEIGHTS)
+    mean_day_weight = sum(DAY_OF_WEEK_WEIGHTS) / float(len(DAY_OF_WEEK_WEIGHTS))
+    day = from_date
+    while day < to_date:
+        expected = plays_per_day * DAY_OF_WEEK_WEIGHTS[day.weekday()] / mean_day_weight
+        count = max(0, int(rng.gauss(expected, expected / 3.0)))
+        times = []
+        for _ in range(count):
+            played_at_cet = datetime(day.year, day.month, day.day, hours.choice(rng),
+                                     rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999) * 1000)
+            times.append(played_at_cet.replace(tzinfo=CET).astimezone(UTC))
+        for played_at_utc in sorted(times):
+            yield played_at_utc
+        day += timedelta(days=1)
+
+
+def play_row(user_name, played_at_utc, track_id):
+    # Same columns the extractor derives from a played_at of the recently played endpoint
+    played_at_cet = played_at_utc.astimezone(CET)
+    return {
+        'played_at_utc_timestamp': int(played_at_utc.timestamp() * 1000),
+        'played_at_utc': played_at_utc.replace(tzinfo=None),
+        'played_at_cet': played_at_cet.replace(tzinfo=None),
+        'day': played_at_cet.day,
+        'month': played_at_cet.month,
+        'year': played_at_cet.year,
+        'hour': played_at_cet.hour,
+        'minute': played_at_cet.minute,
+        'second': played_at_cet.second,
+        'day_of_week': played_at_cet.weekday(),
+        'week_of_year': played_at_cet.date().isocalendar()[1],
+        'track_id': track_id,
+        'user_name': user_name,
+    }
+
+
+def format_played_at(played_at_utc):
+    # Format of played_at in responses of the recently played endpoint, with milliseconds
+    return played_at_utc.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(played_at_utc.microsecond // 1000)
+
+
+class FakeSpotify(object):
+
+    # Stands in for spotipy.Spotify with the endpoints the extractor uses. Every user gets plays_per_run
+    # new plays per extraction, one page per 50 plays, ending now. latency (seconds) is slept per request
+    # to simulate the network. throttle_rate and error_rate are the shares of requests failing like spotipy
+    # does for a 429 (with a Retry-After of retry_after seconds) and a 503.
+
+    PAGE_SIZE = 50
+
+    def __init__(self, catalog, plays_per_run=50, latency=0.0, throttle_rate=0.0, error_rate=0.0, retry_after=1,
+                 seed=0):
+        self.catalog = catalog
+        self.plays_per_run = plays_per_run
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.fault_rng = random.Random(seed)  # Separate, so that faults do not change the plays
+        self.calls = Counter()
+        self.ids = Counter()  # Requested catalog IDs per endpoint
+        self.faults = Counter()
+
+    def _request(self, endpoint, ids=()):
+        self.calls[endpoint] += 1
+        self.ids[endpoint] += len(ids)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate or self.error_rate:
+            self._inject_fault(endpoint)
+
+    def _inject_fault(self, endpoint):
+        # Imported here, the asyncio fake server serves a FakeSpotify without spotipy
+        from spotipy.client import SpotifyException
+        draw = self.fault_rng.random()
+        if draw < self.throttle_rate:
+            self.faults[429] += 1
+            raise SpotifyException(429, -1, '{}: API rate limit exceeded'.format(endpoint),
+                                   headers={'Retry-After': str(self.retry_after)})
+        if draw < self.throttle_rate + self.error_rate:
+            self.faults[503] += 1
+            raise SpotifyException(503, -1, '{}: Service unavailable'.format(endpoint))
+
+    def _recently_played(self, after):
+        now = datetime.utcnow().replace(tzinfo=UTC)
+        start = datetime.fromtimestamp(after / 1000.0, UTC) if after else now - timedelta(days=1)
+        step = (now - start) / (self.plays_per_run + 1)
+        return [{'played_at': format_played_at(start + step * (n + 1) -
+                                               timedelta(milliseconds=self.rng.randint(0, 999))),
+                 'track': self.catalog.tracks_by_id[self.catalog.random_track_id(self.rng)],
+                 'context': None}
+                for n in range(self.plays_per_run)]
+
+    def _page(self, items, offset):
+        page = {'items': items[offset:offset + self.PAGE_SIZE], 'limit': self.PAGE_SIZE}
+        has_next = offset + self.PAGE_SIZE < len(items)
+        # Spotify returns the URL of the next page, only next() reads it here
+        page['next'] = (items, offset + self.PAGE_SIZE) if has_next else None
+        return page
+
+    def _get(self, url, args=None, payload=None, **kwargs):
+        self._request('recently_played')
+        return self._page(self._recently_played(kwargs.get('after')), 0)
+
+    def next(self, result):
+        if not result['next']:
+            return None
+        self._request('recently_played')
+        items, offset = result['next']
+        return self._page(items, offset)
+
+    def tracks(self, track_ids):
+        self._request('tracks', track_ids)
+        return {'tracks': [self.catalog.tracks_by_id.get(i) for i in track_ids]}
+
+    def albums(self, album_ids):
+        self._request('albums', album_ids)
+        return {'albums': [self.catalog.albums_by_id.get(i) for i in album_ids]}
+
+    def artists(self, artist_ids):
+        self._request('artists', artist_ids)
+        return {'artists': [self.catalog.artists_by_id.get(i) for i in artist_ids]}
+
+    def audio_features(self, tracks):
+        track_ids = [tracks] if isinstance(tracks, str) else tracks
+        self._request('audio_features', track_ids)
+        return [self.catalog.audio_features.get(i) for i in track_ids]
+
+    def track(self, track_id):
+        self._request('track', [track_id])
+        return self.catalog.tracks_by_id[track_id]
+
+    def album(self, album_id):
+        self._request('album', [album_id])
+        return self.catalog.albums_by_id[album_id]
+
+    def artist(self, artist_id):
+        self._request('artist', [artist_id])
+        return self.catalog.artists_by_id[artist_id]
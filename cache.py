@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import threading
+import time
+
+
+class CacheEntry(object):
+
+    def __init__(self, body, version, expires_at):
+        self.body = body
+        self.version = version
+        self.expires_at = expires_at  # None: never expires
+        self.etag = hashlib.md5(body).hexdigest()
+        self.last_modified = version if isinstance(version, datetime) else datetime.utcnow()
+
+    def is_valid(self, version):
+        if self.version != version:
+            return False
+        return self.expires_at is None or time.time() < self.expires_at
+
+
+class ResponseCache(object):
+
+    # LRU cache of serialized responses. An entry is only valid for the data version it was built
+    # from, e.g. the time of the latest extraction of a user.
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if not entry.is_valid(version):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, version, expires=True):
+        entry = CacheEntry(body, version, time.time() + self.ttl if expires else None)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SerializationCache(object):
+
+    # LRU cache of the public dicts of catalog entities by (table name, primary key). The cached dicts
+    # are shared, so callers must not modify them.
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.dicts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.dicts.get(key)
+            if value is not None:
+                self.dicts.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.dicts[key] = value
+            self.dicts.move_to_end(key)
+            while len(self.dicts) > self.max_size:
+                self.dicts.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.dicts.clear()
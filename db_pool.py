@@ -0,0 +1,112 @@
+import os
+import threading
+
+from sqlalchemy import event, exc, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+
+# Connection pool settings of the API and the extraction script, read from the environment:
+# DB_POOL_SIZE       connections kept open per process
+# DB_MAX_OVERFLOW    additional connections opened under load and closed when returned
+# DB_POOL_TIMEOUT    seconds to wait for a connection before failing
+# DB_POOL_RECYCLE    seconds after which a connection is replaced, below the server's idle timeout
+# DB_PRE_PING        1: test connections on checkout and replace dropped ones
+# DB_PGBOUNCER       1: no pooling in the process, PgBouncer pools the server connections
+POOL_SIZE_ENVIRON_KEY = 'DB_POOL_SIZE'
+MAX_OVERFLOW_ENVIRON_KEY = 'DB_MAX_OVERFLOW'
+POOL_TIMEOUT_ENVIRON_KEY = 'DB_POOL_TIMEOUT'
+POOL_RECYCLE_ENVIRON_KEY = 'DB_POOL_RECYCLE'
+PRE_PING_ENVIRON_KEY = 'DB_PRE_PING'
+PGBOUNCER_ENVIRON_KEY = 'DB_PGBOUNCER'
+
+
+def engine_options(url, pool_size=2, max_overflow=3, pool_timeout=10, pool_recycle=300):
+    # create_engine arguments for url, the defaults are overridden by the environment. A gunicorn worker serves
+    # one request at a time, so the API defaults keep workers * (pool_size + max_overflow) small.
+    if not make_url(url).drivername.startswith('postgres'):
+        return dict()
+    if os.environ.get(PGBOUNCER_ENVIRON_KEY) == '1':
+        # Connections are only borrowed from PgBouncer per checkout, so they never sit idle in a worker
+        return {'poolclass': NullPool}
+    return {
+        'pool_size': int(os.environ.get(POOL_SIZE_ENVIRON_KEY, pool_size)),
+        'max_overflow': int(os.environ.get(MAX_OVERFLOW_ENVIRON_KEY, max_overflow)),
+        'pool_timeout': int(os.environ.get(POOL_TIMEOUT_ENVIRON_KEY, pool_timeout)),
+        'pool_recycle': int(os.environ.get(POOL_RECYCLE_ENVIRON_KEY, pool_recycle)),
+    }
+
+
+def pre_ping_enabled():
+    return os.environ.get(PRE_PING_ENVIRON_KEY, '1') == '1'
+
+
+def add_pre_ping(engine):
+    # Pessimistic disconnect handling as in the SQLAlchemy 1.1 docs (pool_pre_ping only exists since 1.2):
+    # a dropped connection is invalidated and reconnected before the statement runs instead of failing it
+    @event.listens_for(engine, 'engine_connect')
+    def ping_connection(connection, branch):
+        if branch:
+            return
+        should_close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except exc.DBAPIError as e:
+            if not e.connection_invalidated:
+                raise
+            connection.scalar(select([1]))
+        finally:
+            connection.should_close_with_result = should_close_with_result
+
+
+class PoolStats(object):
+
+    # Counts pool events of an engine. Many connects compared to checkouts mean connections are not reused,
+    # e.g. because pool_recycle is too low or the pool too small.
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def to_dict(self):
+        pool = self.engine.pool
+        stats = {
+            'connects': self.connects,
+            'checkouts': self.checkouts,
+            'invalidations': self.invalidations,
+        }
+        # Only QueuePool keeps connections, NullPool (PgBouncer) has nothing to report
+        if hasattr(pool, 'checkedout'):
+            stats.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow(),
+            })
+        return stats
+
+
+def configure_engine(engine):
+    # Listeners every engine of the project gets, returns the stats of its pool
+    if pre_ping_enabled():
+        add_pre_ping(engine)
+    return PoolStats(engine)
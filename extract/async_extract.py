@@ -0,0 +1,209 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+import traceback
+
+import aiohttp
+
+from models import Track, Album, Artist
+from rate_limit import get_scheduler, is_retryable, retry_after
+
+
+API_URL = 'https://api.spotify.com/v1/'
+API_URL_ENVIRON_KEY = 'SPOTIFY_API_URL'  # e.g. a local fake server
+
+
+def chunks(ids, size):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+class SpotifyHTTPError(Exception):
+
+    def __init__(self, status, url):
+        super(SpotifyHTTPError, self).__init__('Spotify returned {} for {}'.format(status, url))
+        self.status = status
+        self.url = url
+
+
+class AsyncSpotifyClient(object):
+
+    # The endpoints of the extraction over one pooled aiohttp session. Requests are rate limited and retried
+    # by the RequestScheduler of the client_id, which the threads of the blocking extraction share.
+
+    def __init__(self, session, token, scheduler, api_url=API_URL):
+        self.session = session
+        self.token = token
+        self.scheduler = scheduler
+        self.api_url = api_url
+        self.requests = 0
+        self.throttled = 0
+        self.retried = 0
+
+    async def _get(self, url, params=None):
+        if not url.startswith('http'):
+            url = self.api_url + url
+        headers = {'Authorization': 'Bearer {}'.format(self.token)}
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.scheduler.acquire())
+            self.requests += 1
+            status = None
+            retry_after_seconds = None
+            try:
+                async with self.session.get(url, params=params, headers=headers) as response:
+                    if response.status < 400:
+                        result = await response.json()
+                        self.scheduler.succeeded()
+                        return result
+                    status = response.status
+                    retry_after_seconds = retry_after(response.headers)
+                    error = SpotifyHTTPError(status, url)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            except asyncio.CancelledError:
+                # Not an outcome of the request, the circuit lets the next trial through after a while
+                raise
+            except Exception:
+                self.scheduler.aborted()
+                raise
+            if not is_retryable(status):
+                self.scheduler.succeeded()
+                raise error
+            if status == 429:
+                self.throttled += 1
+            delay = self.scheduler.failed(attempt, status, retry_after_seconds)
+            if delay is None:
+                raise error
+            self.retried += 1
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def recently_played(self, after=None, limit=50):
+        params = {'limit': str(limit)}
+        if after is not None:
+            params['after'] = str(after)
+        return await self._get('me/player/recently-played', params)
+
+    async def next(self, response):
+        if not response.get('next'):
+            return None
+        return await self._get(response['next'])
+
+    async def tracks(self, track_ids):
+        return (await self._get('tracks', {'ids': ','.join(track_ids)}))['tracks']
+
+    async def albums(self, album_ids):
+        return (await self._get('albums', {'ids': ','.join(album_ids)}))['albums']
+
+    async def artists(self, artist_ids):
+        return (await self._get('artists', {'ids': ','.join(artist_ids)}))['artists']
+
+    async def audio_features(self, track_ids):
+        return (await self._get('audio-features', {'ids': ','.join(track_ids)}))['audio_features']
+
+
+class AsyncUserExtraction(object):
+
+    # Fetches the new plays of one user and their unknown catalog entities with overlapping requests, then
+    # saves them with SpotifyConnection.save_plays_bulk. Database calls run in the executor, one at a time
+    # per user, so the session of the user is never used concurrently.
+
+    def __init__(self, spotify, client, loop, executor):
+        self.spotify = spotify
+        self.client = client
+        self.loop = loop
+        self.executor = executor
+
+    def _db(self, function, *args):
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+    async def _fetch(self, fetch, ids, size, responses):
+        # All chunks at once, the connector of the session bounds the concurrent requests
+        id_chunks = list(chunks(ids, size))
+        results = await asyncio.gather(*[fetch(chunk) for chunk in id_chunks])
+        for chunk, result in zip(id_chunks, results):
+            responses.update(zip(chunk, result))
+
+    async def get_play_tuples(self):
+        after = await self._db(self.spotify.db.get_cursor, self.spotify.user_name)
+        response = await self.client.recently_played(after=int(after) if after is not None else None)
+        play_tuples = []
+        while response:
+            play_tuples.extend(self.spotify._get_play_tuples_from_response(response))
+            response = await self.client.next(response)
+        return play_tuples
+
+    async def prefetch(self, track_ids):
+        spotify = self.spotify
+        track_ids = await self._db(spotify._get_unknown_ids, Track, track_ids)
+        await asyncio.gather(
+            self._fetch(self.client.tracks, track_ids, spotify.TRACKS_PER_REQUEST, spotify.track_responses),
+            self._fetch(self.client.audio_features, track_ids, spotify.AUDIO_FEATURES_PER_REQUEST,
+                        spotify.audio_feature_responses))
+
+        # Albums and the artists of the tracks at the same time, then the remaining artists of the albums
+        track_responses = [spotify.track_responses[i] for i in track_ids if spotify.track_responses.get(i)]
+        album_ids = await self._db(spotify._get_unknown_ids, Album, [r['album']['id'] for r in track_responses])
+        artist_ids = await self._db(spotify._get_unknown_ids, Artist,
+                                    [a['id'] for r in track_responses for a in r['artists']])
+        await asyncio.gather(
+            self._fetch(self.client.albums, album_ids, spotify.ALBUMS_PER_REQUEST, spotify.album_responses),
+            self._fetch(self.client.artists, artist_ids, spotify.ARTISTS_PER_REQUEST, spotify.artist_responses))
+
+        album_responses = [spotify.album_responses[i] for i in album_ids if spotify.album_responses.get(i)]
+        artist_ids = [a['id'] for r in album_responses for a in r['artists'] if a['id'] not in spotify.artist_responses]
+        artist_ids = await self._db(spotify._get_unknown_ids, Artist, artist_ids)
+        await self._fetch(self.client.artists, artist_ids, spotify.ARTISTS_PER_REQUEST, spotify.artist_responses)
+
+    async def run(self):
+        print("* Extracting latest plays of {} (async).".format(self.spotify.user_name))
+        play_tuples = await self.get_play_tuples()
+        if not play_tuples:
+            print("* No new plays of {}.".format(self.spotify.user_name))
+            return 0, 0, 0, 0
+        await self.prefetch([track_id for _, track_id in play_tuples])
+        return await self._db(self.spotify.save_plays_bulk, play_tuples)
+
+
+async def _extract_user(spotify, client, loop, executor):
+    # Never raises, so that one failing user does not affect the others
+    started = time.time()
+    result = {'inserted': 0, 'skipped': 0, 'failed': 0, 'not_attempted': 0, 'error': None}
+    try:
+        result['inserted'], result['skipped'], result['failed'], result['not_attempted'] = \
+            await AsyncUserExtraction(spotify, client, loop, executor).run()
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] = repr(e)
+    finally:
+        await loop.run_in_executor(executor, spotify.db.close)
+    result['seconds'] = time.time() - started
+    result['requests'] = client.requests
+    result['throttled'] = client.throttled
+    result['retried'] = client.retried
+    return result
+
+
+async def extract_users(spotify_connections, concurrency, workers, api_url, loop):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            results = await asyncio.gather(*[
+                _extract_user(spotify, AsyncSpotifyClient(session, spotify.token, spotify.scheduler or get_scheduler(),
+                                                          api_url), loop, executor)
+                for spotify in spotify_connections])
+    finally:
+        executor.shutdown()
+    return OrderedDict(zip([s.user_name for s in spotify_connections], results))
+
+
+def run(spotify_connections, concurrency=10, workers=1, api_url=None, loop=None):
+    # Extracts all users at once with at most concurrency open HTTP requests and workers database threads.
+    # Returns results per user like main.process_users.
+    api_url = api_url or os.environ.get(API_URL_ENVIRON_KEY, API_URL)
+    loop = loop or asyncio.get_event_loop()
+    return loop.run_until_complete(extract_users(spotify_connections, concurrency, workers, api_url, loop))
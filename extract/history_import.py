@@ -0,0 +1,187 @@
+import calendar
+from collections import Counter
+from datetime import datetime
+import json
+import os
+import re
+import time
+
+from sqlalchemy import func
+
+from models import ImportProgress, Play
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+SCALAR_END = re.compile(r'[ \t\n\r,\]]')
+
+TRACK_URI_PREFIX = 'spotify:track:'
+
+
+def iter_json_array(f, chunk_size=1 << 16):
+    # Yields the elements of the top-level JSON array of f one at a time. f is read in chunks, so memory
+    # use depends on the size of the largest element, not on the size of the file.
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    expect = '['
+    eof = False
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            if eof:
+                raise ValueError('Unexpected end of the JSON array')
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        char = buffer[position]
+        if expect == '[':
+            if char != '[':
+                raise ValueError('Expected a JSON array, found {!r}'.format(char))
+            position += 1
+            expect = 'first'
+        elif char == ']' and expect in ('first', 'separator'):
+            return
+        elif expect == 'separator':
+            if char != ',':
+                raise ValueError('Expected , or ] in the JSON array, found {!r}'.format(char))
+            position += 1
+            expect = 'value'
+        else:
+            # Objects, arrays and strings fail to decode while incomplete, numbers and literals are only
+            # complete once followed by a delimiter
+            complete = char in '{["' or SCALAR_END.search(buffer, position) is not None
+            try:
+                if not complete and not eof:
+                    raise ValueError('Incomplete value')
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield value
+            position = end
+            expect = 'separator'
+
+
+def played_at_utc_timestamp(played_at):
+    # Milliseconds like Play.played_at_utc_timestamp, the history has whole seconds ("2017-01-11T15:06:31Z")
+    return calendar.timegm(datetime.strptime(played_at, '%Y-%m-%dT%H:%M:%SZ').timetuple()) * 1000
+
+
+class HistoryImporter(object):
+
+    # Imports the extended streaming history of a user (Streaming_History_Audio_*.json or endsong_*.json of
+    # Spotify's privacy data export) in batches: the unknown catalog entities of a batch are fetched with the
+    # multi-ID endpoints and everything is written with SpotifyConnection's bulk inserts. The number of
+    # imported records per file is committed with every batch, so an interrupted import resumes after them.
+    #
+    # ts, the end of a play, becomes played_at like in the recently played responses. Podcasts, local files
+    # and plays shorter than min_ms_played (Spotify counts a stream after 30 seconds) are skipped, as well as
+    # plays at or after the earliest play that was in the database before the first import of the user,
+    # whose timestamps would differ from the extracted ones by their milliseconds.
+
+    def __init__(self, spotify, batch_size=5000, min_ms_played=30000):
+        self.spotify = spotify
+        self.db = spotify.db
+        self.batch_size = batch_size
+        self.min_ms_played = min_ms_played
+
+    def get_before_timestamp(self):
+        # The same for all files of a user, later imports must not take the imported plays as the boundary
+        progress = self.db.session.query(ImportProgress).\
+            filter(ImportProgress.user_name == self.spotify.user_name).\
+            first()
+        if progress is not None:
+            return progress.before_timestamp
+        return self.db.session.query(func.min(Play.played_at_utc_timestamp)).\
+            filter(Play.user_name == self.spotify.user_name).\
+            scalar()
+
+    def get_progress(self, file_name):
+        progress = self.db.session.query(ImportProgress).get((self.spotify.user_name, file_name))
+        if progress is None:
+            progress = ImportProgress(user_name=self.spotify.user_name,
+                                      file_name=file_name,
+                                      records=0,
+                                      before_timestamp=self.get_before_timestamp())
+            self.db.session.add(progress)
+        return progress
+
+    def get_play_tuple(self, record, before_timestamp, counts):
+        # (played_at, track_id) like SpotifyConnection._get_play_tuples_from_response, None if skipped
+        uri = record.get('spotify_track_uri')
+        if not uri or not uri.startswith(TRACK_URI_PREFIX):
+            counts['not_a_track'] += 1
+            return None
+        if (record.get('ms_played') or 0) < self.min_ms_played:
+            counts['too_short'] += 1
+            return None
+        if before_timestamp is not None and played_at_utc_timestamp(record['ts']) >= before_timestamp:
+            counts['extracted'] += 1
+            return None
+        return record['ts'], uri[len(TRACK_URI_PREFIX):]
+
+    def save_batch(self, play_tuples, progress, records, counts):
+        spotify = self.spotify
+        if play_tuples:
+            spotify.prefetch([track_id for _, track_id in play_tuples])
+            # Tracks that Spotify does not know anymore are answered with null
+            available = [t for t in play_tuples if spotify.track_responses.get(t[1], True) is not None]
+            counts['unavailable'] += len(play_tuples) - len(available)
+            play_tuples = available
+        progress.records = records
+        if play_tuples:
+            artists, albums, tracks, plays = spotify.build_bulk(play_tuples)
+            # Commits the progress with the plays
+            inserted, skipped = self.db.save_bulk(artists, albums, tracks, plays)
+            counts['inserted'] += inserted
+            counts['skipped'] += skipped
+            if inserted:
+                self.db.touch_data_version(spotify.user_name)
+        else:
+            self.db.session.commit()
+        # Responses of the batch that were not used, e.g. of unavailable tracks
+        for responses in (spotify.track_responses, spotify.album_responses, spotify.artist_responses,
+                          spotify.audio_feature_responses):
+            responses.clear()
+
+    def import_file(self, path):
+        file_name = os.path.basename(path)
+        progress = self.get_progress(file_name)
+        resume_after = progress.records
+        if resume_after:
+            print("* Resuming {} after {} records.".format(file_name, resume_after))
+        counts = Counter()
+        started = time.time()
+        play_tuples = []
+        records = 0
+        with open(path, encoding='utf-8') as f:
+            for record in iter_json_array(f):
+                records += 1
+                if records <= resume_after:
+                    continue
+                play_tuple = self.get_play_tuple(record, progress.before_timestamp, counts)
+                if play_tuple:
+                    play_tuples.append(play_tuple)
+                if len(play_tuples) >= self.batch_size:
+                    self.save_batch(play_tuples, progress, records, counts)
+                    play_tuples = []
+                    print("* {}: {} records, {} plays inserted ({:.0f} records/s).".format(
+                        file_name, records, counts['inserted'], (records - resume_after) / (time.time() - started)))
+        self.save_batch(play_tuples, progress, records, counts)
+        counts['records'] = records - resume_after
+        print("* {}: {} records imported: {}.".format(
+            file_name, counts['records'], ", ".join("{} {}".format(k, v) for k, v in sorted(counts.items()))))
+        return counts
+
+    def import_files(self, paths):
+        counts = Counter()
+        for path in paths:
+            counts.update(self.import_file(path))
+        return counts
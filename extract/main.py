@@ -1,17 +1,26 @@
 import argparse
-from dateutil import tz
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cProfile
 from datetime import datetime
+import os
+import time
+import traceback
 
-from spotipy import Spotify
 import spotipy.util
 
-from models import Play, Track, Album, Artist, PostgreSQLConnection
+from models import Play, Track, Album, Artist, PostgreSQLConnection, AUDIO_FEATURES, audio_features_of, known_ids, \
+    get_engine, get_pool_stats
+from history_import import HistoryImporter
+from play_times import PLAY_TIME_COLUMNS, decompose_played_at, get_timezone
+from profiling import Profiler, profile_client, profile_db, profile_stage
+from rate_limit import SingleAttemptSpotify, get_scheduler, schedule_client, schedulers
 
 import settings
 
 
 def set_timezone_to_datetime(datetime_to_set, timezone):
-    return datetime_to_set.replace(tzinfo=tz.gettz(timezone))
+    return datetime_to_set.replace(tzinfo=get_timezone(timezone))
 
 
 def convert_played_at_from_response_to_datetime(played_at):
@@ -23,64 +32,135 @@ def convert_played_at_from_response_to_datetime(played_at):
 
 
 def convert_datetime_from_timezone_to_timezone(datetime_to_convert, from_tz_code, to_tz_code):
-    from_tz = tz.gettz(from_tz_code)
-    to_tz = tz.gettz(to_tz_code)
+    from_tz = get_timezone(from_tz_code)
+    to_tz = get_timezone(to_tz_code)
 
     datetime_to_convert = datetime_to_convert.replace(tzinfo=from_tz)
     converted_datetime = datetime_to_convert.astimezone(to_tz)
     return converted_datetime
 
 
+def chunks(ids, size):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
 class SpotifyConnection(object):
 
-    def __init__(self, user_data):
+    # Maximum number of IDs per request of Spotify's multi-ID endpoints
+    TRACKS_PER_REQUEST = 50
+    ALBUMS_PER_REQUEST = 20
+    ARTISTS_PER_REQUEST = 50
+    AUDIO_FEATURES_PER_REQUEST = 100
+
+    def __init__(self, user_data, client=None, profile=None, scheduler=None):
         self.user_name = user_data['user_name']
-        token = spotipy.util.prompt_for_user_token(self.user_name,
-                                                   scope='user-read-recently-played',
-                                                   client_id=user_data['client_id'],
-                                                   client_secret=user_data['client_secret'],
-                                                   redirect_uri=user_data['redirect_uri'])
-        self.client = Spotify(auth=token)
-        self.db = self.init_db()
+        if client is None:
+            with profile_stage(profile, 'auth'):
+                token = spotipy.util.prompt_for_user_token(self.user_name,
+                                                           scope='user-read-recently-played',
+                                                           client_id=user_data['client_id'],
+                                                           client_secret=user_data['client_secret'],
+                                                           redirect_uri=user_data['redirect_uri'])
+            client = SingleAttemptSpotify(auth=token)
+            scheduler = scheduler or get_scheduler(user_data['client_id'])
+        else:
+            token = None
+        self.token = token  # Also used by the asyncio extraction
+        # Requests are rate limited and retried per client_id, injected clients only with a scheduler
+        self.scheduler = scheduler
+        # With a profile, the Spotify and database calls are timed per stage, including waits of the scheduler
+        self.client = profile_client(schedule_client(client, scheduler), profile)
+        self.db = profile_db(self.init_db(), profile)
+        # Responses of the multi-ID endpoints by requested ID, filled by prefetch()
+        self.track_responses = dict()
+        self.album_responses = dict()
+        self.artist_responses = dict()
+        self.audio_feature_responses = dict()
 
     def init_db(self):
         return PostgreSQLConnection()
 
+    def prefetch(self, track_ids):
+        # Fetches all unknown tracks of a play batch and their unknown albums and artists with as few
+        # requests as possible. The get_* methods then look the responses up instead of calling the API.
+        track_ids = self._get_unknown_ids(Track, track_ids)
+        for chunk in chunks(track_ids, self.TRACKS_PER_REQUEST):
+            self.track_responses.update(zip(chunk, self.client.tracks(chunk)['tracks']))
+        for chunk in chunks(track_ids, self.AUDIO_FEATURES_PER_REQUEST):
+            self.audio_feature_responses.update(zip(chunk, self.client.audio_features(chunk)))
+
+        track_responses = [self.track_responses[i] for i in track_ids if self.track_responses[i]]
+        album_ids = self._get_unknown_ids(Album, [r['album']['id'] for r in track_responses])
+        for chunk in chunks(album_ids, self.ALBUMS_PER_REQUEST):
+            self.album_responses.update(zip(chunk, self.client.albums(chunk)['albums']))
+
+        album_responses = [self.album_responses[i] for i in album_ids if self.album_responses[i]]
+        artist_ids = [a['id'] for r in track_responses + album_responses for a in r['artists']]
+        artist_ids = self._get_unknown_ids(Artist, artist_ids)
+        for chunk in chunks(artist_ids, self.ARTISTS_PER_REQUEST):
+            self.artist_responses.update(zip(chunk, self.client.artists(chunk)['artists']))
+
+    def _get_track_response(self, track_id):
+        return self.track_responses.pop(track_id, None) or self.client.track(track_id)
+
+    def _get_album_response(self, album_id):
+        return self.album_responses.pop(album_id, None) or self.client.album(album_id)
+
+    def _get_artist_response(self, artist_id):
+        return self.artist_responses.pop(artist_id, None) or self.client.artist(artist_id)
+
+    def _get_audio_feature_response(self, track_id):
+        if track_id in self.audio_feature_responses:
+            return self.audio_feature_responses.pop(track_id)
+        return self.client.audio_features(track_id)[0]
+
     def get_artist(self, artist_id):
+        if known_ids.contains(Artist, artist_id):
+            return self.db.get_reference(Artist, artist_id)
         artist = self.db.session.query(Artist).get(artist_id)
         if artist:
+            known_ids.add(Artist, [artist_id])
             return artist
         else:
-            artist_response = self.client.artist(artist_id)
+            artist_response = self._get_artist_response(artist_id)
             artist = Artist()
             artist.artist_id = artist_id
             artist.artist_data = artist_response
-            self.db.save_instance(artist)
             print("> Artist {} was not in database.".format(artist.artist_data['name']))
+            if self.db.save_instance(artist):
+                return artist
             return self.db.session.query(Artist).get(artist_id)
 
     def get_album(self, album_id):
+        if known_ids.contains(Album, album_id):
+            return self.db.get_reference(Album, album_id)
         album = self.db.session.query(Album).get(album_id)
         if album:
+            known_ids.add(Album, [album_id])
             return album
         else:
-            album_response = self.client.album(album_id)
+            album_response = self._get_album_response(album_id)
             album = Album()
             album.album_data = album_response
             album.album_id = album_response['id']
             # Artists
             for album_artist_response in album_response['artists']:
                 album.artists.append(self.get_artist(album_artist_response['id']))
-            self.db.save_instance(album)
             print("> Album {} was not in database.".format(album.album_data['name']))
+            if self.db.save_instance(album):
+                return album
             return self.db.session.query(Album).get(album_id)
 
     def get_track(self, track_id):
+        if known_ids.contains(Track, track_id):
+            return self.db.get_reference(Track, track_id)
         track = self.db.session.query(Track).get(track_id)
         if track:
+            known_ids.add(Track, [track_id], [audio_features_of(track)])
             return track
         else:
-            response = self.client.track(track_id)
+            response = self._get_track_response(track_id)
 
             track = Track()
             track.track_id = track_id
@@ -91,14 +171,17 @@ class SpotifyConnection(object):
             for artist_response in response['artists']:
                 track.artists.append(self.get_artist(artist_response['id']))
             # Audio feature
-            audio_feature_response = self.client.audio_features(track_id)[0]
+            audio_feature_response = self._get_audio_feature_response(track_id)
             if audio_feature_response:  # Some tracks do not have audio features
                 track.audio_feature_data = audio_feature_response
+                for feature in AUDIO_FEATURES:
+                    setattr(track, feature, audio_feature_response[feature])
             print("> Track {} was not in database.".format(track.track_data['name']))
-            self.db.save_instance(track)
+            if self.db.save_instance(track):
+                return track
             return self.db.session.query(Track).get(track_id)
 
-    def get_play_from_played_at_utc_and_track_id(self, played_at_utc, track_id):
+    def get_play_from_played_at_utc(self, played_at_utc):
         played_at_utc = convert_played_at_from_response_to_datetime(played_at_utc)
         played_at_utc = set_timezone_to_datetime(played_at_utc, timezone='UTC')
         played_at_cet = convert_datetime_from_timezone_to_timezone(played_at_utc,
@@ -118,6 +201,19 @@ class SpotifyConnection(object):
         play.second = played_at_cet.second
         play.day_of_week = played_at_cet.weekday()
         play.week_of_year = played_at_cet.date().isocalendar()[1]
+        return play
+
+    def get_plays_from_played_at_utc(self, played_at_utcs):
+        # Like get_play_from_played_at_utc for many plays at once
+        plays = []
+        for values in zip(*decompose_played_at(played_at_utcs).values()):
+            play = Play(**dict(zip(PLAY_TIME_COLUMNS, values)))
+            play.user_name = self.user_name
+            plays.append(play)
+        return plays
+
+    def get_play_from_played_at_utc_and_track_id(self, played_at_utc, track_id):
+        play = self.get_play_from_played_at_utc(played_at_utc)
         # Track
         track = self.get_track(track_id)
         play.track = track
@@ -143,29 +239,218 @@ class SpotifyConnection(object):
 
         return play_tuples
 
+    def _get_new_play_tuples(self):
+        # Only plays after the latest extracted play of the user
+        after = self.db.get_cursor(self.user_name)
+        if after is not None:
+            print("* Extracting plays after {}.".format(int(after)))
+            return self._get_play_tuples(after=int(after))
+        return self._get_play_tuples()
+
     def extract_plays(self):
         print("* Extracting latest plays of {}.".format(self.user_name))
-        play_tuples = self._get_play_tuples()
-
-        for played_at, track_id in play_tuples:
+        play_tuples = self._get_new_play_tuples()
+        if not play_tuples:
+            print("* No new plays.")
+            return 0, 0, 0, 0
+        self.prefetch([track_id for _, track_id in play_tuples])
+
+        inserted = 0
+        skipped = 0
+        failed = 0
+        latest_timestamp = None
+        # Oldest first, the cursor only advances over plays that are in the database
+        for played_at, track_id in sorted(play_tuples, key=lambda t: convert_played_at_from_response_to_datetime(t[0])):
             play = self.get_play_from_played_at_utc_and_track_id(played_at, track_id)
-            self.db.save_play(play)
+            saved = self.db.save_play(play)
+            if saved is None:
+                print("* Play at {} was not saved, the next run extracts it again.".format(play.played_at_cet))
+                failed += 1
+                break
+            if saved:
+                inserted += 1
+            else:
+                skipped += 1
+            latest_timestamp = play.played_at_utc_timestamp
+        if latest_timestamp is not None:
+            self.db.save_cursor(self.user_name, latest_timestamp)
+        # The plays after a failed one are left for the next run
+        return inserted, skipped, failed, len(play_tuples) - inserted - skipped - failed
+
+    def _get_unknown_ids(self, model, ids):
+        ids = list(set(ids))
+        known_ids = self.db.get_known_ids(model, ids)
+        return [i for i in ids if i not in known_ids]
+
+    def extract_plays_bulk(self):
+        # Collects all plays and unknown catalog entities first and writes them in one transaction
+        print("* Extracting latest plays of {} (bulk).".format(self.user_name))
+        play_tuples = self._get_new_play_tuples()
+        if not play_tuples:
+            print("* No new plays.")
+            return 0, 0, 0, 0
+        self.prefetch([track_id for _, track_id in play_tuples])
+        return self.save_plays_bulk(play_tuples)
+
+    def save_plays_bulk(self, play_tuples):
+        # Saves the plays and their unknown catalog entities in one transaction and advances the cursor
+        artists, albums, tracks, plays = self.build_bulk(play_tuples)
+        inserted, skipped = self.db.save_bulk(artists, albums, tracks, plays)
+        self.db.save_cursor(self.user_name, max(p.played_at_utc_timestamp for p in plays))
+        print("* {} artists, {} albums and {} tracks were not in database.".format(len(artists), len(albums),
+                                                                                   len(tracks)))
+        print("* {} plays inserted, {} plays skipped.".format(inserted, skipped))
+        return inserted, skipped, 0, 0
+
+    def build_bulk(self, play_tuples):
+        # The plays and their unknown catalog entities for save_bulk, built from the prefetched responses.
+        # Responses missing there are requested one by one.
+
+        # Tracks
+        tracks = []
+        for track_id in self._get_unknown_ids(Track, [track_id for _, track_id in play_tuples]):
+            response = self._get_track_response(track_id)
+            track = Track()
+            track.track_id = track_id
+            track.track_data = response
+            track.album_id = response['album']['id']
+            track.artist_ids = [a['id'] for a in response['artists']]
+            audio_feature_response = self._get_audio_feature_response(track_id)
+            if audio_feature_response:  # Some tracks do not have audio features
+                track.audio_feature_data = audio_feature_response
+                for feature in AUDIO_FEATURES:
+                    setattr(track, feature, audio_feature_response[feature])
+            tracks.append(track)
+
+        # Albums
+        albums = []
+        for album_id in self._get_unknown_ids(Album, [t.album_id for t in tracks]):
+            response = self._get_album_response(album_id)
+            album = Album()
+            album.album_id = album_id
+            album.album_data = response
+            album.artist_ids = [a['id'] for a in response['artists']]
+            albums.append(album)
+
+        # Artists
+        artists = []
+        artist_ids = [i for t in tracks for i in t.artist_ids] + [i for a in albums for i in a.artist_ids]
+        for artist_id in self._get_unknown_ids(Artist, artist_ids):
+            artist = Artist()
+            artist.artist_id = artist_id
+            artist.artist_data = self._get_artist_response(artist_id)
+            artists.append(artist)
+
+        # Plays
+        plays = self.get_plays_from_played_at_utc([played_at for played_at, _ in play_tuples])
+        for play, (_, track_id) in zip(plays, play_tuples):
+            play.track_id = track_id
+        return artists, albums, tracks, plays
 
 
 class HoergewohnheitenManager(object):
 
-    def __init__(self, spotify_user_data):
-        self.spotify = SpotifyConnection(user_data=spotify_user_data)
+    def __init__(self, spotify_user_data, bulk=False, profile=None):
+        self.spotify = SpotifyConnection(user_data=spotify_user_data, profile=profile)
+        self.bulk = bulk
 
     def process_hoergewohnheiten(self):
-        self.spotify.extract_plays()
+        try:
+            if self.bulk:
+                return self.spotify.extract_plays_bulk()
+            return self.spotify.extract_plays()
+        finally:
+            self.spotify.db.close()
 
 
-def process_hoergewohnheiten(user_name):
+def process_hoergewohnheiten(user_name, bulk=False, profile=None):
     print("***", user_name, "***")
     user_data = settings.SPOTIFY_USERS[user_name]
-    mgr = HoergewohnheitenManager(user_data)
-    mgr.process_hoergewohnheiten()
+    mgr = HoergewohnheitenManager(user_data, bulk=bulk, profile=profile)
+    return mgr.process_hoergewohnheiten()
+
+
+def _process_hoergewohnheiten_isolated(user_name, bulk, profiler=None, cprofile_dir=None):
+    # Never raises, so that one failing user does not affect the others
+    started = time.time()
+    result = {'inserted': 0, 'skipped': 0, 'failed': 0, 'not_attempted': 0, 'error': None}
+    profile = profiler.user(user_name) if profiler else None
+    # cProfile only sees the thread it was enabled in, so every user run gets its own
+    c_profile = cProfile.Profile() if cprofile_dir else None
+    if c_profile:
+        c_profile.enable()
+    try:
+        result['inserted'], result['skipped'], result['failed'], result['not_attempted'] = \
+            process_hoergewohnheiten(user_name, bulk=bulk, profile=profile)
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] = repr(e)
+    finally:
+        if c_profile:
+            c_profile.disable()
+            c_profile.dump_stats(os.path.join(cprofile_dir, '{}.prof'.format(user_name)))
+    result['seconds'] = time.time() - started
+    if profile:
+        profile.finish(result)
+    return result
+
+
+def process_users(user_names, workers=1, bulk=False, profiler=None, cprofile_dir=None):
+    # Each user runs with its own session, all sessions share the pool of the process wide engine.
+    # Every worker holds one connection, the overflow covers the cursor and migration commands.
+    get_engine(pool_size=workers, max_overflow=2)
+    results = OrderedDict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(u, executor.submit(_process_hoergewohnheiten_isolated, u, bulk, profiler, cprofile_dir))
+                   for u in user_names]
+        for user_name, future in futures:
+            results[user_name] = future.result()
+
+    print_summary(results)
+    return results
+
+
+def process_users_async(user_names, workers=1, concurrency=10):
+    # All users at once on one event loop, see async_extract. Tokens are fetched up front, because
+    # prompt_for_user_token may ask on the console.
+    import async_extract
+    get_engine(pool_size=workers, max_overflow=2)
+    results = OrderedDict()
+    spotify_connections = []
+    for user_name in user_names:
+        try:
+            spotify_connections.append(SpotifyConnection(settings.SPOTIFY_USERS[user_name]))
+        except Exception as e:
+            traceback.print_exc()
+            results[user_name] = {'inserted': 0, 'skipped': 0, 'failed': 0, 'not_attempted': 0, 'error': repr(e),
+                                  'seconds': 0.0}
+    results.update(async_extract.run(spotify_connections, concurrency=concurrency, workers=workers))
+    print_summary(results)
+    return results
+
+
+def import_history(user_name, paths, min_ms_played=30000):
+    spotify = SpotifyConnection(settings.SPOTIFY_USERS[user_name])
+    try:
+        counts = HistoryImporter(spotify, min_ms_played=min_ms_played).import_files(paths)
+    finally:
+        spotify.db.close()
+    print("* Imported {} plays of {} from {} records.".format(counts['inserted'], user_name, counts['records']))
+    return counts
+
+
+def print_summary(results):
+    print("Summary:")
+    for user_name, result in results.items():
+        # Skipped plays were in the database already, failed and not attempted ones are extracted again
+        print("* {}: {:.1f}s, {} plays inserted, {} plays skipped, {} plays failed, {} plays not attempted{}".format(
+            user_name, result['seconds'], result['inserted'], result['skipped'], result['failed'],
+            result['not_attempted'], ", failed with {}".format(result['error']) if result['error'] else ""))
+
+
+def get_scheduler_stats():
+    return OrderedDict((str(client_id), scheduler.stats.to_dict())
+                       for client_id, scheduler in sorted(schedulers.items(), key=lambda item: str(item[0])))
 
 
 if __name__ == '__main__':
@@ -180,12 +465,69 @@ if __name__ == '__main__':
     # Argparse
     parser = argparse.ArgumentParser(description='Hoergewohnheiten')
     parser.add_argument('-u', dest='user_name')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of users to extract concurrently')
+    parser.add_argument('--bulk', dest='bulk', action='store_true',
+                        help='Write all new plays and catalog entities of a user in one transaction')
+    parser.add_argument('--migrate-db', dest='migrate_db', action='store_true',
+                        help='Create missing tables and indexes in an existing database')
+    parser.add_argument('--backfill-audio-features', dest='backfill_audio_features', action='store_true',
+                        help='Copy audio features of existing tracks from JSON into typed columns')
+    parser.add_argument('--rebuild-rollups', dest='rebuild_rollups', action='store_true',
+                        help='Recompute t_play_rollup from all existing plays')
+    parser.add_argument('--async', dest='async_', action='store_true',
+                        help='Extract all users at once with asyncio and aiohttp (implies bulk writes)')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=10,
+                        help='Maximum number of concurrent Spotify requests with --async')
+    parser.add_argument('--import-history', dest='import_history', nargs='+', metavar='FILE',
+                        help='Import the extended streaming history JSON files of the user given by -u')
+    parser.add_argument('--min-ms-played', dest='min_ms_played', type=int, default=30000,
+                        help='Shortest play imported by --import-history in milliseconds')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Report time, calls and bytes per stage and user')
+    parser.add_argument('--profile-output', dest='profile_output', default='profile.jsonl',
+                        help='File the profile of the run is appended to as one JSON line')
+    parser.add_argument('--cprofile-dir', dest='cprofile_dir',
+                        help='Directory for a cProfile dump (<user_name>.prof) per user run')
     args = parser.parse_args()
-
-    if args.user_name:
-        process_hoergewohnheiten(args.user_name)
+    if args.async_ and (args.profile or args.cprofile_dir):
+        # The stages of the event loop overlap, so they are not timed
+        parser.error('--profile and --cprofile-dir are not supported with --async')
+    profiler = Profiler() if args.profile else None
+    if args.cprofile_dir and not os.path.isdir(args.cprofile_dir):
+        os.makedirs(args.cprofile_dir)
+
+    if args.migrate_db:
+        print("* Migrating database.")
+        PostgreSQLConnection().migrate_db()
+    elif args.backfill_audio_features:
+        print("* Backfilling audio features.")
+        PostgreSQLConnection().backfill_audio_features()
+    elif args.rebuild_rollups:
+        print("* Rebuilding play rollups.")
+        PostgreSQLConnection().rebuild_rollups()
+    elif args.import_history:
+        if not args.user_name:
+            parser.error('--import-history requires -u')
+        import_history(args.user_name, args.import_history, min_ms_played=args.min_ms_played)
+    elif args.async_:
+        process_users_async([args.user_name] if args.user_name else list(settings.SPOTIFY_USERS),
+                            workers=args.workers, concurrency=args.concurrency)
+    elif args.user_name:
+        process_users([args.user_name], bulk=args.bulk, profiler=profiler, cprofile_dir=args.cprofile_dir)
     else:
-        for user_name in settings.SPOTIFY_USERS:
-            process_hoergewohnheiten(user_name)
+        process_users(list(settings.SPOTIFY_USERS), workers=args.workers, bulk=args.bulk,
+                      profiler=profiler, cprofile_dir=args.cprofile_dir)
+    print("Known ID cache: {} hits, {} misses.".format(known_ids.hits, known_ids.misses))
+    print("Connection pool: {}.".format(", ".join("{} {}".format(k, v)
+                                                  for k, v in sorted(get_pool_stats().to_dict().items()))))
+    for client_id, stats in get_scheduler_stats().items():
+        print("Spotify requests of {}: {}.".format(client_id, ", ".join("{} {}".format(k, round(v, 2))
+                                                                        for k, v in sorted(stats.items()))))
+    if profiler:
+        profiler.pool = get_pool_stats().to_dict()
+        profiler.requests = get_scheduler_stats()
+        profiler.print_summary()
+        profiler.write(args.profile_output)
 
     print("Finished at {}.".format(datetime.now()))
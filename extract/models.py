@@ -1,112 +1,177 @@
+from collections import OrderedDict
 from datetime import datetime
 import os
+import sys
+import threading
 
-from sqlalchemy import Column, DateTime, String, BigInteger, Integer, ForeignKey
-from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Table
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy import func, inspect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import null
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import make_transient_to_detached, sessionmaker
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
 
+# The schema is shared with the API. Appended, so that settings and models of extract/ come first
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from db_pool import configure_engine, engine_options  # noqa: E402
+from schema import Base, AUDIO_FEATURES, track_artists, album_artists, Artist, Album, Track, Play, PlayRollup, \
+    ExtractionCursor, ImportProgress  # noqa: E402,F401
 
-POSTGRES_ENVIRON_KEY = 'DATABASE_URL'
-
-
-Base = declarative_base()
-
-
-track_artists = Table('t_track_artists',
-                      Base.metadata,
-                      Column('track_id', String, ForeignKey('t_track.track_id')),
-                      Column('artist_id', String, ForeignKey('t_artist.artist_id')))
-
-
-album_artists = Table('t_album_artists',
-                      Base.metadata,
-                      Column('album_id', String, ForeignKey('t_album.album_id')),
-                      Column('artist_id', String, ForeignKey('t_artist.artist_id')))
-
-
-class Artist(Base):
-
-    # Meta
-    __tablename__ = 't_artist'
-    created_at_utc = Column(DateTime, default=datetime.utcnow)
-
-    # Payload
-    artist_id = Column(String, primary_key=True)
-    artist_data = Column(JSON, nullable=False)
-
-
-class Album(Base):
-
-    # Meta
-    __tablename__ = 't_album'
-    created_at_utc = Column(DateTime, default=datetime.utcnow)
-
-    # Payload
-    album_id = Column(String, primary_key=True)
-    album_data = Column(JSON, nullable=False)
 
-    # Relationship
-    artists = relationship('Artist', secondary=album_artists)
-    tracks = relationship('Track')
-
-
-class Track(Base):
-
-    # Meta
-    __tablename__ = 't_track'
-    created_at_utc = Column(DateTime, default=datetime.utcnow)
-
-    # Payload
-    track_id = Column(String, primary_key=True, index=True)
-    album_id = Column(String, ForeignKey('t_album.album_id'), index=True)
-    track_data = Column(JSON, nullable=False)
-    audio_feature_data = Column(JSON)
-
-    # Relationships
-    plays = relationship('Play', back_populates='track')
-    album = relationship('Album', back_populates='tracks')
-    artists = relationship('Artist', secondary=track_artists)
+POSTGRES_ENVIRON_KEY = 'DATABASE_URL'
 
 
-class Play(Base):
+REBUILD_ROLLUPS_SQL = """INSERT INTO t_play_rollup (
+    user_name, year, month, day, hour, date_cet, day_of_week,
+    play_count, audio_feature_count, sum_tempo, sum_energy, sum_valence, sum_key, sum_loudness)
+SELECT
+    t_play.user_name,
+    t_play.year,
+    t_play.month,
+    t_play.day,
+    t_play.hour,
+    min(t_play.played_at_cet) :: DATE,
+    min(t_play.day_of_week),
+    count(*),
+    count(t_track.tempo),
+    coalesce(sum(t_track.tempo), 0),
+    coalesce(sum(t_track.energy), 0),
+    coalesce(sum(t_track.valence), 0),
+    coalesce(sum(t_track.key), 0),
+    coalesce(sum(t_track.loudness), 0)
+FROM
+    t_play
+JOIN t_track ON t_play.track_id = t_track.track_id
+{where}
+GROUP BY t_play.user_name, t_play.year, t_play.month, t_play.day, t_play.hour
+{on_conflict}"""
+
+
+ROLLUPS_ON_CONFLICT_ADD_SQL = """ON CONFLICT (user_name, year, month, day, hour) DO UPDATE SET
+    play_count = t_play_rollup.play_count + EXCLUDED.play_count,
+    audio_feature_count = t_play_rollup.audio_feature_count + EXCLUDED.audio_feature_count,
+    sum_tempo = t_play_rollup.sum_tempo + EXCLUDED.sum_tempo,
+    sum_energy = t_play_rollup.sum_energy + EXCLUDED.sum_energy,
+    sum_valence = t_play_rollup.sum_valence + EXCLUDED.sum_valence,
+    sum_key = t_play_rollup.sum_key + EXCLUDED.sum_key,
+    sum_loudness = t_play_rollup.sum_loudness + EXCLUDED.sum_loudness"""
+
+
+ADD_PLAY_TO_ROLLUP_SQL = """INSERT INTO t_play_rollup (
+    user_name, year, month, day, hour, date_cet, day_of_week,
+    play_count, audio_feature_count, sum_tempo, sum_energy, sum_valence, sum_key, sum_loudness)
+VALUES (
+    :user_name, :year, :month, :day, :hour, :date_cet, :day_of_week,
+    1, :audio_feature_count, :sum_tempo, :sum_energy, :sum_valence, :sum_key, :sum_loudness)
+{on_conflict}"""
+
+
+BACKFILL_AUDIO_FEATURES_SQL = """UPDATE t_track SET
+    tempo = (audio_feature_data->>'tempo') :: FLOAT,
+    energy = (audio_feature_data->>'energy') :: FLOAT,
+    valence = (audio_feature_data->>'valence') :: FLOAT,
+    key = (audio_feature_data->>'key') :: FLOAT,
+    loudness = (audio_feature_data->>'loudness') :: FLOAT
+WHERE audio_feature_data IS NOT NULL
+AND tempo IS NULL"""
+
+
+def to_row(instance):
+    # Column values of a transient instance for Core inserts (SQL NULL for unset values)
+    row = dict()
+    for column in instance.__table__.columns:
+        if column.default is not None:
+            continue
+        value = getattr(instance, column.key)
+        row[column.name] = value if value is not None else null()
+    return row
+
+
+def audio_features_of(track):
+    # Kept with the known track IDs, so that rollups need no lookup of the track
+    return tuple(getattr(track, feature) for feature in AUDIO_FEATURES)
+
+
+class KnownIdCache(object):
+
+    # Bounded LRU set of catalog IDs known to be in the database, shared by all users of a run. A value can be
+    # kept with an ID, e.g. the audio features of a track.
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def contains(self, model, id_):
+        key = (model.__tablename__, id_)
+        with self.lock:
+            if key in self.ids:
+                self.ids.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def get(self, model, id_):
+        # The value kept with a known ID, None for unknown IDs
+        with self.lock:
+            return self.ids.get((model.__tablename__, id_))
+
+    def add(self, model, ids, values=None):
+        with self.lock:
+            for id_, value in zip(ids, values or [True] * len(ids)):
+                key = (model.__tablename__, id_)
+                self.ids[key] = value
+                self.ids.move_to_end(key)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+
+known_ids = KnownIdCache()
+
+
+_engine = None
+_pool_stats = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(**pool_defaults):
+    # One engine (and connection pool) per process, created on first use. pool_defaults (e.g. pool_size)
+    # only apply to the first call and are overridden by the DB_* environment variables, see db_pool.
+    global _engine, _pool_stats
+    with _engine_lock:
+        if _engine is None:
+            if POSTGRES_ENVIRON_KEY in os.environ:
+                url = os.environ[POSTGRES_ENVIRON_KEY]
+            else:
+                import settings
+                url = settings.POSTGRES_CONNECTION_STRING
+            _engine = create_engine(url, **engine_options(url, **pool_defaults))
+            _pool_stats = configure_engine(_engine)
+        return _engine
 
-    # Meta
-    __tablename__ = 't_play'
-    created_at_utc = Column(DateTime, default=datetime.utcnow)
 
-    # Payload
-    played_at_utc_timestamp = Column(BigInteger, primary_key=True)
-    played_at_utc = Column(DateTime, nullable=False)
-    played_at_cet = Column(DateTime, nullable=False)
-    day = Column(Integer, nullable=False)
-    month = Column(Integer, nullable=False)
-    year = Column(Integer, nullable=False)
-    hour = Column(Integer, nullable=False)
-    minute = Column(Integer, nullable=False)
-    second = Column(Integer, nullable=False)
-    day_of_week = Column(Integer, nullable=False)  # Monday: 0, Sunday: 6
-    week_of_year = Column(Integer, nullable=False)
-    track_id = Column(String, ForeignKey('t_track.track_id'), index=True)
-    user_name = Column(String, nullable=False)
+def get_pool_stats():
+    get_engine()
+    return _pool_stats
 
-    # Relationship
-    track = relationship('Track', back_populates='plays')
+
+# Sessions keep objects loaded after commits, so repeated lookups are answered from the identity map
+Session = sessionmaker(autoflush=False, expire_on_commit=False)
 
 
 class PostgreSQLConnection(object):
 
     def __init__(self):
-        if POSTGRES_ENVIRON_KEY in os.environ:
-            self.engine = create_engine(os.environ[POSTGRES_ENVIRON_KEY])
-        else:
-            import settings
-            self.engine = create_engine(settings.POSTGRES_CONNECTION_STRING)
-        self.session = sessionmaker(autoflush=False)(bind=self.engine)
+        # One session per user run, close() returns its connection to the pool of the process wide engine
+        self.engine = get_engine()
+        self.session = Session(bind=self.engine)
+
+    def close(self):
+        # Returns the connection of the session to the pool
+        self.session.close()
 
     def drop_db(self):
         Base.metadata.drop_all(bind=self.engine)
@@ -114,21 +179,179 @@ class PostgreSQLConnection(object):
     def create_db(self):
         Base.metadata.create_all(bind=self.engine)
 
+    def migrate_db(self):
+        # Creates missing tables and adds missing (nullable) columns and indexes to existing tables
+        inspector = inspect(self.engine)
+        existing_tables = inspector.get_table_names()
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                print("* Creating table {}.".format(table.name))
+                table.create(bind=self.engine)
+                continue
+            existing_columns = [c['name'] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    print("* Adding column {}.{}.".format(table.name, column.name))
+                    self.engine.execute('ALTER TABLE {} ADD COLUMN "{}" {}'.format(
+                        table.name, column.name, column.type.compile(dialect=self.engine.dialect)))
+            existing_indexes = [i['name'] for i in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    print("* Creating index {}.".format(index.name))
+                    index.create(bind=self.engine)
+
     def save_instance(self, instance):
         try:
             self.session.add(instance)
             self.session.commit()
+            model = type(instance)
+            known_ids.add(model, [instance.__mapper__.primary_key_from_instance(instance)[0]],
+                          [audio_features_of(instance)] if model is Track else None)
+            return True
         except IntegrityError as e:
             self.session.rollback()
         except InvalidRequestError as e:
             self.session.rollback()
+        return False
+
+    def add_play_to_rollup(self, play):
+        # One upsert, so that concurrent runs for the same user add up instead of overwriting each other
+        audio_features = known_ids.get(Track, play.track_id)
+        if audio_features is None:  # Dropped from the cache in the meantime
+            audio_features = audio_features_of(play.track)
+        has_audio_features = audio_features[0] is not None
+        parameters = {'user_name': play.user_name,
+                      'year': play.year,
+                      'month': play.month,
+                      'day': play.day,
+                      'hour': play.hour,
+                      'date_cet': play.played_at_cet.date(),
+                      'day_of_week': play.day_of_week,
+                      'audio_feature_count': 1 if has_audio_features else 0}
+        for feature, value in zip(AUDIO_FEATURES, audio_features):
+            parameters['sum_' + feature] = value if has_audio_features else 0.0
+        self.session.execute(ADD_PLAY_TO_ROLLUP_SQL.format(on_conflict=ROLLUPS_ON_CONFLICT_ADD_SQL), parameters)
+
+    def backfill_audio_features(self):
+        result = self.session.execute(BACKFILL_AUDIO_FEATURES_SQL)
+        if result.rowcount:
+            # The audio features of all users can change, see touch_data_version
+            self.session.query(ExtractionCursor).\
+                update({ExtractionCursor.updated_at_utc: datetime.utcnow()}, synchronize_session=False)
+        self.session.commit()
+        print("* Backfilled audio features of {} tracks.".format(result.rowcount))
+
+    def rebuild_rollups(self):
+        self.session.execute("DELETE FROM t_play_rollup")
+        self.session.execute(REBUILD_ROLLUPS_SQL.format(where='', on_conflict=''))
+        self.session.commit()
 
     def save_play(self, play):
+        # True if the play was inserted, False if it was in the database already, None if it failed
         try:
             self.session.add(play)
+            self.session.flush()  # Raises IntegrityError for known plays before the rollup is touched
+            self.add_play_to_rollup(play)
             self.session.commit()
-            print("* Track \"{}\" (played at {}) saved.".format(play.track.track_data['name'], play.played_at_cet))
+            # By ID, the track is not loaded for this
+            print("* Track {} (played at {}) saved.".format(play.track_id, play.played_at_cet))
+            return True
         except IntegrityError as e:
             self.session.rollback()
+            return False
         except InvalidRequestError as e:
             self.session.rollback()
+        return None
+
+    def get_cursor(self, user_name):
+        cursor = self.session.query(ExtractionCursor).get(user_name)
+        if cursor:
+            return cursor.played_at_utc_timestamp
+        # Users extracted before cursors existed
+        return self.session.query(func.max(Play.played_at_utc_timestamp)).filter(Play.user_name == user_name).scalar()
+
+    def save_cursor(self, user_name, played_at_utc_timestamp):
+        cursor = self.session.query(ExtractionCursor).get(user_name)
+        if cursor is None:
+            cursor = ExtractionCursor(user_name=user_name, played_at_utc_timestamp=played_at_utc_timestamp)
+            self.session.add(cursor)
+        else:
+            cursor.played_at_utc_timestamp = max(cursor.played_at_utc_timestamp, played_at_utc_timestamp)
+        self.session.commit()
+
+    def touch_data_version(self, user_name):
+        # ExtractionCursor.updated_at_utc is the data version of the API caches (api.get_data_version), plays
+        # written without moving the cursor (the history import) have to change it as well
+        cursor = self.session.query(ExtractionCursor).get(user_name)
+        if cursor is not None:
+            cursor.updated_at_utc = datetime.utcnow()
+        else:
+            latest_timestamp = self.get_cursor(user_name)
+            if latest_timestamp is not None:
+                self.session.add(ExtractionCursor(user_name=user_name, played_at_utc_timestamp=latest_timestamp))
+        self.session.commit()
+
+    def get_reference(self, model, id_):
+        # An instance of a catalog entity known to be in the database, without a query: from the identity map,
+        # or attached with only its primary key, the other columns are loaded on first access
+        instance = self.session.identity_map.get(model.__mapper__.identity_key_from_primary_key([id_]))
+        if instance is None:
+            instance = model(**{model.__mapper__.primary_key[0].key: id_})
+            make_transient_to_detached(instance)
+            self.session.add(instance)
+        return instance
+
+    def get_known_ids(self, model, ids):
+        result = {i for i in ids if known_ids.contains(model, i)}
+        unknown_ids = [i for i in ids if i not in result]
+        if unknown_ids:
+            primary_key = model.__mapper__.primary_key[0]
+            if model is Track:
+                rows = self.session.query(primary_key, *[getattr(Track, f) for f in AUDIO_FEATURES]).\
+                    filter(primary_key.in_(unknown_ids)).\
+                    all()
+                known_ids.add(Track, [row[0] for row in rows], [tuple(row[1:]) for row in rows])
+            else:
+                rows = self.session.query(primary_key).filter(primary_key.in_(unknown_ids)).all()
+                known_ids.add(model, [row[0] for row in rows])
+            result.update(row[0] for row in rows)
+        return result
+
+    def _insert_ignore(self, table, rows, returning):
+        # Multi-row INSERT ... ON CONFLICT DO NOTHING, returns the keys of the inserted rows
+        if not rows:
+            return set()
+        statement = insert(table).values(rows).on_conflict_do_nothing().returning(returning)
+        return {row[0] for row in self.session.execute(statement)}
+
+    def save_bulk(self, artists, albums, tracks, plays):
+        # Writes all instances in one transaction. Relationships are ignored, instead album.artist_ids
+        # and track.artist_ids are expected to hold the ids of the artists.
+        try:
+            self._insert_ignore(Artist.__table__, [to_row(a) for a in artists], Artist.artist_id)
+            new_album_ids = self._insert_ignore(Album.__table__, [to_row(a) for a in albums], Album.album_id)
+            self._insert_ignore(album_artists,
+                                [{'album_id': a.album_id, 'artist_id': artist_id}
+                                 for a in albums if a.album_id in new_album_ids for artist_id in a.artist_ids],
+                                album_artists.c.album_id)
+            new_track_ids = self._insert_ignore(Track.__table__, [to_row(t) for t in tracks], Track.track_id)
+            self._insert_ignore(track_artists,
+                                [{'track_id': t.track_id, 'artist_id': artist_id}
+                                 for t in tracks if t.track_id in new_track_ids for artist_id in t.artist_ids],
+                                track_artists.c.track_id)
+            new_play_timestamps = self._insert_ignore(Play.__table__,
+                                                      [to_row(p) for p in plays],
+                                                      Play.played_at_utc_timestamp)
+            if new_play_timestamps:
+                self.session.execute(
+                    REBUILD_ROLLUPS_SQL.format(where='WHERE t_play.played_at_utc_timestamp = ANY(:timestamps)',
+                                               on_conflict=ROLLUPS_ON_CONFLICT_ADD_SQL),
+                    {'timestamps': list(new_play_timestamps)})
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        known_ids.add(Artist, [a.artist_id for a in artists])
+        known_ids.add(Album, [a.album_id for a in albums])
+        known_ids.add(Track, [t.track_id for t in tracks], [audio_features_of(t) for t in tracks])
+        return len(new_play_timestamps), len(plays) - len(new_play_timestamps)
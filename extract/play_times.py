@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from dateutil import tz
+import numpy as np
+
+
+EPOCH = datetime(1970, 1, 1)
+US_PER_SECOND = 10 ** 6
+US_PER_MINUTE = 60 * US_PER_SECOND
+US_PER_HOUR = 60 * US_PER_MINUTE
+US_PER_DAY = 24 * US_PER_HOUR
+EPOCH_WEEKDAY = 3  # 1970-01-01 was a Thursday
+
+# Columns of Play derived from played_at, in the order of decompose_played_at
+PLAY_TIME_COLUMNS = ('played_at_utc_timestamp', 'played_at_utc', 'played_at_cet', 'day', 'month', 'year', 'hour',
+                     'minute', 'second', 'day_of_week', 'week_of_year')
+
+
+timezones = dict()
+
+
+def get_timezone(code):
+    # dateutil before 2.7 reads the zoneinfo file on every gettz call
+    timezone = timezones.get(code)
+    if timezone is None:
+        timezone = timezones[code] = tz.gettz(code)
+    return timezone
+
+
+def utc_offset(utc_us, timezone):
+    # Offset in microseconds at a UTC instant, through astimezone like the conversion of a single play
+    utc = (EPOCH + timedelta(microseconds=utc_us)).replace(tzinfo=get_timezone('UTC'))
+    return utc.astimezone(timezone).utcoffset() // timedelta(microseconds=1)
+
+
+def decompose_played_at(played_ats, timezone_code='CET'):
+    # The columns of SpotifyConnection.get_play_from_played_at_utc for many played_at strings of the recently
+    # played endpoint at once, as lists by column name with the same values and types.
+    #
+    # The UTC offset is looked up once per UTC day instead of once per play. Days on which the offset changes,
+    # and the days after them (ambiguous wall times right after a change belong to the later occurrence),
+    # are converted per play with astimezone. Zones are expected to change their offset at most once a day.
+    utc_timezone = get_timezone('UTC')
+    local_timezone = get_timezone(timezone_code)
+    if not all(p.endswith('Z') for p in played_ats):
+        raise ValueError('played_at has to be in UTC (ending with Z)')
+    utc = np.array([p[:-1] for p in played_ats], dtype='datetime64[us]')
+    utc_us = utc.astype(np.int64)
+
+    days = utc_us // US_PER_DAY
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    unique_days = unique_days.tolist()
+    starts = np.array([utc_offset(d * US_PER_DAY, local_timezone) for d in unique_days], dtype=np.int64)
+    ends = np.array([utc_offset((d + 1) * US_PER_DAY - 1, local_timezone) for d in unique_days], dtype=np.int64)
+    changes = starts != ends
+    exact_days = changes | np.isin(unique_days, np.array(unique_days)[changes] + 1)
+    local_us = utc_us + starts[inverse]
+
+    utc_datetimes = [d.replace(tzinfo=utc_timezone) for d in utc.tolist()]
+    local_datetimes = [d.replace(tzinfo=local_timezone) for d in local_us.astype('datetime64[us]').tolist()]
+    for i in np.flatnonzero(exact_days[inverse]).tolist():
+        local_datetimes[i] = utc_datetimes[i].astimezone(local_timezone)
+        local_us[i] = (local_datetimes[i].replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+
+    local = local_us.astype('datetime64[us]')
+    local_days = local.astype('datetime64[D]')
+    local_months = local.astype('datetime64[M]')
+    us_of_day = (local - local_days).astype(np.int64)
+    day_numbers = local_days.astype(np.int64)
+    day_of_week = (day_numbers + EPOCH_WEEKDAY) % 7
+    # ISO weeks belong to the year of their Thursday
+    thursdays = day_numbers - day_of_week + 3
+    iso_years = thursdays.astype('datetime64[D]').astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+
+    return OrderedDict([
+        # Float like datetime.timestamp() * 1000
+        ('played_at_utc_timestamp', ((utc_us / float(US_PER_SECOND)) * 1000).tolist()),
+        ('played_at_utc', utc_datetimes),
+        ('played_at_cet', local_datetimes),
+        ('day', ((local_days - local_months.astype('datetime64[D]')).astype(np.int64) + 1).tolist()),
+        ('month', (local_months.astype(np.int64) % 12 + 1).tolist()),
+        ('year', (local.astype('datetime64[Y]').astype(np.int64) + 1970).tolist()),
+        ('hour', (us_of_day // US_PER_HOUR).tolist()),
+        ('minute', (us_of_day // US_PER_MINUTE % 60).tolist()),
+        ('second', (us_of_day // US_PER_SECOND % 60).tolist()),
+        ('day_of_week', day_of_week.tolist()),
+        ('week_of_year', ((thursdays - iso_years) // 7 + 1).tolist()),
+    ])
@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from datetime import datetime
+import functools
+import json
+import threading
+import time
+
+
+# Stage of every profiled Spotify client and database method
+CLIENT_STAGES = {
+    '_get': 'paging',
+    'next': 'paging',
+    'track': 'catalog_fetch',
+    'tracks': 'catalog_fetch',
+    'album': 'catalog_fetch',
+    'albums': 'catalog_fetch',
+    'artist': 'catalog_fetch',
+    'artists': 'catalog_fetch',
+    'audio_features': 'catalog_fetch',
+}
+DB_STAGES = {
+    'get_cursor': 'db_read',
+    'get_known_ids': 'db_read',
+    'save_instance': 'db_write',
+    'save_play': 'db_write',
+    'save_bulk': 'db_write',
+    'save_cursor': 'db_write',
+    'touch_data_version': 'db_write',
+}
+STAGES = ('auth', 'paging', 'catalog_fetch', 'db_read', 'db_write')
+
+
+class NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+def profile_stage(profile, name):
+    # Context manager timing a stage of profile, does nothing without a profile
+    return profile.stage(name) if profile is not None else NO_STAGE
+
+
+class StageStats(object):
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.bytes = 0
+
+
+class StageContext(object):
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile._exit()
+        return False
+
+
+class UserProfile(object):
+
+    # Exclusive wall time, calls and response bytes per stage of one user run. Stages nest, e.g. a catalog
+    # fetch during a database write, and time is only counted for the innermost stage. A user run stays in
+    # one thread, so no locking is needed.
+
+    def __init__(self, user_name):
+        self.user_name = user_name
+        self.stages = OrderedDict((s, StageStats()) for s in STAGES)
+        self.stack = []  # [stage name, running since]
+        self.started = time.time()
+        self.seconds = None
+        self.result = None
+
+    def stage(self, name):
+        return StageContext(self, name)
+
+    def _enter(self, name):
+        now = time.time()
+        if self.stack:
+            parent = self.stack[-1]
+            self.stages[parent[0]].seconds += now - parent[1]
+        self.stack.append([name, now])
+        self.stages.setdefault(name, StageStats()).calls += 1
+
+    def _exit(self):
+        now = time.time()
+        name, running_since = self.stack.pop()
+        self.stages[name].seconds += now - running_since
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def add_bytes(self, name, count):
+        self.stages[name].bytes += count
+
+    def finish(self, result):
+        self.seconds = time.time() - self.started
+        self.result = result
+
+    def to_dict(self):
+        stages = OrderedDict((name, vars(s).copy()) for name, s in self.stages.items())
+        seconds = self.seconds if self.seconds is not None else time.time() - self.started
+        # Python code and ORM lookups outside of the profiled methods
+        stages['other'] = {'seconds': seconds - sum(s['seconds'] for s in stages.values()), 'calls': 0, 'bytes': 0}
+        return OrderedDict([('user_name', self.user_name),
+                            ('seconds', seconds),
+                            ('result', self.result),
+                            ('stages', stages)])
+
+
+class ProfiledProxy(object):
+
+    # Wraps the methods named in stages, all other attributes are passed through
+
+    def __init__(self, target, profile, stages, count_bytes):
+        self._target = target
+        self._profile = profile
+        self._stages = stages
+        self._count_bytes = count_bytes
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name not in self._stages:
+            return attribute
+        stage_name = self._stages[name]
+
+        @functools.wraps(attribute)
+        def wrapper(*args, **kwargs):
+            with self._profile.stage(stage_name):
+                result = attribute(*args, **kwargs)
+            if self._count_bytes and result is not None:
+                # Size of the JSON response as returned by Spotify, without whitespace
+                self._profile.add_bytes(stage_name, len(json.dumps(result, separators=(',', ':'))))
+            return result
+        return wrapper
+
+
+def profile_client(client, profile):
+    return ProfiledProxy(client, profile, CLIENT_STAGES, count_bytes=True) if profile is not None else client
+
+
+def profile_db(db, profile):
+    return ProfiledProxy(db, profile, DB_STAGES, count_bytes=False) if profile is not None else db
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.started_at = datetime.utcnow()
+        self.users = OrderedDict()
+        self.pool = None  # Stats of the connection pool at the end of the run
+        self.requests = None  # Stats of the Spotify request schedulers by client_id
+        self.lock = threading.Lock()
+
+    def user(self, user_name):
+        profile = UserProfile(user_name)
+        with self.lock:
+            self.users[user_name] = profile
+        return profile
+
+    def to_dict(self):
+        users = [p.to_dict() for p in self.users.values()]
+        totals = OrderedDict()
+        for user in users:
+            for name, s in user['stages'].items():
+                total = totals.setdefault(name, {'seconds': 0.0, 'calls': 0, 'bytes': 0})
+                for key in total:
+                    total[key] += s[key]
+        return OrderedDict([('started_at_utc', self.started_at.isoformat()),
+                            ('seconds', (datetime.utcnow() - self.started_at).total_seconds()),
+                            ('stages', totals),
+                            ('pool', self.pool),
+                            ('requests', self.requests),
+                            ('users', users)])
+
+    def print_summary(self):
+        data = self.to_dict()
+        print("Profile ({:.1f}s):".format(data['seconds']))
+        print("  {:<14} {:>9} {:>7} {:>12}".format('stage', 'seconds', 'calls', 'bytes'))
+        for name, s in data['stages'].items():
+            print("  {:<14} {:>9.2f} {:>7} {:>12}".format(name, s['seconds'], s['calls'], s['bytes']))
+
+    def write(self, path):
+        # One JSON document per line and run, so that runs of a cron job accumulate in one file
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.to_dict(), default=str) + '\n')
+        print("Profile appended to {}.".format(path))
@@ -0,0 +1,305 @@
+import functools
+import os
+import random
+import threading
+import time
+
+import requests
+from spotipy import Spotify
+from spotipy.client import SpotifyException
+
+
+# Request scheduler settings, read from the environment. Spotify does not publish its rate limit, it is
+# enforced per application (client_id), so all users of one client_id share one scheduler.
+# SPOTIFY_RATE           requests per second per client_id
+# SPOTIFY_BURST          requests that may be sent at once after an idle period
+# SPOTIFY_MAX_RETRIES    retries of a throttled or failed request before the user run fails
+# SPOTIFY_BREAKER        consecutive failed requests (5xx, connection errors) that open the circuit
+# SPOTIFY_BREAKER_RESET  seconds an open circuit rejects requests before a trial request is let through
+RATE_ENVIRON_KEY = 'SPOTIFY_RATE'
+BURST_ENVIRON_KEY = 'SPOTIFY_BURST'
+MAX_RETRIES_ENVIRON_KEY = 'SPOTIFY_MAX_RETRIES'
+BREAKER_ENVIRON_KEY = 'SPOTIFY_BREAKER'
+BREAKER_RESET_ENVIRON_KEY = 'SPOTIFY_BREAKER_RESET'
+
+# Methods of the Spotify client that send a request
+REQUEST_METHODS = ('_get', 'next', 'track', 'tracks', 'album', 'albums', 'artist', 'artists', 'audio_features')
+
+
+def retry_after(headers):
+    # Seconds of a Retry-After header, None if missing or an HTTP date
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(status):
+    # Throttling, server errors and connection failures (no status) are retried, client errors are not
+    return status is None or status == 429 or status >= 500
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, client_id, seconds):
+        super(CircuitOpenError, self).__init__(
+            'Spotify requests of {} are suspended for {:.0f}s after repeated failures'.format(client_id, seconds))
+        self.client_id = client_id
+        self.seconds = seconds
+
+
+class TokenBucket(object):
+
+    # rate tokens per second, at most burst. reserve() takes a token and returns the seconds until it may be
+    # used, so that the caller waits outside of the lock (or in the event loop of the asyncio extraction).
+    # Tokens can go negative, every reservation then queues behind the ones before it.
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()  # In the future while paused
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self):
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            ready_at = self.updated + max(0.0, -self.tokens) / self.rate
+            return max(0.0, ready_at - now)
+
+    def pause(self, seconds):
+        # After a 429 no request of the client_id may be sent for Retry-After seconds, and the bucket starts
+        # refilling from empty afterwards, so that the queued requests do not hit Spotify all at once
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            until = now + seconds
+            if until > self.updated:
+                self.tokens = min(self.tokens, 0.0)
+                self.updated = until
+
+
+class CircuitBreaker(object):
+
+    # Opens after threshold consecutive failed requests and rejects requests for reset_seconds. Then one
+    # trial request is let through (half open): its success closes the circuit, its failure opens it again.
+    # A trial without an outcome after reset_seconds (e.g. a cancelled request) is replaced by the next one.
+    # 429s count as successes, Spotify is reachable and the token bucket is paused for them instead.
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, reset_seconds=30.0, clock=time.time):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        # Seconds the circuit stays open, 0 if a request may be sent
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            now = self.clock()
+            started_at = self.opened_at if self.state == self.OPEN else self.trial_started_at
+            remaining = started_at + self.reset_seconds - now
+            if remaining > 0:
+                return remaining
+            self.state = self.HALF_OPEN
+            self.trial_started_at = now
+            return 0.0
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class SchedulerStats(object):
+
+    COUNTERS = ('sent', 'throttled', 'server_errors', 'connection_errors', 'retried', 'failed', 'rejected')
+
+    def __init__(self):
+        self.counts = dict((name, 0) for name in self.COUNTERS)
+        self.wait_seconds = 0.0  # Waiting for a token
+        self.backoff_seconds = 0.0  # Waiting for a retry
+        self.lock = threading.Lock()
+
+    def add(self, name, wait_seconds=0.0, backoff_seconds=0.0):
+        with self.lock:
+            self.counts[name] += 1
+            self.wait_seconds += wait_seconds
+            self.backoff_seconds += backoff_seconds
+
+    def to_dict(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['wait_seconds'] = self.wait_seconds
+            stats['backoff_seconds'] = self.backoff_seconds
+        return stats
+
+
+class RequestScheduler(object):
+
+    # Sends the Spotify requests of one client_id: at most rate per second, a 429 pauses all of them for its
+    # Retry-After, server and connection errors are retried with jittered exponential backoff and open the
+    # circuit when they persist. acquire(), succeeded() and failed() are the steps of one request for clients
+    # with their own request loop (async_extract), call() runs the whole loop for a blocking function.
+
+    def __init__(self, client_id=None, rate=10.0, burst=20, max_retries=5, backoff_base=0.5, backoff_max=30.0,
+                 breaker_threshold=5, breaker_reset_seconds=30.0, clock=time.time, sleep=time.sleep, seed=None):
+        self.client_id = client_id
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_seconds, clock)
+        self.stats = SchedulerStats()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+        self.rng = random.Random(seed)
+
+    def backoff(self, attempt):
+        # Full jitter, so that the retries of many users do not synchronize
+        return self.rng.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def acquire(self):
+        # Seconds to wait before the request may be sent, raises CircuitOpenError while the circuit is open
+        open_seconds = self.breaker.check()
+        if open_seconds:
+            self.stats.add('rejected')
+            raise CircuitOpenError(self.client_id, open_seconds)
+        wait = self.bucket.reserve()
+        self.stats.add('sent', wait_seconds=wait)
+        return wait
+
+    def succeeded(self):
+        self.breaker.success()
+
+    def failed(self, attempt, status=None, retry_after_seconds=None):
+        # Records a failed attempt (counted from 0) of a retryable request. Returns the seconds to wait before
+        # the next attempt, None when the retries are exhausted.
+        if status == 429:
+            self.stats.add('throttled')
+            self.breaker.success()
+            pause = retry_after_seconds if retry_after_seconds is not None else self.backoff(attempt)
+            self.bucket.pause(pause)
+            # Spread the retries of the requests that waited for the same Retry-After
+            delay = pause + self.rng.uniform(0, self.backoff_base)
+        else:
+            self.stats.add('server_errors' if status else 'connection_errors')
+            self.breaker.failure()
+            delay = self.backoff(attempt)
+        if attempt >= self.max_retries:
+            self.stats.add('failed')
+            return None
+        self.stats.add('retried', backoff_seconds=delay)
+        return delay
+
+    def aborted(self):
+        # Records an attempt that raised an unexpected error, e.g. a broken response body. It is not retried,
+        # but counts as a failure for the circuit.
+        self.stats.add('failed')
+        self.breaker.failure()
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.sleep(self.acquire())
+            try:
+                result = function(*args, **kwargs)
+            except SpotifyException as e:
+                if not is_retryable(e.http_status):
+                    # Spotify answered, e.g. 404 for an unknown ID
+                    self.succeeded()
+                    raise
+                delay = self.failed(attempt, e.http_status, retry_after(e.headers))
+                if delay is None:
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                delay = self.failed(attempt)
+                if delay is None:
+                    raise
+            except Exception:
+                self.aborted()
+                raise
+            else:
+                self.succeeded()
+                return result
+            self.sleep(delay)
+            attempt += 1
+
+
+def scheduler_options():
+    return {
+        'rate': float(os.environ.get(RATE_ENVIRON_KEY, 10.0)),
+        'burst': int(os.environ.get(BURST_ENVIRON_KEY, 20)),
+        'max_retries': int(os.environ.get(MAX_RETRIES_ENVIRON_KEY, 5)),
+        'breaker_threshold': int(os.environ.get(BREAKER_ENVIRON_KEY, 5)),
+        'breaker_reset_seconds': float(os.environ.get(BREAKER_RESET_ENVIRON_KEY, 30.0)),
+    }
+
+
+schedulers = dict()
+schedulers_lock = threading.Lock()
+
+
+def get_scheduler(client_id=None):
+    # One scheduler per client_id and process, shared by the worker threads of all its users
+    with schedulers_lock:
+        if client_id not in schedulers:
+            schedulers[client_id] = RequestScheduler(client_id, **scheduler_options())
+        return schedulers[client_id]
+
+
+class SingleAttemptSpotify(Spotify):
+
+    # spotipy 2.4 retries 429s and server errors of GET requests itself, sleeping Retry-After without jitter,
+    # and returns None once it gives up. The scheduler retries instead.
+
+    def _get(self, url, args=None, payload=None, **kwargs):
+        if args:
+            kwargs.update(args)
+        return self._internal_call('GET', url, payload, kwargs)
+
+
+class ScheduledProxy(object):
+
+    # Sends the requests of a Spotify client through a scheduler, all other attributes are passed through
+
+    def __init__(self, target, scheduler):
+        self._target = target
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name not in REQUEST_METHODS:
+            return attribute
+
+        @functools.wraps(attribute)
+        def wrapper(*args, **kwargs):
+            return self._scheduler.call(attribute, *args, **kwargs)
+        return wrapper
+
+
+def schedule_client(client, scheduler):
+    return ScheduledProxy(client, scheduler) if scheduler is not None else client
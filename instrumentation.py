@@ -0,0 +1,241 @@
+from collections import OrderedDict
+import functools
+import heapq
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+
+from api import AudioFeature, Counts, Histogram
+from models import db, Album, Artist, Track
+
+
+# Upper bounds (seconds) of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Statements per slow request in the log
+WORST_STATEMENTS = 3
+
+
+# Units and buckets the endpoints know. Units and buckets are taken from the URL, any other value is labelled
+# 'other', so that requests for made up units do not add series to /metrics.
+UNIT_LABELS = frozenset(Counts()._get_unit_mapping()) | frozenset(AudioFeature()._get_unit_mapping()) | \
+    frozenset(Histogram.BUCKETS)
+
+
+# Pool stats that only ever increase, all others are current values
+POOL_COUNTERS = ('connects', 'checkouts', 'invalidations')
+
+
+class RequestStats(object):
+
+    __slots__ = ('started', 'statement_started', 'statements', 'db_seconds', 'serialization_seconds',
+                 'serialization_depth', 'status', 'timings')
+
+    def __init__(self):
+        self.started = time.time()
+        self.statement_started = None
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.serialization_depth = 0  # to_dict calls nest, only the outermost is timed
+        self.status = None
+        self.timings = []  # (seconds, statement)
+
+
+class RouteMetrics(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.duration_seconds = 0.0
+        self.duration_buckets = [0] * len(DURATION_BUCKETS)
+
+
+class Metrics(object):
+
+    # Totals per (endpoint, unit, status) since the start of the process. Every worker process of
+    # gunicorn has its own totals, Prometheus sums them up per instance.
+
+    def __init__(self, pool_stats=None):
+        self.routes = OrderedDict()
+        self.pool_stats = pool_stats
+        self.lock = threading.Lock()
+
+    def record(self, labels, stats, duration):
+        with self.lock:
+            metrics = self.routes.get(labels)
+            if metrics is None:
+                metrics = self.routes[labels] = RouteMetrics()
+            metrics.requests += 1
+            metrics.statements += stats.statements
+            metrics.db_seconds += stats.db_seconds
+            metrics.serialization_seconds += stats.serialization_seconds
+            metrics.duration_seconds += duration
+            for n, upper_bound in enumerate(DURATION_BUCKETS):
+                if duration <= upper_bound:
+                    metrics.duration_buckets[n] += 1
+
+    def to_prometheus(self):
+        with self.lock:
+            routes = [(labels, vars(metrics).copy()) for labels, metrics in self.routes.items()]
+        lines = []
+        counters = (
+            ('requests', 'requests_total', 'Number of requests'),
+            ('statements', 'request_statements_total', 'Number of SQL statements executed by requests'),
+            ('db_seconds', 'request_db_seconds_total', 'Time spent executing SQL statements'),
+            ('serialization_seconds', 'request_serialization_seconds_total', 'Time spent in to_dict and JSON encoding'),
+        )
+        for attribute, name, help_text in counters:
+            lines.append('# HELP hoergewohnheiten_{} {}'.format(name, help_text))
+            lines.append('# TYPE hoergewohnheiten_{} counter'.format(name))
+            for labels, metrics in routes:
+                lines.append('hoergewohnheiten_{}{{{}}} {}'.format(name, format_labels(labels), metrics[attribute]))
+
+        lines.append('# HELP hoergewohnheiten_request_duration_seconds Request latency')
+        lines.append('# TYPE hoergewohnheiten_request_duration_seconds histogram')
+        for labels, metrics in routes:
+            for upper_bound, count in zip(DURATION_BUCKETS, metrics['duration_buckets']):
+                lines.append('hoergewohnheiten_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                    format_labels(labels), upper_bound, count))
+            lines.append('hoergewohnheiten_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                format_labels(labels), metrics['requests']))
+            lines.append('hoergewohnheiten_request_duration_seconds_sum{{{}}} {}'.format(
+                format_labels(labels), metrics['duration_seconds']))
+            lines.append('hoergewohnheiten_request_duration_seconds_count{{{}}} {}'.format(
+                format_labels(labels), metrics['requests']))
+
+        if self.pool_stats is not None:
+            for name, value in sorted(self.pool_stats.to_dict().items()):
+                kind = 'counter' if name in POOL_COUNTERS else 'gauge'
+                metric = 'hoergewohnheiten_db_pool_{}{}'.format(name, '_total' if kind == 'counter' else '')
+                lines.append('# TYPE {} {}'.format(metric, kind))
+                lines.append('{} {}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    endpoint, unit, status = labels
+    return 'endpoint="{}",unit="{}",status="{}"'.format(escape_label(endpoint), escape_label(unit), status)
+
+
+def unit_label(view_args):
+    # Empty for endpoints without a unit, e.g. plays and stats (whose units can be combined freely)
+    unit = view_args.get('unit') or view_args.get('bucket')
+    if unit is None:
+        return ''
+    return unit if unit in UNIT_LABELS else 'other'
+
+
+def get_request_stats():
+    if has_request_context():
+        return getattr(g, 'request_stats', None)
+    return None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = get_request_stats()
+    if stats is not None:
+        stats.statement_started = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = get_request_stats()
+    if stats is not None and stats.statement_started is not None:
+        seconds = time.time() - stats.statement_started
+        stats.statements += 1
+        stats.db_seconds += seconds
+        stats.timings.append((seconds, statement))
+
+
+def timed_serialization(to_dict):
+    @functools.wraps(to_dict)
+    def wrapper(*args, **kwargs):
+        stats = get_request_stats()
+        if stats is None:
+            return to_dict(*args, **kwargs)
+        stats.serialization_depth += 1
+        started = time.time()
+        try:
+            return to_dict(*args, **kwargs)
+        finally:
+            stats.serialization_depth -= 1
+            if not stats.serialization_depth:
+                stats.serialization_seconds += time.time() - started
+    return wrapper
+
+
+def timed_json_encoder(json_encoder):
+    class TimedJSONEncoder(json_encoder):
+        encode = timed_serialization(json_encoder.encode)
+    return TimedJSONEncoder
+
+
+class Instrumentation(object):
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+        self.slow_request_seconds = app.config['SLOW_REQUEST_SECONDS']
+
+    def before_request(self):
+        g.request_stats = RequestStats()
+
+    def after_request(self, response):
+        stats = get_request_stats()
+        if stats is not None:
+            stats.status = response.status_code
+        return response
+
+    def teardown_request(self, exception):
+        # Runs after streamed responses are consumed, so their duration includes the whole stream
+        stats = g.pop('request_stats', None)
+        if stats is None or request.endpoint in (None, 'static', 'metrics'):
+            return
+        duration = time.time() - stats.started
+        status = stats.status if exception is None else 500
+        self.metrics.record((request.endpoint, unit_label(request.view_args or dict()), status), stats, duration)
+        if duration >= self.slow_request_seconds:
+            self.log_slow_request(stats, duration)
+
+    def log_slow_request(self, stats, duration):
+        lines = ['Slow request {} {}: {:.3f}s, {} statements in {:.3f}s, serialization {:.3f}s'.format(
+            request.method, request.full_path, duration, stats.statements, stats.db_seconds,
+            stats.serialization_seconds)]
+        for seconds, statement in heapq.nlargest(WORST_STATEMENTS, stats.timings, key=lambda t: t[0]):
+            lines.append('  {:.3f}s {}'.format(seconds, ' '.join(statement.split())[:500]))
+        self.app.logger.warning('\n'.join(lines))
+
+    def metrics_view(self):
+        return Response(self.metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    # Only called with INSTRUMENTATION enabled, otherwise no hooks or listeners are installed at all
+    app.config.setdefault('SLOW_REQUEST_SECONDS', 1.0)
+    metrics = Metrics(app.extensions.get('pool_stats'))
+    instrumentation = Instrumentation(app, metrics)
+    app.extensions['instrumentation'] = instrumentation
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    app.before_request(instrumentation.before_request)
+    app.after_request(instrumentation.after_request)
+    app.teardown_request(instrumentation.teardown_request)
+
+    for model in (Artist, Album, Track):
+        model.to_dict = timed_serialization(model.to_dict)
+    app.json_encoder = timed_json_encoder(app.json_encoder)
+
+    app.add_url_rule('/metrics', 'metrics', instrumentation.metrics_view)
@@ -0,0 +1,297 @@
+from datetime import datetime
+import functools
+
+from sqlalchemy import Column, Date, DateTime, String, BigInteger, Integer, Float, ForeignKey, Index, JSON
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.schema import Table
+
+from cache import SerializationCache
+
+
+# Schema shared by the API (models.py, through Flask-SQLAlchemy) and the extraction script (extract/models.py)
+Base = declarative_base()
+
+
+AUDIO_FEATURES = ('tempo', 'energy', 'valence', 'key', 'loudness')
+
+
+serialization_cache = SerializationCache()
+
+
+def cache_key(instance):
+    return instance.__tablename__, instance.__mapper__.primary_key_from_instance(instance)[0]
+
+
+def cached_dict(to_dict):
+    # Builds the dict of a catalog entity once per process and serves it from serialization_cache afterwards.
+    # The extractor only inserts catalog rows, except for the audio features that --backfill-audio-features
+    # fills in later. Such changes of another process can not invalidate the cache, so dicts are only cached
+    # once they can not change anymore (dict_is_final).
+    @functools.wraps(to_dict)
+    def wrapper(self):
+        key = cache_key(self)
+        result = serialization_cache.get(key)
+        if result is None:
+            result = to_dict(self)
+            if getattr(self, 'dict_is_final', True):
+                serialization_cache.set(key, result)
+        return result
+    return wrapper
+
+
+def largest_image_url(images):
+    last_width = 0
+    url = None
+    for image in images:
+        if last_width < image['width']:
+            last_width = image['width']
+            url = image['url']
+    return url
+
+
+# Indexed by the entity that the artists are loaded for
+track_artists = Table('t_track_artists',
+                      Base.metadata,
+                      Column('track_id', String, ForeignKey('t_track.track_id'), index=True),
+                      Column('artist_id', String, ForeignKey('t_artist.artist_id')))
+
+
+album_artists = Table('t_album_artists',
+                      Base.metadata,
+                      Column('album_id', String, ForeignKey('t_album.album_id'), index=True),
+                      Column('artist_id', String, ForeignKey('t_artist.artist_id')))
+
+
+class Artist(Base):
+
+    # Meta
+    __tablename__ = 't_artist'
+    created_at_utc = Column(DateTime, default=datetime.utcnow)
+
+    # Payload
+    artist_id = Column(String, primary_key=True)
+    artist_data = Column(JSON, nullable=False)
+
+    @property
+    def image_url(self):
+        return largest_image_url(self.artist_data['images'])
+
+    @property
+    def artist_name(self):
+        return self.artist_data['name']
+
+    @property
+    def spotify_url(self):
+        return self.artist_data['external_urls']['spotify']
+
+    @cached_dict
+    def to_dict(self):
+        return {
+            'id': self.artist_id,
+            'name': self.artist_name,
+            'spotify_url': self.spotify_url,
+            'image_url': self.image_url,
+        }
+
+
+class Album(Base):
+
+    # Meta
+    __tablename__ = 't_album'
+    created_at_utc = Column(DateTime, default=datetime.utcnow)
+
+    # Payload
+    album_id = Column(String, primary_key=True)
+    album_data = Column(JSON, nullable=False)
+
+    # Relationships
+    artists = relationship('Artist', secondary=album_artists)
+    tracks = relationship('Track')
+
+    @property
+    def image_url(self):
+        return largest_image_url(self.album_data['images'])
+
+    @property
+    def spotify_url(self):
+        return self.album_data['external_urls']['spotify']
+
+    @property
+    def album_name(self):
+        return self.album_data['name']
+
+    @cached_dict
+    def to_dict(self):
+        return {
+            'id': self.album_id,
+            'name': self.album_name,
+            'spotify_url': self.spotify_url,
+            'artists': [a.to_dict() for a in self.artists],
+            'image_url': self.image_url,
+        }
+
+
+class Track(Base):
+
+    # Meta
+    __tablename__ = 't_track'
+    created_at_utc = Column(DateTime, default=datetime.utcnow)
+
+    # Payload
+    track_id = Column(String, primary_key=True, index=True)
+    album_id = Column(String, ForeignKey('t_album.album_id'), index=True)
+    track_data = Column(JSON, nullable=False)
+    # Only written, reads use the typed columns below, so it is not loaded with the track
+    audio_feature_data = deferred(Column(JSON))
+
+    # Audio features (copied from audio_feature_data for aggregations)
+    tempo = Column(Float)
+    energy = Column(Float)
+    valence = Column(Float)
+    key = Column(Float)
+    loudness = Column(Float)
+
+    # Relationships
+    plays = relationship('Play', back_populates='track')
+    album = relationship('Album', back_populates='tracks')
+    artists = relationship('Artist', secondary=track_artists)
+
+    @property
+    def duration(self):
+        return self.track_data['duration_ms']
+
+    @property
+    def track_name(self):
+        return self.track_data['name']
+
+    @property
+    def spotify_url(self):
+        return self.track_data['external_urls']['spotify']
+
+    @property
+    def dict_is_final(self):
+        # Tracks without audio features may get them from the backfill
+        return self.tempo is not None
+
+    @cached_dict
+    def to_dict(self):
+        return {
+            'id': self.track_id,
+            'name': self.track_name,
+            'spotify_url': self.spotify_url,
+            'duration': self.duration,
+            'audio_feature': {
+                'tempo': self.tempo,
+                'valence': self.valence,
+                'energy': self.energy,
+                'key': self.key,
+                'loudness': self.loudness,
+            },
+            'artists': [a.to_dict() for a in self.artists],
+            'album': self.album.to_dict(),
+        }
+
+
+def play_to_dict(play, track_dict):
+    # Works for Play instances and for rows of column-only queries
+    return {
+        'track': track_dict,
+        'played_at_cet': play.played_at_cet,
+    }
+
+
+class Play(Base):
+
+    # Meta
+    __tablename__ = 't_play'
+    created_at_utc = Column(DateTime, default=datetime.utcnow)
+
+    # Payload
+    played_at_utc_timestamp = Column(BigInteger, primary_key=True)
+    played_at_utc = Column(DateTime, nullable=False)
+    played_at_cet = Column(DateTime, nullable=False)
+    day = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    year = Column(Integer, nullable=False)
+    hour = Column(Integer, nullable=False)
+    minute = Column(Integer, nullable=False)
+    second = Column(Integer, nullable=False)
+    day_of_week = Column(Integer, nullable=False)  # Monday: 0, Sunday: 6
+    week_of_year = Column(Integer, nullable=False)
+    track_id = Column(String, ForeignKey('t_track.track_id'), index=True)
+    user_name = Column(String, nullable=False)
+
+    # Relationship
+    track = relationship('Track', back_populates='plays')
+
+    # Indexes
+    __table_args__ = (
+        # Range scans per user, e.g. latest plays and date filters
+        Index('ix_t_play_user_name_played_at_cet', 'user_name', 'played_at_cet'),
+        # Index-only scans for plays per track
+        Index('ix_t_play_user_name_played_at_cet_track_id', 'user_name', 'played_at_cet', 'track_id'),
+        # Keyset pagination of the play history
+        Index('ix_t_play_user_name_played_at_utc_timestamp', 'user_name', 'played_at_utc_timestamp'),
+    )
+
+    def to_dict(self, track_dict=None):
+        return play_to_dict(self, track_dict or self.track.to_dict())
+
+
+class PlayRollup(Base):
+
+    # Pre-aggregated plays per user and CET hour, maintained by the extractor
+    __tablename__ = 't_play_rollup'
+
+    # Key
+    user_name = Column(String, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    day = Column(Integer, primary_key=True)
+    hour = Column(Integer, primary_key=True)
+
+    # Denormalized for filtering and grouping
+    date_cet = Column(Date, nullable=False)
+    day_of_week = Column(Integer, nullable=False)  # Monday: 0, Sunday: 6
+
+    # Payload
+    play_count = Column(Integer, nullable=False, default=0)
+    audio_feature_count = Column(Integer, nullable=False, default=0)  # Plays of tracks with audio features
+    sum_tempo = Column(Float, nullable=False, default=0.0)
+    sum_energy = Column(Float, nullable=False, default=0.0)
+    sum_valence = Column(Float, nullable=False, default=0.0)
+    sum_key = Column(Float, nullable=False, default=0.0)
+    sum_loudness = Column(Float, nullable=False, default=0.0)
+
+    # Indexes
+    __table_args__ = (
+        Index('ix_t_play_rollup_user_name_date_cet', 'user_name', 'date_cet'),
+    )
+
+
+class ExtractionCursor(Base):
+
+    # High-water mark of the extracted plays per user, passed as `after` to recently-played
+    __tablename__ = 't_extraction_cursor'
+    updated_at_utc = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Payload
+    user_name = Column(String, primary_key=True)
+    played_at_utc_timestamp = Column(BigInteger, nullable=False)
+
+
+class ImportProgress(Base):
+
+    # Records of a streaming history file that are imported, so that an interrupted import resumes after them
+    __tablename__ = 't_import_progress'
+    updated_at_utc = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Key
+    user_name = Column(String, primary_key=True)
+    file_name = Column(String, primary_key=True)
+
+    # Payload
+    records = Column(BigInteger, nullable=False, default=0)
+    # Earliest play of the user before the first import, later records are left to the extraction
+    before_timestamp = Column(BigInteger)
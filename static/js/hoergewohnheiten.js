@@ -111,16 +111,10 @@ function applyTrackStats(topTracks) {
     }
 }
 
-function applyAlbum(stats) {
-    applyAlbumStats(stats.data)
-}
-
-function applyArtist(stats) {
-    applyArtistStats(stats.data)
-}
-
-function applyTrack(stats) {
-    applyTrackStats(stats.data)
+function applyStats(stats) {
+    applyTrackStats(stats.data.count.track.data)
+    applyArtistStats(stats.data.count.artist.data)
+    applyAlbumStats(stats.data.count.album.data)
 }
 
 
@@ -159,9 +153,7 @@ function applyData() {
     var toDate = url.searchParams.get('to')
     urlAppendix = getUrlAppendix(userName, fromDate, toDate)
 
-    get('counts/per/track/user/' + urlAppendix, applyTrack)
-    get('counts/per/artist/user/' + urlAppendix, applyArtist)
-    get('counts/per/album/user/' + urlAppendix, applyAlbum)
+    get('stats/user/' + urlAppendix + '?units=count:track,count:artist,count:album', applyStats)
 }
 
 $(document).ready(function () {
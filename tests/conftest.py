@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+import types
+
+from dateutil import tz
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+EXTRACT_DIR = os.path.join(ROOT_DIR, 'extract')
+sys.path.insert(0, ROOT_DIR)
+
+# The tests run on a throwaway SQLite database, or on the PostgreSQL database of TEST_DATABASE_URL. Its tables are
+# dropped after every test.
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL') or \
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+
+from app import app  # noqa: E402
+import api  # noqa: E402
+from models import db, serialization_cache, Artist, Album, Track, Play, ExtractionCursor  # noqa: E402
+
+# extract/ has its own models and settings modules. The modules of the extraction script are imported with
+# extract/ first on sys.path, then the models module of the API is put back for the API tests.
+api_models = sys.modules.pop('models')
+sys.modules['settings'] = types.ModuleType('settings')
+sys.modules['settings'].POSTGRES_CONNECTION_STRING = os.environ['DATABASE_URL']
+sys.modules['settings'].SPOTIFY_USERS = dict()
+sys.path.insert(0, EXTRACT_DIR)
+import main  # noqa: E402,F401
+import async_extract  # noqa: E402,F401
+extract_models = sys.modules['models']
+sys.modules['models'] = api_models
+sys.path.remove(EXTRACT_DIR)
+
+
+CET = tz.gettz('CET')
+
+postgresql_only = pytest.mark.skipif(not os.environ['DATABASE_URL'].startswith('postgresql'),
+                                     reason='Needs PostgreSQL, set TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def database():
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.drop_all()
+    api.response_cache.clear()
+    serialization_cache.clear()
+    extract_models.known_ids.ids.clear()
+
+
+@pytest.fixture
+def client(database):
+    return app.test_client()
+
+
+def image(url):
+    return {'url': url, 'width': 640, 'height': 640}
+
+
+def add_track(session, track_id, artist_id='artist', album_id='album', tempo=None):
+    # A track with its album and artist, the JSON holds what the to_dict methods read
+    if session.query(Artist).get(artist_id) is None:
+        session.add(Artist(artist_id=artist_id,
+                           artist_data={'name': artist_id, 'images': [image(artist_id)],
+                                        'external_urls': {'spotify': artist_id}}))
+    artist = session.query(Artist).get(artist_id)
+    if session.query(Album).get(album_id) is None:
+        session.add(Album(album_id=album_id,
+                          album_data={'name': album_id, 'images': [image(album_id)],
+                                      'external_urls': {'spotify': album_id}},
+                          artists=[artist]))
+    track = Track(track_id=track_id, album_id=album_id, artists=[artist],
+                  track_data={'name': track_id, 'duration_ms': 180000, 'external_urls': {'spotify': track_id}})
+    if tempo is not None:
+        track.tempo, track.energy, track.valence, track.key, track.loudness = tempo, 0.5, 0.5, 5.0, -5.0
+    session.add(track)
+    session.commit()
+    return track
+
+
+def add_play(session, user_name, track_id, played_at_utc):
+    played_at_cet = played_at_utc.replace(tzinfo=tz.tzutc()).astimezone(CET).replace(tzinfo=None)
+    play = Play(user_name=user_name,
+                track_id=track_id,
+                played_at_utc_timestamp=int((played_at_utc - datetime(1970, 1, 1)).total_seconds() * 1000),
+                played_at_utc=played_at_utc,
+                played_at_cet=played_at_cet,
+                day=played_at_cet.day,
+                month=played_at_cet.month,
+                year=played_at_cet.year,
+                hour=played_at_cet.hour,
+                minute=played_at_cet.minute,
+                second=played_at_cet.second,
+                day_of_week=played_at_cet.weekday(),
+                week_of_year=played_at_cet.isocalendar()[1])
+    session.add(play)
+    session.commit()
+    return play
+
+
+def set_data_version(session, user_name, updated_at_utc):
+    cursor = session.query(ExtractionCursor).get(user_name)
+    if cursor is None:
+        cursor = ExtractionCursor(user_name=user_name, played_at_utc_timestamp=0)
+        session.add(cursor)
+    cursor.updated_at_utc = updated_at_utc
+    session.commit()
+
+
+def hours(start, count):
+    return [start + timedelta(hours=n) for n in range(count)]
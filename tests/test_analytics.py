@@ -0,0 +1,91 @@
+from datetime import datetime
+import json
+
+import pytest
+
+import analytics
+import api
+from app import app
+from conftest import add_play, add_track, extract_models, hours
+
+
+def test_reloads_plays_older_than_the_loaded_ones(database):
+    session = database.session
+    add_track(session, 'track')
+    for played_at in hours(datetime(2018, 3, 10, 12), 3):
+        add_play(session, 'user', 'track', played_at)
+    engine = analytics.AnalyticsEngine()
+    assert engine.count_entities('track', 'user', 1, datetime(2018, 1, 1), datetime(2019, 1, 1), 10) == [(3, 'track')]
+
+    # Imported from the streaming history, before all extracted plays
+    for played_at in hours(datetime(2017, 3, 10, 12), 2):
+        add_play(session, 'user', 'track', played_at)
+    add_play(session, 'user', 'track', datetime(2018, 3, 11, 12))
+    assert engine.count_entities('track', 'user', 2, datetime(2017, 1, 1), datetime(2019, 1, 1), 10) == [(6, 'track')]
+
+
+def test_refreshes_backfilled_audio_features(database):
+    session = database.session
+    track = add_track(session, 'track')
+    add_play(session, 'user', 'track', datetime(2018, 3, 10, 12))
+    engine = analytics.AnalyticsEngine()
+    rows = engine.aggregate_buckets('hour', 'user', 1, datetime(2018, 1, 1), datetime(2019, 1, 1))
+    assert rows[0].avg_tempo is None
+
+    track.tempo, track.energy, track.valence, track.key, track.loudness = 120.0, 0.5, 0.5, 5.0, -5.0
+    session.commit()
+    rows = engine.aggregate_buckets('hour', 'user', 2, datetime(2018, 1, 1), datetime(2019, 1, 1))
+    assert rows[0].avg_tempo == 120.0
+
+
+def test_skips_plays_without_a_known_track(database):
+    session = database.session
+    add_track(session, 'track')
+    add_play(session, 'user', 'track', datetime(2018, 3, 10, 12))
+    add_play(session, 'user', None, datetime(2018, 3, 10, 13))
+    add_play(session, 'user', 'deleted', datetime(2018, 3, 10, 14))
+    engine = analytics.AnalyticsEngine()
+    assert engine.count_entities('track', 'user', 1, datetime(2018, 1, 1), datetime(2019, 1, 1), 10) == [(1, 'track')]
+
+    add_play(session, 'user', 'track', datetime(2018, 3, 10, 15))
+    assert engine.count_entities('track', 'user', 2, datetime(2018, 1, 1), datetime(2019, 1, 1), 10) == [(2, 'track')]
+
+
+DATES = 'from/2018-12-28/to/2019-01-02'
+ROUTES = ['/counts/per/{}/user/user/{}'.format(unit, DATES) for unit in api.Counts()._get_unit_mapping()] + \
+    ['/audiofeatures/per/{}/user/user/{}'.format(unit, DATES) for unit in api.AudioFeature()._get_unit_mapping()] + \
+    ['/stats/user/user/{}?units={}'.format(DATES, ','.join(
+        ['count:{}'.format(unit) for unit in api.Counts()._get_unit_mapping()] +
+        ['audio_feature:{}'.format(unit) for unit in api.AudioFeature()._get_unit_mapping()]))]
+
+
+def add_plays_and_rollups(session):
+    # Around the turn of the year (ISO week 52 to week 1), with tracks, albums and artists played equally often and
+    # a track without audio features. Albums and artists are not in the order of their tracks.
+    for track_id, album_id, artist_id, tempo in [('b', 'album_b', 'artist_b', 100.0),
+                                                 ('a', 'album_c', 'artist_c', 120.0),
+                                                 ('c', 'album_a', 'artist_a', None)]:
+        add_track(session, track_id, artist_id=artist_id, album_id=album_id, tempo=tempo)
+    # 10 plays of every track in the date range, one before and one after
+    played_at = hours(datetime(2018, 12, 20, 12), 1) + hours(datetime(2018, 12, 28), 24 * 5)[::4] + \
+        hours(datetime(2019, 1, 3, 12), 1)
+    plays = [add_play(session, 'user', 'bac'[n % 3], p) for n, p in enumerate(played_at)]
+    connection = extract_models.PostgreSQLConnection()
+    for play in plays:
+        connection.add_play_to_rollup(play)
+    connection.session.commit()
+    connection.close()
+
+
+@pytest.mark.parametrize('path', ROUTES)
+def test_backends_answer_alike(client, database, monkeypatch, path):
+    add_plays_and_rollups(database.session)
+    responses = []
+    for engine in (None, analytics.AnalyticsEngine()):
+        monkeypatch.setitem(app.extensions, 'analytics', engine)
+        api.response_cache.clear()
+        response = client.get(path)
+        assert response.status_code == 200
+        responses.append(json.loads(response.get_data(as_text=True)))
+    assert responses[0] == responses[1]
+    assert responses[0]['data']
@@ -0,0 +1,114 @@
+from datetime import date, datetime, timedelta
+import json
+
+import pytest
+from sqlalchemy import event, literal, select
+
+import api
+from conftest import add_play, add_track, set_data_version
+
+
+class StatementCounter(object):
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = 0
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+        return False
+
+
+def add_user_plays(session, user_name, track_count, start):
+    # One play per track, every track with its own album and artist
+    for n in range(track_count):
+        track_id = '{}_track_{}'.format(user_name, n)
+        add_track(session, track_id, artist_id='{}_artist_{}'.format(user_name, n),
+                  album_id='{}_album_{}'.format(user_name, n))
+        add_play(session, user_name, track_id, start + timedelta(hours=n))
+
+
+@pytest.mark.parametrize('path', ['/plays/user/{}',
+                                  '/plays/history/user/{}',
+                                  '/counts/per/track/user/{}/from/2018-03-01/to/2018-03-31',
+                                  '/counts/per/album/user/{}/from/2018-03-01/to/2018-03-31',
+                                  '/counts/per/artist/user/{}/from/2018-03-01/to/2018-03-31',
+                                  '/stats/user/{}/from/2018-03-01/to/2018-03-31?units=count:track,count:artist'])
+def test_statements_per_request_do_not_grow_with_the_entities(client, database, path):
+    statements = []
+    for user_name, track_count, start in (('few', 2, datetime(2018, 3, 1)), ('many', 20, datetime(2018, 3, 2))):
+        add_user_plays(database.session, user_name, track_count, start)
+        database.session.remove()
+        with StatementCounter(database.engine) as counter:
+            response = client.get(path.format(user_name))
+            assert response.status_code == 200
+            response.get_data()
+        statements.append(counter.statements)
+    assert statements[0] == statements[1]
+
+
+@pytest.mark.parametrize('bucket', sorted(api.ROLLUP_BUCKETS))
+def test_rollup_statement_text_only_depends_on_the_bucket(database, bucket):
+    first = api.rollup_select(bucket, 'few', datetime(2018, 1, 1), datetime(2018, 2, 1)).compile(database.engine)
+    second = api.rollup_select(bucket, 'many', datetime(2017, 6, 1), datetime(2018, 6, 1)).compile(database.engine)
+    assert str(first) == str(second)
+    assert first.params != second.params
+    assert 'few' not in str(first) and '2018' not in str(first)
+
+
+@pytest.mark.parametrize('day', [date(2018, 1, 1), date(2018, 12, 30), date(2018, 12, 31), date(2020, 12, 31),
+                                 date(2021, 1, 3), date(2021, 1, 4), date(2022, 1, 1)])
+def test_week_bucket_is_the_iso_week(database, day):
+    week = database.session.execute(select([api.iso_week(literal(day, database.Date))])).scalar()
+    assert week == day.isocalendar()[1]
+
+
+def get_track_counts(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    return [(c['count'], c['track']['id']) for c in json.loads(response.get_data(as_text=True))['data']]
+
+
+def test_cached_past_ranges_follow_the_data_version(client, database):
+    session = database.session
+    add_track(session, 'track')
+    add_play(session, 'user', 'track', datetime(2018, 3, 10, 12))
+    set_data_version(session, 'user', datetime(2018, 3, 10, 13))
+    path = '/counts/per/track/user/user/from/2018-03-01/to/2018-03-31'
+    assert get_track_counts(client, path) == [(1, 'track')]
+
+    # Imported from the streaming history
+    add_play(session, 'user', 'track', datetime(2018, 3, 9, 12))
+    assert get_track_counts(client, path) == [(1, 'track')]
+    set_data_version(session, 'user', datetime(2018, 3, 11))
+    assert get_track_counts(client, path) == [(2, 'track')]
+
+
+def test_ends_in_past_uses_cet_dates():
+    today = datetime.now(api.CET).date()
+    assert api.ends_in_past((today - timedelta(days=1)).isoformat())
+    assert not api.ends_in_past(today.isoformat())
+    assert not api.ends_in_past(None)
+
+
+def test_backfilled_audio_features_reach_cached_tracks(client, database):
+    session = database.session
+    add_track(session, 'track')
+    add_play(session, 'user', 'track', datetime(2018, 3, 10, 12))
+    set_data_version(session, 'user', datetime(2018, 3, 10, 13))
+    response = client.get('/plays/user/user')
+    assert json.loads(response.get_data(as_text=True))['latest_plays'][0]['track']['audio_feature']['tempo'] is None
+
+    # --backfill-audio-features updates the tracks with SQL in the extractor
+    session.execute("UPDATE t_track SET tempo = 120.0, energy = 0.5, valence = 0.5, key = 5.0, loudness = -5.0")
+    session.commit()
+    set_data_version(session, 'user', datetime(2018, 3, 11))
+    response = client.get('/plays/user/user')
+    assert json.loads(response.get_data(as_text=True))['latest_plays'][0]['track']['audio_feature']['tempo'] == 120.0
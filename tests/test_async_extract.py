@@ -0,0 +1,126 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import unused_port
+
+import async_extract
+import main
+from rate_limit import RequestScheduler
+
+
+class FakeSpotifyServer(object):
+
+    # The endpoints of the Spotify Web API that the asyncio extraction requests, with play_count plays of
+    # track_count tracks. Every throttle_every-th request is answered with a 429 and a Retry-After of 0.
+
+    PAGE_SIZE = 50
+
+    def __init__(self, play_count, track_count, throttle_every=3):
+        self.play_count = play_count
+        self.track_count = track_count
+        self.throttle_every = throttle_every
+        self.requests = 0
+        self.throttled = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v1/me/player/recently-played', self.recently_played)
+        app.router.add_get('/v1/tracks', self.catalog('tracks', self.track))
+        app.router.add_get('/v1/albums', self.catalog('albums', self.album))
+        app.router.add_get('/v1/artists', self.catalog('artists', self.artist))
+        app.router.add_get('/v1/audio-features', self.catalog('audio_features', self.audio_features))
+        return app
+
+    def _throttle(self):
+        self.requests += 1
+        if self.requests % self.throttle_every == 0:
+            self.throttled += 1
+            return web.Response(status=429, headers={'Retry-After': '0'})
+        return None
+
+    def track(self, track_id):
+        n = int(track_id.split('_')[1])
+        return {'id': track_id, 'name': track_id, 'duration_ms': 180000,
+                'album': {'id': 'album_{}'.format(n % 5)}, 'artists': [{'id': 'artist_{}'.format(n % 7)}]}
+
+    def album(self, album_id):
+        n = int(album_id.split('_')[1])
+        return {'id': album_id, 'name': album_id, 'artists': [{'id': 'artist_{}'.format(n + 7)}]}
+
+    def artist(self, artist_id):
+        return {'id': artist_id, 'name': artist_id}
+
+    def audio_features(self, track_id):
+        return {'id': track_id, 'tempo': 120.0, 'energy': 0.5, 'valence': 0.5, 'key': 5, 'loudness': -5.0}
+
+    async def recently_played(self, request):
+        throttled = self._throttle()
+        if throttled:
+            return throttled
+        offset = int(request.query.get('offset', 0))
+        start = datetime(2018, 3, 1)
+        items = [{'played_at': (start + timedelta(minutes=n)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                  'track': {'id': 'track_{}'.format(n % self.track_count)}}
+                 for n in range(offset, min(offset + self.PAGE_SIZE, self.play_count))]
+        next_offset = offset + self.PAGE_SIZE
+        next_url = str(request.url.with_query({'offset': next_offset})) if next_offset < self.play_count else None
+        return web.json_response({'items': items, 'next': next_url})
+
+    def catalog(self, key, payload):
+        async def handler(request):
+            throttled = self._throttle()
+            if throttled:
+                return throttled
+            return web.json_response({key: [payload(i) for i in request.query['ids'].split(',')]})
+        return handler
+
+
+def test_extracts_all_plays_through_throttled_requests(database):
+    server = FakeSpotifyServer(play_count=120, track_count=40)
+    spotify = main.SpotifyConnection({'user_name': 'user'}, client=object())
+    scheduler = RequestScheduler(rate=1000.0, burst=1000, max_retries=20, backoff_base=0.01, breaker_threshold=100)
+    saved = []
+
+    def save_plays_bulk(play_tuples):
+        # save_bulk inserts with PostgreSQL's ON CONFLICT, here the plays and prefetched responses are kept instead
+        saved.append((play_tuples, spotify.track_responses, spotify.audio_feature_responses,
+                      spotify.album_responses, spotify.artist_responses))
+        return len(play_tuples), 0, 0, 0
+    spotify.save_plays_bulk = save_plays_bulk
+
+    async def extract(loop, executor, port):
+        runner = web.AppRunner(server.app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                client = async_extract.AsyncSpotifyClient(session, 'token', scheduler,
+                                                          'http://127.0.0.1:{}/v1/'.format(port))
+                result = await async_extract.AsyncUserExtraction(spotify, client, loop, executor).run()
+                return result, client
+        finally:
+            await runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        result, client = loop.run_until_complete(extract(loop, executor, unused_port()))
+    finally:
+        executor.submit(spotify.db.close).result()  # In the thread that used the session
+        executor.shutdown()
+        loop.close()
+
+    assert result == (120, 0, 0, 0)
+    # Every response that save_plays_bulk needs was prefetched, none is requested one by one
+    play_tuples, tracks, audio_features, albums, artists = saved[0]
+    assert len(play_tuples) == 120
+    assert set(tracks) == set(audio_features) == set(track_id for _, track_id in play_tuples)
+    assert len(tracks) == 40 and len(albums) == 5 and len(artists) == 7 + 5
+    assert server.throttled > 0
+    assert client.throttled == server.throttled
+    assert client.retried == server.throttled
+    assert scheduler.stats.counts['throttled'] == server.throttled
+    assert scheduler.stats.counts['failed'] == 0
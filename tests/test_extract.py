@@ -0,0 +1,163 @@
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+
+import main
+from conftest import add_track, postgresql_only
+from models import ExtractionCursor, Play, PlayRollup
+
+
+class RecentlyPlayed(object):
+
+    # Answers recently-played with one page of items, the tracks are expected in the database
+
+    def __init__(self, play_tuples):
+        self.play_tuples = play_tuples
+
+    def _get(self, url, **kwargs):
+        return {'items': [{'played_at': p, 'track': {'id': t}} for p, t in self.play_tuples]}
+
+    def next(self, response):
+        return None
+
+    def tracks(self, track_ids):
+        return {'tracks': [{'id': i, 'name': i, 'album': {'id': 'album'}, 'artists': [{'id': 'artist'}]}
+                           for i in track_ids]}
+
+    def audio_features(self, track_ids):
+        return [None for _ in track_ids]
+
+
+def timestamp(played_at_utc):
+    return (played_at_utc - datetime(1970, 1, 1)).total_seconds() * 1000
+
+
+def make_connection(play_tuples, user_name='user'):
+    return main.SpotifyConnection({'user_name': user_name}, client=RecentlyPlayed(play_tuples))
+
+
+def test_cursor_stops_before_the_first_failed_play(database, monkeypatch):
+    add_track(database.session, 'track')
+    # Newest first, like Spotify
+    spotify = make_connection([('2018-03-10T14:00:00.000Z', 'track'),
+                               ('2018-03-10T13:00:00.000Z', 'track'),
+                               ('2018-03-10T12:00:00.000Z', 'track')])
+    add_play_to_rollup = spotify.db.add_play_to_rollup
+
+    def fail_at_13(play):
+        if play.hour == 14:  # CET, 13:00 UTC
+            raise InvalidRequestError('Failed')
+        add_play_to_rollup(play)
+    monkeypatch.setattr(spotify.db, 'add_play_to_rollup', fail_at_13)
+
+    assert spotify.extract_plays() == (1, 0, 1, 1)
+    spotify.db.close()
+    cursor = database.session.query(ExtractionCursor).get('user')
+    assert cursor.played_at_utc_timestamp == timestamp(datetime(2018, 3, 10, 12))
+    assert database.session.query(Play).count() == 1
+
+
+def test_cursor_advances_over_known_plays(database):
+    add_track(database.session, 'track')
+    spotify = make_connection([('2018-03-10T12:00:00.000Z', 'track')])
+    assert spotify.extract_plays() == (1, 0, 0, 0)
+    spotify.db.close()
+
+    spotify = make_connection([('2018-03-10T13:00:00.000Z', 'track'), ('2018-03-10T12:00:00.000Z', 'track')])
+    assert spotify.extract_plays() == (1, 1, 0, 0)
+    spotify.db.close()
+    cursor = database.session.query(ExtractionCursor).get('user')
+    assert cursor.played_at_utc_timestamp == timestamp(datetime(2018, 3, 10, 13))
+
+
+def extract_recording_statements(spotify):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(spotify.db.engine, 'before_cursor_execute', record)
+    try:
+        result = spotify.extract_plays()
+    finally:
+        event.remove(spotify.db.engine, 'before_cursor_execute', record)
+        spotify.db.close()
+    return result, statements
+
+
+def test_known_albums_and_artists_are_not_queried_again(database):
+    add_track(database.session, 'track', tempo=120.0)
+    result, statements = extract_recording_statements(make_connection([('2018-03-10T12:00:00.000Z', 'new_track')]))
+    assert result == (1, 0, 0, 0)
+    # Only the lookups of the unknown IDs by prefetch, and of the new track before it is saved
+    assert len([s for s in statements if 'FROM t_album' in s]) == 1
+    assert len([s for s in statements if 'FROM t_artist' in s]) == 1
+    assert len([s for s in statements if 'FROM t_track' in s]) == 2
+    track = database.session.query(Play).one().track
+    assert (track.album.album_id, [a.artist_id for a in track.artists]) == ('album', ['artist'])
+
+    # Known tracks are referenced, their audio features for the rollup come with the lookup by prefetch
+    result, statements = extract_recording_statements(make_connection([('2018-03-10T12:10:00.000Z', 'new_track'),
+                                                                       ('2018-03-10T12:20:00.000Z', 'track')]))
+    assert result == (2, 0, 0, 0)
+    assert len([s for s in statements if 'FROM t_track' in s]) == 1
+    rollup = database.session.query(PlayRollup).one()
+    assert (rollup.play_count, rollup.audio_feature_count, rollup.sum_tempo) == (3, 1, 120.0)
+
+
+def test_plays_are_added_to_the_rollup_without_reading_it(database):
+    add_track(database.session, 'track', tempo=120.0)
+    add_track(database.session, 'other_track')
+    statements = []
+    # Two runs of the same user, e.g. overlapping cron runs, write to the same hour
+    for play_tuples in ([('2018-03-10T12:10:00.000Z', 'track')],
+                        [('2018-03-10T12:20:00.000Z', 'track'), ('2018-03-10T12:30:00.000Z', 'other_track')]):
+        statements.extend(extract_recording_statements(make_connection(play_tuples))[1])
+    assert not [s for s in statements if 'FROM t_play_rollup' in s]
+    rollup = database.session.query(PlayRollup).one()
+    assert (rollup.hour, rollup.play_count, rollup.audio_feature_count) == (13, 3, 2)
+    assert (rollup.sum_tempo, rollup.sum_loudness) == (240.0, -10.0)
+
+
+def test_summary_reports_failed_plays_apart_from_known_ones(capsys):
+    main.print_summary({'user': {'seconds': 1.0, 'inserted': 1, 'skipped': 2, 'failed': 1, 'not_attempted': 3,
+                                 'error': None}})
+    assert capsys.readouterr().out.splitlines()[-1] == \
+        "* user: 1.0s, 1 plays inserted, 2 plays skipped, 1 plays failed, 3 plays not attempted"
+
+
+def rollup_rows(session, user_name):
+    return sorted((r.year, r.month, r.day, r.hour, r.date_cet, r.day_of_week, r.play_count, r.audio_feature_count,
+                   r.sum_tempo, r.sum_energy, r.sum_valence, r.sum_key, r.sum_loudness)
+                  for r in session.query(PlayRollup).filter(PlayRollup.user_name == user_name))
+
+
+@postgresql_only
+def test_bulk_saves_the_same_plays_and_rollups_as_per_row(database):
+    add_track(database.session, 'track', tempo=120.0)
+    add_track(database.session, 'other_track')
+    runs = [[('2018-03-10T12:10:00.000Z', 'track'),
+             ('2018-03-10T12:20:00.000Z', 'other_track'),
+             ('2018-03-10T13:10:00.000Z', 'new_track')],
+            # Known plays again, two of them in an hour that has a rollup already
+            [('2018-03-10T12:10:00.000Z', 'track'),
+             ('2018-03-10T12:30:00.000Z', 'track'),
+             ('2018-03-10T13:10:00.000Z', 'new_track'),
+             ('2018-03-11T08:00:00.000Z', 'other_track')]]
+    results = dict()
+    for user_name, bulk in (('per_row', False), ('bulk', True)):
+        results[user_name] = []
+        for play_tuples in runs:
+            spotify = make_connection(play_tuples, user_name=user_name)
+            try:
+                results[user_name].append(spotify.extract_plays_bulk() if bulk else spotify.extract_plays())
+            finally:
+                spotify.db.close()
+    assert results['per_row'] == results['bulk'] == [(3, 0, 0, 0), (2, 2, 0, 0)]
+    plays = dict()
+    for user_name in results:
+        plays[user_name] = sorted((p.played_at_utc_timestamp, p.played_at_cet, p.track_id, p.hour, p.week_of_year)
+                                  for p in database.session.query(Play).filter(Play.user_name == user_name))
+    assert plays['per_row'] == plays['bulk']
+    assert rollup_rows(database.session, 'per_row') == rollup_rows(database.session, 'bulk')
+    assert [row[6:9] for row in rollup_rows(database.session, 'bulk')] == [(3, 2, 240.0), (1, 0, 0.0), (1, 0, 0.0)]
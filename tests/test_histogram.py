@@ -0,0 +1,44 @@
+from datetime import datetime
+
+from flask import json
+import pytest
+
+from conftest import add_play, add_track, postgresql_only
+
+
+@pytest.mark.parametrize('url', ['/histogram/per/minute/user/user',
+                                 '/histogram/per/day/user/user?tz=Mars/Olympus_Mons'])
+def test_unknown_buckets_and_time_zones_are_rejected(client, url):
+    response = client.get(url)
+    assert response.status_code == 400
+    assert 'Unknown' in json.loads(response.get_data())['message']
+
+
+@postgresql_only
+def test_buckets_follow_the_time_zone_across_daylight_saving_time(client, database):
+    # New York switched from EST (UTC-5) to EDT (UTC-4) at 2018-03-11 02:00 local time
+    session = database.session
+    add_track(session, 'track')
+    for played_at_utc in (datetime(2018, 3, 11, 4, 30),  # 2018-03-10 23:30 EST
+                          datetime(2018, 3, 11, 5, 30),  # 2018-03-11 00:30 EST
+                          datetime(2018, 3, 11, 6, 50),  # 2018-03-11 01:50 EST
+                          datetime(2018, 3, 11, 7, 10),  # 2018-03-11 03:10 EDT
+                          datetime(2018, 3, 12, 3, 30),  # 2018-03-11 23:30 EDT
+                          datetime(2018, 3, 12, 4, 30)):  # 2018-03-12 00:30 EDT
+        add_play(session, 'user', 'track', played_at_utc)
+
+    def histogram(bucket, from_date, to_date):
+        response = client.get('/histogram/per/{}/user/user/from/{}/to/{}?tz=America/New_York'.format(
+            bucket, from_date, to_date))
+        assert response.status_code == 200
+        return json.loads(response.get_data())['data']
+
+    assert histogram('day', '2018-03-10', '2018-03-12') == {'2018-03-10T00:00:00': 1,
+                                                            '2018-03-11T00:00:00': 4,
+                                                            '2018-03-12T00:00:00': 1}
+    assert histogram('15min', '2018-03-11', '2018-03-11') == {'2018-03-11T00:30:00': 1,
+                                                              '2018-03-11T01:45:00': 1,
+                                                              '2018-03-11T03:00:00': 1,
+                                                              '2018-03-11T23:30:00': 1}
+    # The day range is taken in local time, so the play at 23:30 EST is left out
+    assert histogram('day', '2018-03-11', '2018-03-11') == {'2018-03-11T00:00:00': 4}
@@ -0,0 +1,187 @@
+from datetime import datetime, timedelta
+import io
+import json
+
+import pytest
+
+import history_import
+import main
+from conftest import add_play, add_track, postgresql_only
+from models import ImportProgress, Play
+
+
+ELEMENTS = [{'ts': '2017-01-11T15:06:31Z', 'name': 'a]b,c', 'nested': [1, {'x': '"]'}]},
+            12345, -1.5e3, 'plain ] and , in a string', ['[', ']'], True, False, None, {}, []]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64])
+def test_json_array_across_chunk_boundaries(chunk_size):
+    text = json.dumps(ELEMENTS)
+    assert list(history_import.iter_json_array(io.StringIO(text), chunk_size=chunk_size)) == ELEMENTS
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 64])
+def test_json_array_with_whitespace_between_elements(chunk_size):
+    text = ' \n[\n  1 ,\t2\r\n,{"a" : [ 3 ]}  ,\n"4"\n]\n '
+    assert list(history_import.iter_json_array(io.StringIO(text), chunk_size=chunk_size)) == [1, 2, {'a': [3]}, '4']
+
+
+@pytest.mark.parametrize('text', ['[]', ' [ \n ] '])
+def test_empty_json_array(text):
+    assert list(history_import.iter_json_array(io.StringIO(text), chunk_size=1)) == []
+
+
+@pytest.mark.parametrize('text', ['', '[', '[1, 2', '[1, 2,', '[{"ts": "2017', '[123', '{"a": 1}', '[1 2]'])
+def test_truncated_or_invalid_json_array(text):
+    with pytest.raises(ValueError):
+        list(history_import.iter_json_array(io.StringIO(text), chunk_size=2))
+
+
+class Catalog(object):
+
+    # Answers the multi-ID endpoints for any ID, tracks in unavailable with null
+
+    def __init__(self, unavailable=()):
+        self.unavailable = unavailable
+
+    def tracks(self, track_ids):
+        return {'tracks': [None if i in self.unavailable else
+                           {'id': i, 'name': i, 'album': {'id': 'album'}, 'artists': [{'id': 'artist'}]}
+                           for i in track_ids]}
+
+    def audio_features(self, track_ids):
+        return [None for _ in track_ids]
+
+    def albums(self, album_ids):
+        return {'albums': [{'id': i, 'name': i, 'artists': [{'id': 'artist'}]} for i in album_ids]}
+
+    def artists(self, artist_ids):
+        return {'artists': [{'id': i, 'name': i} for i in artist_ids]}
+
+
+def record(played_at, track_id='track', ms_played=180000):
+    return {'ts': played_at.strftime('%Y-%m-%dT%H:%M:%SZ'), 'ms_played': ms_played,
+            'spotify_track_uri': 'spotify:track:' + track_id if track_id else None}
+
+
+def write_history(tmpdir, file_name, records):
+    path = tmpdir.join(file_name)
+    path.write(json.dumps(records))
+    return str(path)
+
+
+def make_importer(catalog=None, fail_at_batch=None, **kwargs):
+    # On SQLite the instances of a batch are added with the session instead of save_bulk's ON CONFLICT
+    # inserts, either way in one transaction with the progress. Batches from fail_at_batch on fail.
+    spotify = main.SpotifyConnection({'user_name': 'user'}, client=catalog or Catalog())
+    session = spotify.db.session
+    save_bulk = spotify.db.save_bulk
+    batches = []
+
+    def recording_save_bulk(artists, albums, tracks, plays):
+        batches.append([p.played_at_utc_timestamp for p in plays])
+        if fail_at_batch is not None and len(batches) >= fail_at_batch:
+            session.rollback()
+            raise RuntimeError('Interrupted')
+        if session.bind.dialect.name == 'postgresql':
+            return save_bulk(artists, albums, tracks, plays)
+        session.add_all(artists + albums + tracks + plays)
+        session.commit()
+        return len(plays), 0
+    spotify.db.save_bulk = recording_save_bulk
+    return history_import.HistoryImporter(spotify, batch_size=2, **kwargs), batches
+
+
+def imported_timestamps(database):
+    database.session.remove()
+    return [t for t, in database.session.query(Play.played_at_utc_timestamp).order_by(Play.played_at_utc_timestamp)]
+
+
+def timestamp(played_at):
+    return int((played_at - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def test_interrupted_import_resumes_after_the_committed_batches(database, tmpdir):
+    played_ats = [datetime(2017, 1, 1) + timedelta(hours=n) for n in range(7)]
+    path = write_history(tmpdir, 'Streaming_History_Audio_2017.json', [record(p) for p in played_ats])
+
+    importer, batches = make_importer(fail_at_batch=3)
+    with pytest.raises(RuntimeError):
+        importer.import_file(path)
+    importer.db.close()
+    assert len(batches) == 3
+    assert imported_timestamps(database) == [timestamp(p) for p in played_ats[:4]]
+    assert database.session.query(ImportProgress).get(('user', 'Streaming_History_Audio_2017.json')).records == 4
+
+    importer, batches = make_importer()
+    counts = importer.import_file(path)
+    importer.db.close()
+    # Only the records after the committed batches are read again, no play is saved twice
+    assert batches == [[timestamp(p) for p in played_ats[4:6]], [timestamp(played_ats[6])]]
+    assert (counts['records'], counts['inserted'], counts['skipped']) == (3, 3, 0)
+    assert imported_timestamps(database) == [timestamp(p) for p in played_ats]
+    progress = database.session.query(ImportProgress).get(('user', 'Streaming_History_Audio_2017.json'))
+    assert (progress.records, progress.before_timestamp) == (7, None)
+
+
+def test_skips_records_at_or_after_the_first_extracted_play(database, tmpdir):
+    add_track(database.session, 'track')
+    extracted_at = datetime(2018, 3, 10, 12)
+    add_play(database.session, 'user', 'track', extracted_at)
+    first = write_history(tmpdir, 'endsong_0.json', [record(extracted_at - timedelta(hours=1)),
+                                                     record(extracted_at),
+                                                     record(extracted_at + timedelta(hours=1))])
+
+    importer, _ = make_importer()
+    counts = importer.import_file(first)
+    importer.db.close()
+    assert (counts['inserted'], counts['extracted']) == (1, 2)
+
+    # Later files keep the boundary of the first import, although imported plays are older now
+    second = write_history(tmpdir, 'endsong_1.json', [record(extracted_at - timedelta(hours=3)),
+                                                      record(extracted_at - timedelta(hours=2))])
+    importer, _ = make_importer()
+    counts = importer.import_file(second)
+    importer.db.close()
+    assert (counts['inserted'], counts['extracted']) == (2, 0)
+    assert database.session.query(ImportProgress).get(('user', 'endsong_1.json')).before_timestamp == \
+        timestamp(extracted_at)
+
+
+@pytest.mark.parametrize('min_ms_played, inserted, too_short', [(30000, 1, 2), (0, 3, 0)])
+def test_skips_plays_shorter_than_min_ms_played(database, tmpdir, min_ms_played, inserted, too_short):
+    start = datetime(2017, 1, 1)
+    path = write_history(tmpdir, 'endsong_0.json', [record(start, ms_played=30000),
+                                                    record(start + timedelta(hours=1), ms_played=29999),
+                                                    record(start + timedelta(hours=2), ms_played=0),
+                                                    record(start + timedelta(hours=3), track_id=None)])
+    importer, _ = make_importer(min_ms_played=min_ms_played)
+    counts = importer.import_file(path)
+    importer.db.close()
+    assert (counts['inserted'], counts['too_short'], counts['not_a_track']) == (inserted, too_short, 1)
+
+
+def test_skips_tracks_spotify_does_not_return(database, tmpdir):
+    start = datetime(2017, 1, 1)
+    path = write_history(tmpdir, 'endsong_0.json', [record(start, track_id='gone'),
+                                                    record(start + timedelta(hours=1))])
+    importer, _ = make_importer(catalog=Catalog(unavailable=('gone',)))
+    counts = importer.import_file(path)
+    importer.db.close()
+    assert (counts['inserted'], counts['unavailable']) == (1, 1)
+
+
+@postgresql_only
+def test_importing_a_file_again_skips_its_plays(database, tmpdir):
+    start = datetime(2017, 1, 1)
+    path = write_history(tmpdir, 'endsong_0.json', [record(start + timedelta(hours=n)) for n in range(3)])
+    importer, _ = make_importer()
+    importer.import_file(path)
+    importer.db.close()
+    database.session.query(ImportProgress).delete()
+    database.session.commit()
+
+    importer, _ = make_importer()
+    counts = importer.import_file(path)
+    importer.db.close()
+    assert (counts['inserted'], counts['skipped']) == (0, 3)
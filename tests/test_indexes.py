@@ -0,0 +1,110 @@
+from datetime import datetime
+import re
+
+import pytest
+from sqlalchemy import event
+
+from conftest import add_play, add_track, postgresql_only
+from models import db
+
+COUNT_UNITS = ('track', 'album', 'artist', 'hour', 'day', 'week', 'month', 'year')
+AUDIO_FEATURE_UNITS = ('hour', 'day', 'week', 'month', 'year')
+HISTOGRAM_BUCKETS = ('15min', 'hour', 'day', 'week', 'month', 'year')
+DATES = 'from/2018-01-01/to/2018-12-31'
+STATS_UNITS = ','.join(['count:' + unit for unit in COUNT_UNITS] +
+                       ['audio_feature:' + unit for unit in AUDIO_FEATURE_UNITS])
+ROUTES = ['/plays/user/user', '/plays/history/user/user'] + \
+    ['/counts/per/{}/user/user/{}'.format(unit, DATES) for unit in COUNT_UNITS] + \
+    ['/audiofeatures/per/{}/user/user/{}'.format(unit, DATES) for unit in AUDIO_FEATURE_UNITS] + \
+    ['/stats/user/user/{}?units={}'.format(DATES, STATS_UNITS)] + \
+    [pytest.param('/histogram/per/{}/user/user/{}?tz=America/New_York'.format(bucket, DATES),
+                  marks=postgresql_only) for bucket in HISTOGRAM_BUCKETS]
+
+
+class StatementRecorder(object):
+
+    # Statements and DBAPI parameters of the queries sent on an engine while recording
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')) and statement.strip() != 'SELECT 1':
+            self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+        return False
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        for n in plan_nodes(child):
+            yield n
+
+
+def postgres_full_scans(cursor, statement, parameters):
+    # With sequential scans disabled the planner only chooses one if no index can answer the query, so the
+    # result does not depend on the size of the tables
+    cursor.execute('SET enable_seqscan = off')
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.execute('RESET enable_seqscan')
+    return [n['Relation Name'] for n in plan_nodes(plan[0]['Plan']) if n['Node Type'] == 'Seq Scan']
+
+
+def sqlite_full_scans(cursor, statement, parameters):
+    # "SCAN t_play" reads the whole table, "SCAN t_play USING INDEX ..." and "SEARCH ..." use an index.
+    # Tables are named by their alias (t_track_artists_1), CTEs and subqueries are not tables. SQLite
+    # materializes the parenthesized joins of joinedload whatever the indexes are, PostgreSQL's plans
+    # cover them.
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    parents = dict()
+    materialized = set()
+    scanned = []
+    for node_id, parent_id, _, detail in cursor.fetchall():
+        parents[node_id] = parent_id
+        if detail.startswith('MATERIALIZE'):
+            materialized.add(node_id)
+        elif detail.startswith('SCAN ') and ' USING ' not in detail:
+            scanned.append((parent_id, detail.split()[1]))
+    found = []
+    for parent_id, name in scanned:
+        while parent_id and parent_id not in materialized:
+            parent_id = parents.get(parent_id)
+        if not parent_id and re.sub(r'_\d+$', '', name) in db.metadata.tables:
+            found.append(name)
+    return found
+
+
+def full_scans(engine, statement, parameters):
+    explain = postgres_full_scans if engine.dialect.name == 'postgresql' else sqlite_full_scans
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        return explain(cursor, statement, parameters)
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('url', ROUTES)
+def test_endpoint_queries_use_indexes(client, database, url):
+    session = database.session
+    add_track(session, 'track')
+    add_play(session, 'user', 'track', datetime(2018, 3, 10, 12))
+    with StatementRecorder(database.engine) as recorder:
+        response = client.get(url)
+        response.get_data()  # Also runs streamed responses to the end
+    assert response.status_code == 200
+    assert recorder.statements
+    found = [(statement, full_scans(database.engine, statement, parameters))
+             for statement, parameters in recorder.statements]
+    assert [(statement, tables) for statement, tables in found if tables] == []
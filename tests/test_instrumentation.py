@@ -0,0 +1,68 @@
+from flask import g
+import pytest
+
+import instrumentation
+from app import app
+
+
+class Stats(object):
+
+    def __init__(self, statements=0):
+        self.statements = statements
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+
+
+def record_request(monkeypatch, path, seconds=0.0, slow_request_seconds=1.0):
+    # One request through the hooks of Instrumentation, returns its metrics and the logged warnings
+    monkeypatch.setitem(app.config, 'SLOW_REQUEST_SECONDS', slow_request_seconds)
+    metrics = instrumentation.Metrics()
+    hooks = instrumentation.Instrumentation(app, metrics)
+    warnings = []
+    monkeypatch.setattr(app.logger, 'warning', warnings.append)
+    with app.test_request_context(path):
+        hooks.before_request()
+        g.request_stats.started -= seconds  # As if the request took seconds
+        hooks.after_request(app.response_class(status=200))
+        hooks.teardown_request(None)
+    return metrics, warnings
+
+
+@pytest.mark.parametrize('path, unit', [('/counts/per/track/user/user', 'track'),
+                                        ('/audiofeatures/per/week/user/user', 'week'),
+                                        ('/histogram/per/15min/user/user', '15min'),
+                                        ('/counts/per/made_up_1/user/user', 'other'),
+                                        ('/histogram/per/made_up_2/user/user', 'other'),
+                                        ('/stats/user/user?units=count:track,made_up_3', ''),
+                                        ('/plays/user/user', '')])
+def test_unit_label_is_a_known_unit(monkeypatch, path, unit):
+    metrics, _ = record_request(monkeypatch, path)
+    (endpoint, label, status), = metrics.routes
+    assert (label, status) == (unit, 200)
+
+
+def test_prometheus_histogram_and_label_escaping():
+    metrics = instrumentation.Metrics()
+    labels = ('counts', 'a"b\\c\nd', 200)
+    metrics.record(labels, Stats(statements=2), 0.02)
+    metrics.record(labels, Stats(statements=3), 3.0)
+    lines = metrics.to_prometheus().splitlines()
+
+    formatted = 'endpoint="counts",unit="a\\"b\\\\c\\nd",status="200"'
+    assert 'hoergewohnheiten_requests_total{{{}}} 2'.format(formatted) in lines
+    assert 'hoergewohnheiten_request_statements_total{{{}}} 5'.format(formatted) in lines
+    buckets = [line for line in lines if line.startswith('hoergewohnheiten_request_duration_seconds_bucket')]
+    assert buckets[:3] == ['hoergewohnheiten_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+        formatted, upper_bound, count) for upper_bound, count in ((0.005, 0), (0.01, 0), (0.025, 1))]
+    assert 'hoergewohnheiten_request_duration_seconds_bucket{{{},le="5.0"}} 2'.format(formatted) in buckets
+    assert buckets[-1] == 'hoergewohnheiten_request_duration_seconds_bucket{{{},le="+Inf"}} 2'.format(formatted)
+    assert 'hoergewohnheiten_request_duration_seconds_count{{{}}} 2'.format(formatted) in lines
+    assert '# TYPE hoergewohnheiten_request_duration_seconds histogram' in lines
+
+
+@pytest.mark.parametrize('seconds, logged', [(0.5, False), (1.5, True)])
+def test_logs_requests_slower_than_the_threshold(monkeypatch, seconds, logged):
+    _, warnings = record_request(monkeypatch, '/counts/per/track/user/user', seconds=seconds)
+    assert bool(warnings) == logged
+    if logged:
+        assert warnings[0].startswith('Slow request GET /counts/per/track/user/user?: ')
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+from play_times import PLAY_TIME_COLUMNS, decompose_played_at
+
+
+def played_ats(start, end, step):
+    result = []
+    while start <= end:
+        result.append(start.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z')
+        start += step
+    return result
+
+
+# CET changes to CEST at 2018-03-25T01:00:00Z and back at 2018-10-28T01:00:00Z
+DST_PLAYED_ATS = (
+    played_ats(datetime(2018, 3, 24, 23), datetime(2018, 3, 26, 2), timedelta(minutes=15)) +
+    played_ats(datetime(2018, 10, 27, 23), datetime(2018, 10, 29, 2), timedelta(minutes=15)) +
+    ['2018-03-25T00:59:59.999Z', '2018-03-25T01:00:00Z', '2018-03-25T01:00:00.001Z',
+     '2018-10-28T00:59:59.999Z', '2018-10-28T01:00:00Z', '2018-10-28T01:00:00.001Z',
+     '2018-10-28T00:30:00Z', '2018-10-28T01:30:00Z']
+)
+
+
+def comparable(value):
+    # Datetimes are also compared by offset, fold and tzinfo, which == ignores for the same tzinfo
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None), value.utcoffset(), getattr(value, 'fold', 0), id(value.tzinfo)
+    return type(value), value
+
+
+def mismatches(per_row, batch):
+    found = []
+    for row, (a, b) in enumerate(zip(per_row, batch)):
+        for column in PLAY_TIME_COLUMNS:
+            if comparable(getattr(a, column)) != comparable(getattr(b, column)):
+                found.append((row, column, getattr(a, column), getattr(b, column)))
+    return found
+
+
+@pytest.fixture
+def spotify(database):
+    spotify = main.SpotifyConnection({'user_name': 'user'}, client=object())
+    yield spotify
+    spotify.db.close()
+
+
+def test_batch_conversion_matches_single_plays_around_dst_changes(spotify):
+    per_row = [spotify.get_play_from_played_at_utc(p) for p in DST_PLAYED_ATS]
+    batch = spotify.get_plays_from_played_at_utc(DST_PLAYED_ATS)
+    assert mismatches(per_row, batch) == []
+
+
+def test_ambiguous_wall_times_keep_their_offset(spotify):
+    # 02:30 CET exists twice on 2018-10-28, first in summer time
+    columns = decompose_played_at(['2018-10-28T00:30:00Z', '2018-10-28T01:30:00Z'])
+    first, second = columns['played_at_cet']
+    assert first.replace(tzinfo=None) == second.replace(tzinfo=None) == datetime(2018, 10, 28, 2, 30)
+    assert first.utcoffset() == timedelta(hours=2)
+    assert second.utcoffset() == timedelta(hours=1)
+    for played_at, value in zip(['2018-10-28T00:30:00Z', '2018-10-28T01:30:00Z'], (first, second)):
+        assert comparable(value) == comparable(spotify.get_play_from_played_at_utc(played_at).played_at_cet)
@@ -0,0 +1,122 @@
+import pytest
+import requests
+from spotipy.client import SpotifyException
+
+import rate_limit
+from rate_limit import CircuitBreaker, CircuitOpenError, RequestScheduler
+
+
+class FakeClock(object):
+
+    # Time only advances by sleeping, so waits of the scheduler can be asserted exactly
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_scheduler(clock, **options):
+    defaults = {'rate': 10.0, 'burst': 1, 'max_retries': 3, 'backoff_base': 0.5, 'backoff_max': 30.0,
+                'breaker_threshold': 2, 'breaker_reset_seconds': 30.0, 'seed': 0}
+    defaults.update(options)
+    return RequestScheduler('client', clock=clock, sleep=clock.sleep, **defaults)
+
+
+def responses(*outcomes):
+    # A request function that raises or returns the outcomes in order
+    outcomes = list(outcomes)
+
+    def request():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return request
+
+
+def throttled(seconds):
+    return SpotifyException(429, -1, 'Too many requests', headers={'Retry-After': str(seconds)})
+
+
+def test_429_waits_retry_after():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock)
+    assert scheduler.call(responses(throttled(7), 'ok')) == 'ok'
+    # Retry-After plus a jitter below backoff_base
+    assert 7 <= clock.sleeps[1] < 7.5
+    assert clock.now - 1000.0 >= 7
+    assert scheduler.stats.counts['throttled'] == 1
+    assert scheduler.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_server_errors_back_off_exponentially():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, breaker_threshold=10)
+    error = SpotifyException(503, -1, 'Service unavailable')
+    with pytest.raises(SpotifyException):
+        scheduler.call(responses(error, error, error, error))
+    backoffs = [s for s in clock.sleeps if s > 0.1]
+    assert len(backoffs) == 3
+    for attempt, seconds in enumerate(backoffs):
+        assert seconds <= 0.5 * 2 ** attempt
+    assert scheduler.stats.counts['retried'] == 3
+    assert scheduler.stats.counts['failed'] == 1
+
+
+def test_breaker_opens_half_opens_and_closes():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, max_retries=0)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            scheduler.call(responses(requests.exceptions.ConnectionError()))
+    assert scheduler.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        scheduler.call(responses('ok'))
+
+    # A failed trial opens the circuit again
+    clock.now += 30
+    with pytest.raises(requests.exceptions.ConnectionError):
+        scheduler.call(responses(requests.exceptions.ConnectionError()))
+    assert scheduler.breaker.state == CircuitBreaker.OPEN
+
+    clock.now += 30
+    assert scheduler.call(responses('ok')) == 'ok'
+    assert scheduler.breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.parametrize('outcome', [throttled(1), ValueError('Broken JSON')])
+def test_every_trial_outcome_ends_half_open(outcome):
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, max_retries=0)
+    for _ in range(2):
+        scheduler.breaker.failure()
+    clock.now += 30
+    with pytest.raises(type(outcome)):
+        scheduler.call(responses(outcome))
+    assert scheduler.breaker.state != CircuitBreaker.HALF_OPEN
+
+
+def test_trial_without_outcome_times_out():
+    clock = FakeClock()
+    breaker = CircuitBreaker(threshold=1, reset_seconds=30.0, clock=clock)
+    breaker.failure()
+    clock.now += 30
+    assert breaker.check() == 0.0
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # The trial is still running
+    assert breaker.check() == 30.0
+    clock.now += 30
+    assert breaker.check() == 0.0
+
+
+def test_retry_after_header():
+    assert rate_limit.retry_after({'Retry-After': '3'}) == 3.0
+    assert rate_limit.retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) is None
+    assert rate_limit.retry_after({}) is None